@@ -0,0 +1,54 @@
+#! usr/bin/env python
+
+# ## PIPELINE: fmripreproc_client.py
+# ## USAGE: python3 fmripreproc_client.py [--socket=<path>] --in=<inputs> --out=<outputs> [OPTIONS]
+#    * thin client for a running "fmripreproc_wrapper.py serve" daemon: takes the same
+#      arguments as fmripreproc_wrapper.py, streams the output and exits with its status
+#    * standard library only, so it starts instantly (no pybids/numpy import)
+#
+import os, sys, json, socket
+
+EXIT = b'\0fmripreproc-exit '
+
+def default_socket():
+  # also used by the server (fmripreproc_wrapper.py serve)
+  return os.environ.get('FMRIPREPROC_SOCKET', '/tmp/fmripreproc-' + str(os.getuid()) + '.sock')
+
+def main(argv):
+
+  path = default_socket()
+  args = []
+  for arg in argv:
+    if arg.startswith('--socket='):
+      path = arg.split('=', 1)[1]
+    else:
+      args.append(arg)
+
+  conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    conn.connect(path)
+  except (FileNotFoundError, ConnectionRefusedError):
+    print('No fmripreproc server on ' + path + ' (start one with: fmripreproc_wrapper.py serve)')
+    return 2
+  conn.sendall((json.dumps({'argv': args, 'cwd': os.getcwd()}) + '\n').encode())
+
+  # Ctrl-C closes the connection, the server then cancels the request
+  status = 1
+  out = sys.stdout.buffer
+  for line in conn.makefile('rb'):
+    if EXIT in line:
+      line, code = line.split(EXIT, 1)
+      out.write(line)
+      out.flush()
+      status = int(code)
+      break
+    out.write(line)
+    out.flush()
+  conn.close()
+  return status
+
+if __name__ == "__main__":
+  try:
+    sys.exit(main(sys.argv[1:]))
+  except KeyboardInterrupt:
+    sys.exit(130)
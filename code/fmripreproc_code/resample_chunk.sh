@@ -0,0 +1,54 @@
+#!/usr/bin/bash
+#
+# resample_chunk
+#
+# SYNTAX
+#     resample_chunk $epi $firstvol $nvols $mat $stdimg $out [$mask] [$roi] [$warp]
+#
+# DESCRIPTION
+# resample one block of volumes of a native space functional series to standard
+# space (used by fmripreproc resample). Optionally mask the result, or reduce it
+# to mean time series of the labels in an roi image ($out.txt). The published
+# series may be int16 (--output-dtype): the result is always float.
+
+#______________________________________________________________________
+#
+
+# assign inputs
+epi=$1           # native space functional series
+t0=$2            # first volume of this chunk
+n=$3             # number of volumes in this chunk
+mat=$4           # example_func2standard.mat
+stdimg=$5        # standard space reference
+out=$6           # output chunk (no extension)
+mask=${7:-none}  # standard space mask
+roi=${8:-none}   # standard space label image
+warp=${9:-none}  # highres2standard_warp ($mat is then example_func2highres.mat)
+
+cmd="fslroi $epi ${out}_native $t0 $n"
+echo $cmd
+$cmd || exit 1
+
+if [ "$warp" != "none" ]; then
+	cmd="applywarp -r $stdimg -i ${out}_native -o $out -w $warp --rel --premat=$mat --interp=trilinear --datatype=float"
+else
+	cmd="flirt -ref $stdimg -in ${out}_native -out $out -applyxfm -init $mat -interp trilinear -datatype float"
+fi
+echo $cmd
+$cmd || exit 1
+rm -f ${out}_native.nii.gz
+
+if [ "$mask" != "none" ]; then
+	cmd="fslmaths $out -mas $mask $out"
+	echo $cmd
+	$cmd || exit 1
+fi
+
+if [ "$roi" != "none" ]; then
+	cmd="fslmeants -i $out --label=$roi -o ${out}.txt"
+	echo $cmd
+	$cmd || exit 1
+	rm -f ${out}.nii.gz
+fi
+
+# END RESAMPLE_CHUNK
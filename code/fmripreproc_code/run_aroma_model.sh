@@ -3,7 +3,7 @@
 # run_aroma_model
 #
 # SYNTAX
-#     run_aroma_model $epi $t1w $fsf $stdimg $wd
+#     run_aroma_model $epi $t1w $fsf $stdimg $wd $key [$warp]
 #
 # DESCRIPTION
 # run fsl feat model for aroma 
@@ -20,25 +20,21 @@ t1w_brain=$2     							 # t1w image from bet (skull stripped)
 fsf=$3										 # design file template for aroma
 stdimg=$4        							 # standard space image for final registration
 wd=$5
-
-# pull task and run name (assumes bids convention!)
-epiname=`basename $epi_preproc`
-subj=`echo ${epiname#*sub-} | cut -d"_" -f1`
-task=`echo ${epiname#*task-} | cut -d"_" -f1`
-run=`echo ${epiname#*run-} | cut -d"_" -f1`
+key=$6                                       # working directory key (session, acquisition, task and run)
+warp=${7:-none}                              # highres -> standard warp from brain extraction (str2standard)
 
 # setup
 mkdir -p $wd/aroma/
 cd $wd/aroma/
 
-featname=${task}${run}_aroma_noHP.feat
-log=${task}${run}_aroma_noHP.log
+featname=${key}_aroma_noHP.feat
+log=${key}_aroma_noHP.log
 
 # create local links for epi and sbref
-epi=$PWD/$task$run.nii.gz
+epi=$PWD/$key.nii.gz
 ln -s $epi_preproc $epi
 
-sbref=$PWD/${task}${run}_sbref.nii.gz
+sbref=$PWD/${key}_sbref.nii.gz
 ln -s $epi_ref $sbref
 
 t1w=$PWD/t1w_brain.nii.gz
@@ -56,7 +52,7 @@ fi
 here=$PWD
 
 fsffile=`basename $fsf`
-designfile=${task}${run}_${fsffile}
+designfile=${key}_${fsffile}
 cp -p $fsf $wd/aroma/$designfile
 cd $wd/aroma/
 
@@ -81,6 +77,11 @@ sed -i "s,UNWARP_DIRECTION_PLACEHOLDER,${unwrapdir},g" $designfile
 
 sed -i "s,BRAIN_STANDARD_PLACEHOLDER,$stdimg,g" $designfile
 
+# with the brain extraction warp feat does not run fnirt, the warp is put in reg/ for aroma
+if [ "$warp" != "none" ]; then
+	sed -i "s,set fmri(regstandard_nonlinear_yn) 1,set fmri(regstandard_nonlinear_yn) 0,g" $designfile
+fi
+
 # run feat....
 export FSL_SLURM_XNODE_NAME=bnode0101,bnode0102,bnode0103,bnode0104,bnode0105
 export FSL_SLURM_NUM_CPU=3
@@ -104,4 +105,10 @@ do
     echo "Waiting For Jobs To Complete: $duration seconds"
     sleep 30;
 done;
-sleep 30;
\ No newline at end of file
+sleep 30;
+
+if [ "$warp" != "none" ]; then
+	cmd="cp -pL $warp $wd/aroma/$featname/reg/highres2standard_warp.nii.gz"
+	echo $cmd >> $log
+	$cmd >> $log 2>&1
+fi
@@ -2,7 +2,7 @@
 #  run_bet
 #
 # SYNTAX
-#     run_bet $t1w $outfile $wd 
+#     run_bet $t1w $wd [$ref2mm $ref2mmmask $ref $refmask]
 #
 # DESCRIPTION
 #
@@ -27,7 +27,7 @@ echo $cmd >> $log
 $cmd >> $log 2>&1
 
 scripts=`dirname $0`
-cmd="$scripts/t1_fnirt_bet2 $PWD/t1w.nii.gz 0.8mm "  ## t1_fnirt_bet2 is a banich lab tool!!
+cmd="$scripts/t1_fnirt_bet2 $PWD/t1w.nii.gz 0.8mm $3 $4 $5 $6"  ## t1_fnirt_bet2 is a banich lab tool!!
 echo $cmd >> $log
 $cmd >> $log 2>&1
 
@@ -3,7 +3,7 @@
 # run_discorrepi
 #
 # SYNTAX
-#     run_discorrepi XXXXX
+#     run_discorrepi $epi $topup_fout $params $topupdir $wd [$chunkvols $njobs]
 #
 # DESCRIPTION
 # Run distortion correction with FSL topup if prescan normalization filter set.
@@ -35,6 +35,9 @@ topup_fout=$2    # output from topup
 params=$3        # parameters for aquisition sequence
 topupdir=$4
 wd=$5
+chunkvols=${6:-0}  # >0: apply topup in blocks of volumes (see split_apply)
+njobs=${7:-1}      # blocks processed at a time
+scripts=`dirname $0`
 
 mkdir -p $wd/distcorrepi
 cd $wd/distcorrepi
@@ -50,9 +53,16 @@ distcorrepi=dc_${sname}
 distcorrepi_abs=dc_${sname}_abs
 
 # apply distortion correction to functional series
-cmd="applytopup --imain=$epifile --inindex=1 --topup=../$topupdir/$topup_fout --datain=../$topupdir/$params --method=jac --interp=spline --out=$distcorrepi"
-echo $cmd >> $log
-$cmd >> $log 2>&1
+nvols=`fslval $epifile dim4`
+if [ $chunkvols -gt 0 ] && [ $nvols -gt $chunkvols ]; then
+    echo "APPLYING TOPUP IN BLOCKS OF $chunkvols VOLUMES ($njobs AT A TIME)" >> $log
+    cmd="applytopup --imain=@IN@ --inindex=1 --topup=../$topupdir/$topup_fout --datain=../$topupdir/$params --method=jac --interp=spline --out=@OUT@"
+    bash $scripts/split_apply $chunkvols $njobs $epifile $distcorrepi "$cmd" >> $log 2>&1
+else
+    cmd="applytopup --imain=$epifile --inindex=1 --topup=../$topupdir/$topup_fout --datain=../$topupdir/$params --method=jac --interp=spline --out=$distcorrepi"
+    echo $cmd >> $log
+    $cmd >> $log 2>&1
+fi
 
 #removing spline interpolation negative values by replacing with absolute value
 cmd="fslmaths $distcorrepi -abs $distcorrepi_abs -odt short"
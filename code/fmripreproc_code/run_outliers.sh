@@ -3,10 +3,12 @@
 # run_outliers
 #
 # SYNTAX
-#     run_outliers $epi $t1w $wd
+#     run_outliers $epi $epi_mcf $wd [$regdir $segdir]
 #
 # DESCRIPTION
-# run fsl motion outlier detection for preprocessed images
+# run fsl motion outlier detection for preprocessed images. With a registration
+# directory and FAST segmentation, also warp the CSF, white matter and brain
+# masks to the functional grid for CompCor (<prefix>_{csf,wm,brain}_func).
 
 # Amy Hegarty, Intermountain Neuroimaging Consortium
 # 12-16-2021
@@ -18,6 +20,8 @@ epi_preproc=$1   							 # functional series BEFORE motion correction from prepr
 epi_preproc_mcf=$2 							 # functional series AFTER motion correction from preproc working directory...
 # mask=$3							 		     # Brain mask for functional series
 wd=$3
+regdir=${4:-none}                            # registration directory (highres2example_func.mat)
+segdir=${5:-none}                            # FAST output directory (t1w_brain_seg_0 / _2)
 
 # setup
 mkdir -p $wd/preproc/
@@ -50,6 +54,27 @@ echo $cmd >> $log
 $cmd >> $log 2>&1
 cd $here
 
+# ---------- CompCor Masks --------- #
+
+if [ -f $regdir/highres2example_func.mat ] && [ -f $segdir/t1w_brain_seg_2.nii.gz ]; then
+	for tissue in csf:$segdir/t1w_brain_seg_0 wm:$segdir/t1w_brain_seg_2 brain:$regdir/mask; do
+		name=${tissue%%:*}
+		cmd="flirt -in ${tissue#*:} -ref $regdir/example_func -applyxfm -init $regdir/highres2example_func.mat -interp trilinear -out ${prefix}_${name}_func"
+		echo $cmd >> $log
+		$cmd >> $log 2>&1
+	done
+
+	# keep voxels (almost) entirely inside the tissue, erode white matter away from grey matter
+	for cmd in "fslmaths ${prefix}_csf_func -thr 0.99 -bin ${prefix}_csf_func -odt char" \
+	           "fslmaths ${prefix}_wm_func -thr 0.99 -bin -ero ${prefix}_wm_func -odt char" \
+	           "fslmaths ${prefix}_brain_func -thr 0.5 -bin ${prefix}_brain_func -odt char"; do
+		echo $cmd >> $log
+		$cmd >> $log 2>&1
+	done
+else
+	echo "No registration or segmentation: skipping CompCor masks" >> $log
+fi
+
 counfoundsname=${prefix}_confounds.tsv
 
 # puth the outlier files + metrics together + motion (?)
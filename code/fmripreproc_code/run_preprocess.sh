@@ -2,7 +2,7 @@
 # ldrc_preprocess
 #
 # SYNTAX
-#     run_preprocess $epi $func $outputname $wd $trimvol
+#     run_preprocess $epi $func $outputname $wd $trimvol [$croppad]
 #
 # DESCRIPTION
 # Create in analysis/preproc the accession-based subject number directories with input from:
@@ -25,6 +25,12 @@
 # Run bet on the SBRef files in analysis/preproc/* using:
 #    bet SBRef SBRef_bet -f 0.3
 #
+# With $croppad > 0 the trimmed series and SBRef are cropped to the brain
+# bounding box (bet of the SBRef, or of the mean volume without SBRef) plus
+# $croppad voxels before motion correction. The box is saved in
+#        <task>_crop.txt           (x0 nx y0 ny z0 nz)
+#        <task>_crop_ref.nii.gz    (full grid reference, for restoring on publish)
+#
 # Amy Hegarty, Intermountain Neuroimaging Consortium
 # 09-03-2021
 #______________________________________________________________________
@@ -35,6 +41,10 @@ epi=$1           # functional series for distortion correction
 func=$2
 wd=$3
 let trimvol=${4:-0}  # number of input volumes from epi
+let croppad=${5:-0}  # >0: crop to the brain bounding box plus this many voxels
+let chunkvols=${6:-0} # >0: motion correct in blocks of volumes (see split_apply)
+let njobs=${7:-1}     # blocks motion corrected at once
+scripts=`dirname $0`
 #
 dcdir=$wd/distcorrepi
 betdir=$wd/bet
@@ -51,6 +61,23 @@ mkdir -p $wd/preproc
 cd $wd/preproc 
 log=${func}_preprocess.log
 #
+# mcflirt on $trimmed against the reference image $1. In blocks every volume is
+# registered to the same reference, so the merged series and the concatenated
+# ${func}_mcf.par match a single run; only the initial guess of the first
+# volume of each block differs. The mean volume (-stats) is taken afterwards.
+motion_correct () {
+    if [ $chunkvols -gt 0 ]; then
+        mcf="mcflirt -in @IN@ -out @OUT@ -reffile $1 -plots"
+        echo "split_apply $chunkvols $njobs $trimmed ${func}_mcf $mcf" >> $log
+        bash $scripts/split_apply $chunkvols $njobs $trimmed ${func}_mcf "$mcf" >> $log 2>&1
+        cmd="fslmaths ${func}_mcf -Tmean ${func}_mcf_meanvol"
+    else
+        cmd="mcflirt -in $trimmed -reffile $1 -stats -plots -report"
+    fi
+    echo $cmd >> $log
+    $cmd >> $log 2>&1
+}
+#
 currentDate=`date`
 echo "time stamp: $currentDate" >> $log
 echo "$PWD" >> $log
@@ -90,6 +117,44 @@ if [ -f $raw ]; then
     $cmd >> $log 2>&1
 #
     raw_SBRef=${raw//bold/sbref}
+    if [ $croppad -gt 0 ]; then
+        echo "... CROP TO BRAIN BOUNDING BOX: $func" >> $log
+        cropref=${func}_crop_ref.nii.gz
+        if [ -f $raw_SBRef ]; then
+            cmd="fslmaths $raw_SBRef $cropref"
+        else
+            cmd="fslmaths $trimmed -Tmean $cropref"
+        fi
+        echo $cmd >> $log
+        $cmd >> $log 2>&1
+        cmd="bet $cropref ${func}_crop_bet -f 0.3"
+        echo $cmd >> $log
+        $cmd >> $log 2>&1
+#
+        # smallest box containing the brain (fslstats -w), padded and clipped to the image
+        box=(`fslstats ${func}_crop_bet -w`)
+        roi=""
+        for i in 0 1 2; do
+            let dim=`fslval $cropref dim$((i+1))`
+            let lo=${box[$((2*i))]}-$croppad
+            let hi=${box[$((2*i))]}+${box[$((2*i+1))]}+$croppad
+            [ $lo -lt 0 ] && lo=0
+            [ $hi -gt $dim ] && hi=$dim
+            roi="$roi $lo $((hi-lo))"
+        done
+        echo $roi > ${func}_crop.txt
+        rm -f ${func}_crop_bet.nii.gz
+#
+        cmd="fslroi $trimmed $trimmed $roi 0 -1"
+        echo $cmd >> $log
+        $cmd >> $log 2>&1
+        if [ -f $raw_SBRef ]; then
+            cmd="fslroi $raw_SBRef ${func}_SBRef_crop $roi"
+            echo $cmd >> $log
+            $cmd >> $log 2>&1
+            raw_SBRef=$PWD/${func}_SBRef_crop.nii.gz
+        fi
+    fi
     SBRef=${func}_SBRef.nii.gz
     if [ -f $raw_SBRef ]; then
         echo "... GET SBREF: $func" >> $log
@@ -97,9 +162,7 @@ if [ -f $raw ]; then
         echo $cmd >> $log
         $cmd >> $log 2>&1
         echo "... MOTION CORRECT FUNCTIONAL SERIES: $func" >> $log
-        cmd="mcflirt -in $trimmed -reffile $SBRef -stats -plots -report"
-        echo $cmd >> $log
-        $cmd >> $log 2>&1
+        motion_correct $SBRef
 #
         echo "... GET BRAIN EXTRACT: ${func}_SBRef" >> $log
         SBRef_bet=${func}_SBRef_bet.nii.gz
@@ -115,9 +178,18 @@ if [ -f $raw ]; then
     else
         # ---- SBref not provided!! ---- #
         echo "... MOTION CORRECT FUNCTIONAL SERIES: $func" >> $log
-        cmd="mcflirt -in $trimmed -stats -plots -report"
-        echo $cmd >> $log
-        $cmd >> $log 2>&1
+        if [ $chunkvols -gt 0 ]; then
+            # blocks need a common reference: mcflirt's default middle volume
+            let nvols="`fslval $trimmed dim4`"
+            cmd="fslroi $trimmed ${func}_mcfref $((nvols/2)) 1"
+            echo $cmd >> $log
+            $cmd >> $log 2>&1
+            motion_correct ${func}_mcfref
+        else
+            cmd="mcflirt -in $trimmed -stats -plots -report"
+            echo $cmd >> $log
+            $cmd >> $log 2>&1
+        fi
 #
         echo "... NO SBref PROVIDED, REFERENCE VOLUME FROM MCFLIRT: ${func}_meanvol" >> $log
         Ref_bet=${func}_meanvol_bet.nii.gz
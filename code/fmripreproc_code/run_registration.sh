@@ -3,10 +3,15 @@
 # run_registration
 #
 # SYNTAX
-#     run_registration $epi $t1w $stdimg $wd
+#     run_registration $epi $t1w $t1w_brain $stdimg $wd $key [full|lazy] [$chunkvols $njobs] [$warp]
 #
 # DESCRIPTION
 # run registration for functional images to t1w and standard space. 
+# In lazy mode only the transforms (and reference image) are written to
+# standard space; the 4D series is resampled on demand (fmripreproc resample).
+# With $warp (the fnirt T1w -> MNI warp of brain extraction, str2standard) the
+# standard space outputs are nonlinear: applywarp with example_func2highres.mat
+# as premat. The affine example_func2standard.mat is still written.
 
 # Amy Hegarty, Intermountain Neuroimaging Consortium
 # 09-03-2021
@@ -19,14 +24,16 @@ t1w=$2    	     # t1w image from bet (with skull)
 t1w_brain=$3     # t1w image from bet (skull stripped)
 stdimg=$4        # standard space image for final registration
 wd=$5
-
-# pull task and run name (assumes bids convention!)
-task=`echo ${epi#*task-} | cut -d"_" -f1`
-run=`echo ${epi#*run-} | cut -d"_" -f1`
+key=$6           # working directory key (session, acquisition, task and run)
+standard_outputs=${7:-full}   # full: also resample func_data to standard space
+chunkvols=${8:-0}             # >0: resample func_data in blocks of volumes (see split_apply)
+njobs=${9:-1}                 # blocks processed at a time
+warp=${10:-none}              # highres -> standard warp (t1_fnirt_bet2 str2standard)
+scripts=`dirname $0`
 
 # setup
-mkdir -p $wd/reg/$task$run
-cd $wd/reg/$task$run
+mkdir -p $wd/reg/$key
+cd $wd/reg/$key
 
 log='registration.log'
 
@@ -48,14 +55,23 @@ $cmd >> $log 2>&1
 
 # link standard image to directory
 echo "Using standard image: $stdimg"
-cmd="ln -s $stdimg standard.nii.gz"
+case $stdimg in
+	*.nii) cmd="ln -s $stdimg standard.nii" ;;
+	*)     cmd="ln -s $stdimg standard.nii.gz" ;;
+esac
 echo $cmd >> $log
 $cmd >> $log 2>&1
 
 # get epi reference image...
-cmd="fslmaths $epi func_data -odt float"
-echo $cmd >> $log
-$cmd >> $log 2>&1
+if [ "$standard_outputs" == "full" ]; then
+	cmd="fslmaths $epi func_data -odt float"
+	echo $cmd >> $log
+	$cmd >> $log 2>&1
+	funcsrc=func_data
+else
+	echo "Lazy standard space outputs: skipping func_data2standard" >> $log
+	funcsrc=$epi
+fi
 
 sbrefile=${epi//bold/sbref}
 
@@ -69,7 +85,7 @@ else
 	let voln=`fslval $epi dim4`
 	echo "Total original volumes: $voln" >> $log
 	centerval=`bc <<<"scale=0; $voln / 2"`
-	cmd="fslroi func_data example_func $centerval 1"
+	cmd="fslroi $funcsrc example_func $centerval 1"
 	echo $cmd >> $log
 	$cmd >> $log 2>&1 
 fi
@@ -84,10 +100,28 @@ cmd="convert_xfm -inverse -omat highres2example_func.mat example_func2highres.ma
 echo $cmd >> $log
 $cmd >> $log 2>&1 
 
-# register t1w to standard space
-cmd="flirt -in highres -ref standard -out highres2standard -omat highres2standard.mat -cost corratio -dof 12 -searchrx -90 90 -searchry -90 90 -searchrz -90 90 -interp trilinear "
+# final bbr cost of the registration (checked by the wrapper before later stages run)
+cmd="flirt -in example_func -ref highres_head -init example_func2highres.mat -schedule $FSLDIR/etc/flirtsch/measurecost1.sch -cost bbr -wmseg example_func2highres_fast_wmseg -omat /dev/null"
 echo $cmd >> $log
-$cmd >> $log 2>&1 
+$cmd 2>> $log | head -1 | cut -f1 -d' ' > example_func2highres_cost.txt
+
+# register t1w to standard space
+if [ "$warp" != "none" ]; then
+	# reuse the fnirt warp from brain extraction (highres is struc_acpc_brain, the image fnirt registered)
+	echo "Using nonlinear highres to standard warp: $warp" >> $log
+	for cmd in "ln -s $warp highres2standard_warp.nii.gz" \
+	           "cp -p `dirname $warp`/roughlin.mat highres2standard.mat" \
+	           "applywarp -i highres -r standard -w highres2standard_warp --rel -o highres2standard --interp=trilinear"; do
+		echo $cmd >> $log
+		$cmd >> $log 2>&1
+	done
+	resample="applywarp -r standard -i @IN@ -o @OUT@ -w highres2standard_warp --rel --premat=example_func2highres.mat --interp=trilinear"
+else
+	cmd="flirt -in highres -ref standard -out highres2standard -omat highres2standard.mat -cost corratio -dof 12 -searchrx -90 90 -searchry -90 90 -searchrz -90 90 -interp trilinear "
+	echo $cmd >> $log
+	$cmd >> $log 2>&1 
+	resample="flirt -ref standard -in @IN@ -out @OUT@ -applyxfm -init example_func2standard.mat -interp trilinear"
+fi
 
 # add transforms...
 cmd="convert_xfm -inverse -omat standard2highres.mat highres2standard.mat"
@@ -100,17 +134,30 @@ echo $cmd >> $log
 $cmd >> $log 2>&1 
 
 # register example_func to standard space
-cmd="flirt -ref standard -in example_func -out example_func2standard -applyxfm -init example_func2standard.mat -interp trilinear"
+cmd=${resample//@IN@/example_func}
+cmd=${cmd//@OUT@/example_func2standard}
 echo $cmd >> $log
 $cmd >> $log 2>&1 
 
 # register func to standard space
-cmd="flirt -ref standard -in func_data -out func_data2standard -applyxfm -init example_func2standard.mat -interp trilinear"
-echo $cmd >> $log
-$cmd >> $log 2>&1 
+if [ "$standard_outputs" == "full" ]; then
+	if [ $chunkvols -gt 0 ] && [ `fslval func_data dim4` -gt $chunkvols ]; then
+		echo "split_apply $chunkvols $njobs func_data func_data2standard $resample" >> $log
+		bash $scripts/split_apply $chunkvols $njobs func_data func_data2standard "$resample" >> $log 2>&1
+	else
+		cmd=${resample//@IN@/func_data}
+		cmd=${cmd//@OUT@/func_data2standard}
+		echo $cmd >> $log
+		$cmd >> $log 2>&1 
+	fi
+fi
 
 # register brain mask to standard space
-cmd="flirt -ref standard -in mask -out mask2standard -applyxfm -init highres2standard.mat -interp nearestneighbour"
+if [ "$warp" != "none" ]; then
+	cmd="applywarp -r standard -i mask -o mask2standard -w highres2standard_warp --rel --interp=nn"
+else
+	cmd="flirt -ref standard -in mask -out mask2standard -applyxfm -init highres2standard.mat -interp nearestneighbour"
+fi
 echo $cmd >> $log
 $cmd >> $log 2>&1 
 
@@ -3,10 +3,11 @@
 # run_snr
 #
 # SYNTAX
-#     run_snr $epi $t1w $wd
+#     run_snr $epi $wd $key [$template $templatemask]
 #
 # DESCRIPTION
-# run signal to noise ratio for functional images  
+# run signal to noise ratio for functional images (native space, the
+# 3D maps are resampled with the transform from the registration stage)
 
 # Amy Hegarty, Intermountain Neuroimaging Consortium
 # 09-03-2021
@@ -15,34 +16,39 @@
 
 # assign inputs
 epi_preproc=$1   							 # functional series for snr calculation
-epi_ref=${epi_preproc/bold/sbref}    	     # t1w image from bet (with skull)
-t1w_brain=$2     							 # t1w image from bet (skull stripped)
-wd=$3
+epi_ref=${epi_preproc/bold/sbref}    	     # brain extracted reference (native space)
+wd=$2
+key=$3           # working directory key (session, acquisition, task and run)
 
-# pull task and run name (assumes bids convention!)
+# pull subject name (assumes bids convention!)
 epiname=`basename $epi_preproc`
 subj=`echo ${epiname#*sub-} | cut -d"_" -f1`
-task=`echo ${epiname#*task-} | cut -d"_" -f1`
-run=`echo ${epiname#*run-} | cut -d"_" -f1`
 
 # setup
-mkdir -p $wd/snr/$task$run
-cd $wd/snr/$task$run
+mkdir -p $wd/snr/$key
+cd $wd/snr/$key
 
 log='snr.log'
 
 # create local links for epi and sbref
-epi=$task$run.nii.gz
+epi=$key.nii.gz
 ln -s $epi_preproc $epi
 
-sbref=${task}${run}_sbref.nii.gz
+sbref=${key}_sbref.nii.gz
 ln -s $epi_ref $sbref
 
-t1w=t1w.nii.gz
-ln -s $t1w_brain $t1w
+# nonlinear when registration used the brain extraction warp
+func2mni=$wd/reg/$key/example_func2standard.mat
+warp=none
+if [ -e $wd/reg/$key/highres2standard_warp.nii.gz ]; then
+    func2mni=$wd/reg/$key/example_func2highres.mat
+    warp=$wd/reg/$key/highres2standard_warp.nii.gz
+fi
+template=${4:-$FSLDIR/data/standard/MNI152_T1_2mm_brain.nii.gz}
+templatemask=${5:-$template}
 
 # run snr calculation....
 scripts=`dirname $0`
-cmd="$scripts/mb_snr_calc $subj $task $epi $sbref $t1w $t1w"
+cmd="$scripts/mb_snr_calc $subj $key $epi $sbref $func2mni $template $templatemask $warp"
 echo $cmd >> $log
 $cmd >> $log 2>&1
\ No newline at end of file
@@ -21,9 +21,12 @@
 #           Yarkoni, Tal, Markiewicz, Christopher J., de la Vega, Alejandro, Gorgolewski, Krzysztof J., Halchenko, Yaroslav O., Salo, Taylor, ? Blair, Ross. (2019, August 8). bids-standard/pybids: 0.9.3 (Version 0.9.3). Zenodo. http://doi.org/10.5281/zenodo.3363985
 #
 import os, sys, getopt, glob, bids, json, subprocess, multiprocessing, re, warnings
+import asyncio, copy, ctypes, ctypes.util, errno, fcntl, gzip, hashlib, http.server, select, shutil, signal, socket, socketserver, struct, tempfile, threading, time, traceback, types, zlib
 from subprocess import PIPE
 import numpy as np
 import pandas as pd
+import nibabel as nib
+from fmripreproc_client import default_socket
 
 # ------------------------------------------------------------------------------
 #  Show usage information for this script
@@ -48,11 +51,108 @@ def print_help():
           --outliers-dvars=           (In Development) generate indicator variables for dvars outliers
                                         above given threshold
           --run-qc                    add flag to run automated quality 
-                                        control for preprocessing
+                                        control for preprocessing (html report with
+                                        registration, motion and carpet plots)
           --run-aroma                 add flag to run aroma noise removal on 
                                         preprocessed images
           --run-fix (?)               add flag to run fsl-fix noise removal on 
                                         preprocessed images
+          --nprocs=                   (Default: unlimited) maximum number of concurrent jobs
+          --job-timeout=              (Default: none) kill any single job running longer than
+                                        this many seconds
+          --job-scratch=              (Default: <work-dir>/jobs) root of the private directories
+                                        that per-run jobs work in; outputs are moved into the
+                                        work dir when a job succeeds. Use node-local disk
+                                        (e.g. $TMPDIR) to keep temporary files off shared storage
+          --template-cache=           (Default: $TMPDIR/fmripreproc-templates) node-local directory
+                                        for uncompressed copies of the MNI templates and their
+                                        precomputed masks, built once per node and shared by
+                                        all jobs. The HCP 0.8mm templates are taken from
+                                        $HCPPIPEDIR_Templates when it is set
+          --queue                     coordinate with other instances through a work queue in
+                                        <outputs>/fmripreproc/queue. Every instance (on any node)
+                                        started with the same --in/--out pulls (subject, stage)
+                                        items until the queue is drained. --participant-label
+                                        may be a comma separated list (Default: all subjects)
+          --queue-stale=              (Default: 600) seconds without a heartbeat before a claimed
+                                        item is considered abandoned and reclaimed
+          --output-dtype=             (Default: float32) float32: publish 4D series as produced.
+                                        int16: publish 4D series as int16 with per-file
+                                        scl_slope/scl_inter (max quantization error reported in
+                                        the json sidecar)
+          --split-vols=               (Default: 0, off) run applytopup, motion correction
+                                        (against a common reference volume) and the standard
+                                        space resampling of long series in blocks of this many
+                                        volumes, in parallel, and merge them
+          --split-mem=                (Default: 4096) memory cap in MB for the parallel blocks
+                                        of one series
+          --status-interval=          (Default: 15) seconds between rewrites of <work-dir>/status.json
+                                        (jobs per stage, per job elapsed time and memory, node
+                                        cpu/memory, scratch disk use, time remaining). 0: off.
+                                        Queue workers write <outputs>/fmripreproc/queue/status/
+          --metrics-port=             (Default: off) also serve the status as prometheus metrics
+                                        on http://127.0.0.1:<port>/metrics
+          --crop-epi                  crop bold series (and sbref) to the brain bounding box
+                                        before motion correction; every later step runs on the
+                                        smaller grid, published images are restored to the
+                                        acquisition grid
+          --crop-pad=                 (Default: 4) voxels of padding around the brain box
+                                        (implies --crop-epi)
+          --check-bbr-cost=           (Default: 0.8) reject a run whose epi_reg bbr cost exceeds this
+          --check-max-translation=    (Default: 15) reject a run whose motion parameters exceed this
+                                        translation (mm) relative to the reference volume
+          --check-max-rotation=       (Default: 0.26) reject a run whose motion parameters exceed
+                                        this rotation (radians, ~15 degrees)
+          --stages=                   (Default: all) comma separated stages to run: bet, topup,
+                                        distcorrepi, preprocess, registration, snr, fast,
+                                        outliers, aroma-model, aroma-classify, report
+          --from-stage=               rerun this stage and every stage downstream of it
+          --force-stage=              comma separated stages to redo: their working and published
+                                        outputs and those of all downstream stages are removed
+                                        and rerun, upstream results (bet, topup, ...) are kept
+          --watch                     process the subject while its session is being converted:
+                                        watch <in>/sub-<id> and run the stages as soon as the
+                                        T1w, a fieldmap pair or a bold run (bold + json + sbref,
+                                        listed in a fieldmap IntendedFor) is complete
+          --watch-settle=             (Default: 30) seconds a file must stay unchanged to count
+                                        as complete
+          --watch-idle=               (Default: 3600) exit after this many seconds without new
+                                        inputs (0: never)
+          --standard-space=           (Default: full) full: publish 4D series resampled to MNI152.
+                                        lazy: publish native series + transforms only; resample
+                                        on demand with the resample command (below)
+
+    fMRI Preprocessing Pipeline: on demand standard space resampling
+        Usage: resample --bold=<space-native_desc-preproc_bold> [OPTIONS]
+        OPTIONS
+          --mask=                     standard space mask applied to the resampled series
+          --roi=                      standard space label image: write roi mean time series (tsv)
+                                        instead of a 4D image
+          --chunk=                    (Default: 50) volumes resampled per job
+          --nprocs=                   (Default: unlimited) maximum number of concurrent jobs
+
+    fMRI Preprocessing Pipeline: dataset metrics (confounds, motion, snr of every run)
+        Usage: metrics --out=<outputs> [OPTIONS]
+        OPTIONS
+          --table=                    (Default: summary, one row per run) confounds, motion, snr,
+                                        snr_slice: per volume / per slice rows of every run
+          --query=                    pandas query on the table, e.g. "fd_mean > 0.3"
+
+    fMRI Preprocessing Pipeline: daemon with a warm BIDS index
+        Usage: serve [--socket=<path>] [--max-requests=<n>] [--index-dir=<path>]
+               fmripreproc_client.py [--socket=<path>] <same arguments as above>
+        OPTIONS
+          --socket=                   (Default: $FMRIPREPROC_SOCKET or /tmp/fmripreproc-<uid>.sock)
+                                        unix socket the server listens on / the client connects to
+          --max-requests=             (Default: 4) requests run at the same time, more are held
+                                        until one finishes
+          --index-dir=                (Default: $FMRIPREPROC_INDEX or $TMPDIR/fmripreproc-index-<uid>)
+                                        pybids databases of the indexed datasets
+        The client streams the pipeline output and exits with its status; Ctrl-C
+        on the client cancels the request. The BIDS index of --in is kept open by
+        the daemon (and as a database in --index-dir) until files are added,
+        removed or renamed in the dataset; edits in place are picked up with the
+        next change to their directory.
     ** OpenMP used for parellelized execution of XXX. Multiple cores (CPUs) 
        are recommended (XX cpus for each fmri scan).
        
@@ -76,10 +176,31 @@ def parse_arguments(argv):
     runaroma = False
     runfix = False
     overwrite=False
-
+    nprocs = 0
+    jobtimeout = None
+    jobscratch = None
+    templatecache = None
+    queue = False
+    queuestale = 600
+    stdspace = 'full'
+    outdtype = 'float32'
+    splitvols = 0
+    splitmem = 4096
+    statusinterval = 15
+    metricsport = None
+    watch = False
+    watchsettle = 30
+    watchidle = 3600
+    croppad = 0
+    stages = []
+    fromstage = None
+    forcestages = []
+    checkbbrcost = CHECK_BBR_COST
+    checkmaxtrans = CHECK_MAX_TRANSLATION
+    checkmaxrot = CHECK_MAX_ROTATION
 
     try:
-      opts, args = getopt.getopt(argv,"hi:o:",["in=","out=","help","participant-label=","work-dir=","clean-work-dir=","trimvols","dummyscans=","outliers-fd=","outliers-dvars=","run-qc","run-aroma","run-fix"])
+      opts, args = getopt.getopt(argv,"hi:o:",["in=","out=","help","participant-label=","work-dir=","clean-work-dir=","trimvols","dummyscans=","outliers-fd=","outliers-dvars=","run-qc","run-aroma","run-fix","nprocs=","job-timeout=","job-scratch=","template-cache=","queue","queue-stale=","standard-space=","output-dtype=","split-vols=","split-mem=","status-interval=","metrics-port=","watch","watch-settle=","watch-idle=","crop-epi","crop-pad=","stages=","from-stage=","force-stage=","check-bbr-cost=","check-max-translation=","check-max-rotation="])
     except getopt.GetoptError:
       print_help()
       sys.exit(2)
@@ -113,6 +234,56 @@ def parse_arguments(argv):
         runaroma = True
       elif opt in ("--run-fix"):
         runfix = True                                         
+      elif opt in ("--nprocs"):
+        nprocs = int(arg)
+      elif opt in ("--job-timeout"):
+        jobtimeout = float(arg)
+      elif opt in ("--job-scratch"):
+        jobscratch = os.path.abspath(arg)
+      elif opt in ("--template-cache"):
+        templatecache = os.path.abspath(arg)
+      elif opt in ("--queue"):
+        queue = True
+      elif opt in ("--queue-stale"):
+        queuestale = float(arg)
+      elif opt in ("--standard-space"):
+        stdspace = arg
+        if stdspace not in ('full', 'lazy'):
+          raise Exception("--standard-space must be one of: full, lazy")
+      elif opt in ("--output-dtype"):
+        outdtype = arg
+        if outdtype not in ('float32', 'int16'):
+          raise Exception("--output-dtype must be one of: float32, int16")
+      elif opt in ("--split-vols"):
+        splitvols = int(arg)
+      elif opt in ("--split-mem"):
+        splitmem = float(arg)
+      elif opt in ("--status-interval"):
+        statusinterval = float(arg)
+      elif opt in ("--metrics-port"):
+        metricsport = int(arg)
+      elif opt in ("--watch"):
+        watch = True
+      elif opt in ("--watch-settle"):
+        watchsettle = float(arg)
+      elif opt in ("--watch-idle"):
+        watchidle = float(arg)
+      elif opt in ("--crop-epi"):
+        croppad = croppad or 4
+      elif opt in ("--crop-pad"):
+        croppad = int(arg)
+      elif opt in ("--stages"):
+        stages = arg.split(',')
+      elif opt in ("--from-stage"):
+        fromstage = arg
+      elif opt in ("--force-stage"):
+        forcestages = arg.split(',')
+      elif opt in ("--check-bbr-cost"):
+        checkbbrcost = float(arg)
+      elif opt in ("--check-max-translation"):
+        checkmaxtrans = float(arg)
+      elif opt in ("--check-max-rotation"):
+        checkmaxrot = float(arg)
     if 'inputs' not in locals():
       print_help()
       raise Exception("Missing required argument --in=")
@@ -121,13 +292,35 @@ def parse_arguments(argv):
       print_help()
       raise Exception("Missing required argument --out=")
       sys.exit()
-    if 'pid' not in locals():
+    if 'pid' not in locals() and not queue:
       print_help()
       raise Exception("Missing required argument --participant-label=")
       sys.exit()
+    elif 'pid' not in locals():
+      pid = None   # queue mode: all subjects in the bids directory
+    if watch and queue:
+      raise Exception("--watch processes one subject, it cannot be combined with --queue")
+
+    # stage selection: forced stages and everything downstream of them are invalidated and rerun
+    for name in stages + forcestages + ([fromstage] if fromstage else []):
+      if name not in [s[0] for s in STAGES]:
+        raise Exception("Unknown stage: " + name + " (stages: " + ', '.join(s[0] for s in STAGES) + ")")
+    forced = downstream_stages(forcestages + ([fromstage] if fromstage else []))
+    if stages:
+      selected = set(stages) | forced
+    elif fromstage:
+      selected = forced
+    else:
+      selected = None
+    if forced and queue:
+      raise Exception("--force-stage/--from-stage invalidate working directories; run them without --queue")
       
 
-    if not "wd" in locals():
+    # queue mode: one working directory per subject, under --work-dir if given
+    wdbase = wd if "wd" in locals() else None
+    if queue:
+      wd = None
+    elif not "wd" in locals():
       wd=outputs + "/fmripreproc/scratch/sub-" + pid
 
     print('Input Bids directory:\t', inputs)
@@ -136,7 +329,7 @@ def parse_arguments(argv):
     print('Participant:\t\t', str(pid))
 
     class args:
-      def __init__(self, wd, inputs, outputs, pid, qc, cleandir, trimvols, runaroma, runfix):
+      def __init__(self, wd, inputs, outputs, pid, qc, cleandir, trimvols, runaroma, runfix, nprocs, jobtimeout, jobscratch, templatecache, queue, queuestale, wdbase, stdspace, outdtype, splitvols, splitmem, statusinterval, metricsport, watch, watchsettle, watchidle, croppad, selected, forced, checkbbrcost, checkmaxtrans, checkmaxrot):
         self.wd = wd
         self.inputs = inputs
         self.outputs = outputs
@@ -149,27 +342,88 @@ def parse_arguments(argv):
         dirname = os.path.dirname(os.path.abspath(__file__))
         self.templates=dirname + '/fmripreproc_code'
         self.overwrite=False
-
-    entry = args(wd, inputs, outputs, pid, qc, cleandir, trimvols, runaroma, runfix)
+        self.nprocs=nprocs
+        self.jobtimeout=jobtimeout
+        self.jobscratch=jobscratch
+        self.templatecache=templatecache
+        self.queue=queue
+        self.queuestale=queuestale
+        self.wdbase=wdbase
+        self.stdspace=stdspace
+        self.outdtype=outdtype
+        self.splitvols=splitvols
+        self.splitmem=splitmem
+        self.statusinterval=statusinterval
+        self.metricsport=metricsport
+        self.watch=watch
+        self.watchsettle=watchsettle
+        self.watchidle=watchidle
+        self.croppad=croppad
+        self.stages=selected
+        self.forcestages=forced
+        self.checkbbrcost=checkbbrcost
+        self.checkmaxtrans=checkmaxtrans
+        self.checkmaxrot=checkmaxrot
+        self.monitor=None
+        self.failedjobs=[]
+        self.jobresults={}
+        self.currentstage=None
+
+    entry = args(wd, inputs, outputs, pid, qc, cleandir, trimvols, runaroma, runfix, nprocs, jobtimeout, jobscratch, templatecache, queue, queuestale, wdbase, stdspace, outdtype, splitvols, splitmem, statusinterval, metricsport, watch, watchsettle, watchidle, croppad, selected, forced, checkbbrcost, checkmaxtrans, checkmaxrot)
 
     return entry
 
 # ------------------------------------------------------------------------------
 #  Parse Bids inputs for this script
 # ------------------------------------------------------------------------------
-def bids_data(entry):
+def write_json(filename,data):
+  # atomic replace: readers (and other instances) never see a partial file
+  tmp = filename + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.tmp'
+  with open(tmp, 'w') as outfile:
+    json.dump(data, outfile, indent=2)
+  os.replace(tmp, filename)
+
+def input_hash(files,version,*extra):
+  """Cheap content key for a set of input files (path, size and mtime).
+
+  version is the salt of the cache using the key; bumping it invalidates that
+  cache only.
+  """
+  h = hashlib.sha1(str(version).encode())
+  for f in files:
+    h.update(f.encode())
+    if os.path.exists(f):
+      st = os.stat(f)
+      h.update(str(st.st_size).encode() + b':' + str(st.st_mtime_ns).encode())
+  for x in extra:
+    h.update(str(x).encode())
+  return h.hexdigest()
+
+def add_derivatives(layout,entry):
+  # (re-)index fmripreproc derivatives so later stages see newly saved outputs
+  root = os.path.abspath(entry.outputs + '/fmripreproc')
+  for name, deriv in list(layout.derivatives.items()):
+    if os.path.abspath(str(deriv.root)) == root:
+      del layout.derivatives[name]
+  layout.add_derivatives(entry.outputs + '/fmripreproc/')
+
+def bids_data(entry,layout=None,ignore=None):
+    # layout: an already indexed layout of entry.inputs (serve mode)
+    # ignore: extra files left out of the index (watch mode: inputs still arriving)
 
     bids.config.set_option('extension_initial_dot', True)
 
-    layout = bids.BIDSLayout(entry.inputs, derivatives=False, absolute_paths=True)
+    if layout is None and ignore:
+      layout = bids.BIDSLayout(entry.inputs, derivatives=False, absolute_paths=True,
+                               ignore=["code", "stimuli", "sourcedata", "models", re.compile(r'^\.')] + sorted(ignore))
+    elif layout is None:
+      layout = bids.BIDSLayout(entry.inputs, derivatives=False, absolute_paths=True)
 
-    if not os.path.exists(entry.outputs + '/fmripreproc') or os.path.exists(entry.outputs + '/fmripreproc/' + 'dataset_description.json'):
-      os.makedirs(entry.outputs,mode=511,exist_ok=True)
-      os.makedirs(entry.outputs + '/fmripreproc', mode=511,exist_ok=True)
+    os.makedirs(entry.outputs + '/fmripreproc', mode=511,exist_ok=True)
 
-      # make dataset_description file...
-      import json
+    if not os.path.exists(entry.outputs + '/fmripreproc/' + 'dataset_description.json'):
 
+      # make dataset_description file...
       data = {
         'Name': 'FSL fMRI Minimal Preprocessing',
         "BIDSVersion": "1.1.1",
@@ -181,8 +435,8 @@ def bids_data(entry):
         "CodeURL": "https://github.com/intermountainneuroimaging/fmri-preproc.git",
         "HowToAcknowledge": "Please cite all relevant works for FSL tools: bet, topup, mcflirt, aroma and python tools: pybids ( https://doi.org/10.21105/joss.01294,  https://doi.org/10.21105/joss.01294)"}
 
-      with open(entry.outputs + '/fmripreproc/' + 'dataset_description.json', 'w') as outfile:
-          json.dump(data, outfile, indent=2)
+      # several instances may get here at once: write privately, then rename into place
+      write_json(entry.outputs + '/fmripreproc/' + 'dataset_description.json', data)
 
     return layout
 
@@ -190,14 +444,522 @@ def bids_data(entry):
 #  Main Pipeline Starts Here...
 # ------------------------------------------------------------------------------
 
-def worker(name,cmdfile):
-    """Executes the bash script"""
+# ------------------------------------------------------------------------------
+#  Job execution (asyncio subprocesses, one thread for all children)
+# ------------------------------------------------------------------------------
 
-    process = subprocess.Popen(cmdfile.split(), stdout=PIPE, stderr=PIPE, universal_newlines=True)
-    output, error = process.communicate()
-    print(error)
-    print('Worker: ' + name + ' finished')
-    return
+class Job:
+  """A shell command run by run_jobs.
+
+  Jobs listed in `after` must finish successfully first; if any of them fails,
+  times out or is cancelled, this job (and its own dependents) is cancelled.
+  `after` may name jobs of an earlier run_jobs call (an earlier stage); jobs
+  that did not run at all (outputs already present) count as finished.
+  A job with `outputs` (directories relative to the working directory) runs
+  in a private scratch directory (JobScratch).
+  """
+  def __init__(self, name, cmd, after=None, timeout=None, outputs=None):
+    self.name = name
+    self.cmd = cmd
+    self.after = after or []
+    self.timeout = timeout
+    self.outputs = outputs or []
+    self.stage = None         # set by the status monitor
+    self.log = None
+    self.status = 'queued'    # queued, running, done, failed, timeout, cancelled
+    self.returncode = None
+    self.pid = None
+    self.start = None
+    self.end = None
+
+async def kill_job(proc,grace=10):
+  # terminate the job's whole process group (bash script + fsl children)
+  try:
+    os.killpg(proc.pid, signal.SIGTERM)
+    await asyncio.wait_for(proc.wait(), grace)
+  except ProcessLookupError:
+    pass
+  except asyncio.TimeoutError:
+    try:
+      os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+      pass
+
+class JobScratch:
+  """Private working directory of a job with declared output directories.
+
+  <root>/<job name> mirrors the working directory: the output directories (and
+  their parents) are real, initially empty directories, every other entry of
+  the working directory is a link to the shared one. Paths below the working
+  directory in the command are redirected to the private copy; those inside
+  the output directories are linked to the shared files first.
+
+  When the job succeeds, everything it created in the output directories is
+  moved into the working directory (rename, or copy and rename across file
+  systems), so other jobs never see partly written files. Script logs (*.log)
+  are also copied into the job log, and appended to (rather than replacing) a
+  log of the same name already in the working directory.
+  """
+  def __init__(self, wd, root, name, outputs):
+    self.wd = wd
+    self.shared = os.path.abspath(wd)
+    self.root = os.path.abspath(root)
+    self.path = self.root + '/' + name
+    self.outputs = [o.strip('/') for o in outputs]
+    self.links = set()
+
+  def private(self, rel):
+    return self.path + ('/' + rel if rel else '')
+
+  def link(self, rel):
+    os.makedirs(os.path.dirname(self.private(rel)), exist_ok=True)
+    os.symlink(self.shared + '/' + rel, self.private(rel))
+    self.links.add(rel)
+
+  def setup(self):
+    shutil.rmtree(self.path, ignore_errors=True)
+    os.makedirs(self.path)
+    dirs = set()
+    for out in self.outputs:
+      parts = out.split('/')
+      dirs.update('/'.join(parts[:i]) for i in range(1, len(parts) + 1))
+      os.makedirs(self.shared + '/' + out, exist_ok=True)
+      os.makedirs(self.private(out), exist_ok=True)
+    for name in os.listdir(self.shared):
+      if name not in dirs and self.shared + '/' + name != self.root:
+        self.link(name)
+
+  def command(self, cmd):
+    # redirect working directory paths, linking the inputs read from output directories
+    args = []
+    for arg in cmd.split():
+      for prefix in (self.wd, self.shared):
+        if arg == prefix or arg.startswith(prefix + '/'):
+          rel = arg[len(prefix):].strip('/')
+          if any(rel.startswith(out + '/') for out in self.outputs) and os.path.lexists(self.shared + '/' + rel) \
+             and not os.path.lexists(self.private(rel)):
+            self.link(rel)
+          arg = self.private(rel)
+          break
+      args.append(arg)
+    return ' '.join(args)
+
+  def logs(self):
+    for out in self.outputs:
+      for root, dirs, files in os.walk(self.private(out)):
+        for name in sorted(files):
+          if name.endswith('.log') and not os.path.islink(root + '/' + name):
+            yield root + '/' + name
+
+  def move(self, src, dst):
+    tmp = os.path.dirname(dst) + '/.' + os.path.basename(dst) + '.' + str(os.getpid()) + '.tmp'
+    if os.path.islink(src):
+      target = os.readlink(src)
+      if target == self.path or target.startswith(self.path + '/'):
+        target = self.shared + target[len(self.path):]
+      os.symlink(target, tmp)
+      os.replace(tmp, dst)
+      return
+    try:
+      os.replace(src, dst)
+    except OSError as e:
+      if e.errno != errno.EXDEV:
+        raise
+      if os.path.isdir(src):
+        shutil.copytree(src, tmp, symlinks=True)
+      else:
+        shutil.copy2(src, tmp)
+      os.replace(tmp, dst)
+
+  def promote(self, rel=None):
+    for out in ([rel] if rel else self.outputs):
+      for name in os.listdir(self.private(out)):
+        child = out + '/' + name
+        src, dst = self.private(child), self.shared + '/' + child
+        if child in self.links:
+          continue
+        if os.path.isdir(src) and not os.path.islink(src) and os.path.isdir(dst):
+          self.promote(child)
+        elif name.endswith('.log') and not os.path.islink(src) and os.path.isfile(dst):
+          with open(dst, 'ab') as log, open(src, 'rb') as new:
+            fcntl.lockf(log, fcntl.LOCK_EX)
+            shutil.copyfileobj(new, log)
+        else:
+          self.move(src, dst)
+
+  def remove(self):
+    shutil.rmtree(self.path, ignore_errors=True)
+
+def job_scratch(entry):
+  # root of the private job directories of entry.pid
+  if getattr(entry, 'jobscratch', None):
+    return entry.jobscratch + '/sub-' + entry.pid
+  return entry.wd + '/jobs'
+
+async def run_job(job,done,limit,logdir,wd=None,scratch=None):
+  """Runs one job once its dependencies succeed, streaming output to its log"""
+
+  for dep in job.after:
+    if not await done[dep]:
+      job.status = 'cancelled'
+      print('Job: ' + job.name + ' cancelled (dependency ' + dep + ' did not finish)')
+      return False
+
+  async with limit:
+    job.log = logdir + '/' + job.name + '.log'
+    job.status = 'running'
+    job.start = time.time()
+    private = None
+    cmd = job.cmd
+    if job.outputs and scratch:
+      private = JobScratch(wd, scratch, job.name, job.outputs)
+      private.setup()
+      cmd = private.command(cmd)
+    with open(job.log, 'ab') as log:
+      log.write(('$ ' + cmd + '\n').encode())
+      log.flush()
+      proc = await asyncio.create_subprocess_exec(*cmd.split(), stdout=asyncio.subprocess.PIPE,
+                                                  stderr=asyncio.subprocess.STDOUT, start_new_session=True)
+      job.pid = proc.pid
+      print('Job: ' + job.name + ' started (pid ' + str(proc.pid) + ')')
+
+      async def stream():
+        # chunks, not lines: tools may print lines of any length
+        while True:
+          data = await proc.stdout.read(2**16)
+          if not data:
+            break
+          log.write(data)
+          log.flush()
+        return await proc.wait()
+
+      try:
+        job.returncode = await asyncio.wait_for(stream(), job.timeout)
+      except asyncio.TimeoutError:
+        await kill_job(proc)
+        job.status = 'timeout'
+      except asyncio.CancelledError:
+        await kill_job(proc)
+        job.status = 'cancelled'
+        if private:
+          private.remove()
+        raise
+      finally:
+        job.end = time.time()
+
+      if private:
+        for f in private.logs():
+          log.write(('\n==> ' + os.path.relpath(f, private.path) + ' <==\n').encode())
+          with open(f, 'rb') as flog:
+            shutil.copyfileobj(flog, log)
+        if job.status == 'running' and job.returncode == 0:
+          private.promote()
+        private.remove()
+
+  if job.status == 'running':
+    job.status = 'done' if job.returncode == 0 else 'failed'
+  print('Job: ' + job.name + ' ' + job.status + ' (' + str(round(job.end - job.start)) + 's, log: ' + job.log + ')')
+  return job.status == 'done'
+
+async def run_job_graph(jobs,entry):
+  loop = asyncio.get_event_loop()
+  done = {job.name: loop.create_future() for job in jobs}
+  for dep in set(d for job in jobs for d in job.after) - set(done):
+    # dependency from an earlier run_jobs call: resolved by its recorded result
+    done[dep] = loop.create_future()
+    done[dep].set_result(entry.jobresults.get(dep, 'done') == 'done')
+  limit = asyncio.Semaphore(entry.nprocs if entry.nprocs else len(jobs) or 1)
+  logdir = entry.wd + '/logs'
+  os.makedirs(logdir, exist_ok=True)
+
+  scratch = job_scratch(entry) if any(job.outputs for job in jobs) else None
+
+  async def run(job):
+    ok = False
+    try:
+      ok = await run_job(job, done, limit, logdir, entry.wd, scratch)
+    finally:
+      if not done[job.name].done():
+        done[job.name].set_result(ok)
+    return ok
+
+  return await asyncio.gather(*[run(job) for job in jobs])
+
+def run_jobs(jobs,entry):
+  """Runs a list of jobs concurrently and blocks until they are all finished.
+
+  Returns True if every job succeeded. On Ctrl-C all running jobs (and their
+  child processes) are killed before KeyboardInterrupt is re-raised.
+  """
+  if not jobs:
+    return True
+
+  for job in jobs:
+    if job.timeout is None:
+      job.timeout = entry.jobtimeout
+  if entry.monitor:
+    entry.monitor.add_jobs(jobs)
+
+  loop = asyncio.new_event_loop()
+  main = loop.create_task(run_job_graph(jobs, entry))
+  try:
+    results = loop.run_until_complete(main)
+  except KeyboardInterrupt:
+    print('\nInterrupted: cancelling running jobs...')
+    main.cancel()
+    try:
+      loop.run_until_complete(main)
+    except (asyncio.CancelledError, KeyboardInterrupt):
+      pass
+    raise
+  finally:
+    loop.close()
+
+  entry.jobresults.update((job.name, job.status) for job in jobs)
+  failed = [job for job in jobs if job.status != 'done']
+  for job in failed:
+    print('Job: ' + job.name + ' ' + job.status + ', see ' + str(job.log))
+  entry.failedjobs += [job.name for job in failed]
+  return not failed
+
+# ------------------------------------------------------------------------------
+#  Live status: <wd>/status.json and an optional prometheus text endpoint
+# ------------------------------------------------------------------------------
+
+def proc_usage():
+  """{process group: [rss bytes, cpu seconds]} for every process in /proc"""
+  usage = {}
+  page = os.sysconf('SC_PAGE_SIZE')
+  tick = os.sysconf('SC_CLK_TCK')
+  for pid in os.listdir('/proc'):
+    if not pid.isdigit():
+      continue
+    try:
+      with open('/proc/' + pid + '/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+      continue
+    # fields[0] is field 3 (state) of proc(5): pgrp, utime, stime, rss
+    group = usage.setdefault(int(fields[2]), [0, 0.0])
+    group[0] += int(fields[21]) * page
+    group[1] += (int(fields[11]) + int(fields[12])) / tick
+  return usage
+
+def node_usage(prev=None):
+  """(cpu utilisation since prev, cpu counters, memory total/available bytes)"""
+  with open('/proc/stat') as f:
+    cpu = [int(x) for x in f.readline().split()[1:]]
+  util = None
+  if prev:
+    total = sum(cpu) - sum(prev)
+    idle = cpu[3] + cpu[4] - prev[3] - prev[4]   # idle + iowait
+    util = round(1 - idle / total, 3) if total else 0.0
+  mem = {}
+  with open('/proc/meminfo') as f:
+    for line in f:
+      key, value = line.split(':')
+      mem[key] = int(value.split()[0]) * 1024
+  return util, cpu, {'total': mem['MemTotal'], 'available': mem.get('MemAvailable', mem['MemFree'])}
+
+DU_INTERVAL = 600   # seconds between walks of the work directory (metadata heavy on shared storage)
+
+def du(path):
+  size = 0
+  for root, dirs, files in os.walk(path):
+    for name in files:
+      try:
+        size += os.lstat(os.path.join(root, name)).st_size
+      except OSError:
+        pass
+  return size
+
+class StatusMonitor:
+  """Samples the pipeline every `interval` seconds and rewrites a status json.
+
+  Jobs are registered by run_jobs, stages by run_stage. Stage wall times are
+  kept in <outputs>/fmripreproc/stage_durations.json (running average over
+  subjects) to estimate the time remaining. Free space comes from statvfs on
+  every sample, the size of the work directory is refreshed every DU_INTERVAL.
+  """
+  def __init__(self, entry, path, scratch, interval=15, port=None):
+    self.path = path
+    self.scratch = scratch
+    self.interval = interval
+    self.port = port
+    self.stages = stage_names(entry)
+    self.history = entry.outputs + '/fmripreproc/stage_durations.json'
+    self.jobs = []
+    self.subject = entry.pid
+    self.stage = None
+    self.stagestart = None
+    self.stagejobs = 0
+    self.finished = []
+    self.cpu = None
+    self.used = None
+    self.usedtime = 0
+    self.status = {}
+    self.lock = threading.Lock()
+    self.stop = threading.Event()
+
+  def add_jobs(self, jobs):
+    with self.lock:
+      for job in jobs:
+        job.stage = self.stage
+      self.jobs += jobs
+      self.stagejobs += len(jobs)
+
+  def begin_stage(self, subject, stage):
+    with self.lock:
+      if subject != self.subject:
+        self.finished = []
+      self.subject, self.stage, self.stagestart, self.stagejobs = subject, stage, time.time(), 0
+
+  def end_stage(self, ok):
+    with self.lock:
+      self.finished.append(self.stage)
+      if not self.stagejobs or not ok:
+        return   # skipped (already complete) or failed: not a useful duration
+      elapsed = time.time() - self.stagestart
+      stage = self.stage
+    with FileLock(self.history + '.lock'):
+      history = self.durations()
+      history[stage] = round(0.7 * history[stage] + 0.3 * elapsed if stage in history else elapsed, 1)
+      write_json(self.history, history)
+
+  def durations(self):
+    try:
+      with open(self.history) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return {}
+
+  def eta(self, now):
+    # remaining time of the current stage + typical time of the stages not started yet
+    history = self.durations()
+    todo = [s for s in self.stages if s not in self.finished and s != self.stage]
+    eta = sum(history.get(s, 0) for s in todo)
+    complete = all(s in history for s in todo)
+    if self.stage:
+      done = [j.end - j.start for j in self.jobs if j.stage == self.stage and j.status == 'done']
+      running = [now - j.start for j in self.jobs if j.stage == self.stage and j.status == 'running']
+      if self.stage in history:
+        eta += max(history[self.stage] - (now - self.stagestart), 0)
+      elif done and running:
+        eta += max(max(sum(done) / len(done) - r, 0) for r in running)
+      else:
+        complete = False
+    return round(eta), complete
+
+  def sample(self):
+    now = time.time()
+    try:
+      usage = proc_usage()
+      util, self.cpu, mem = node_usage(self.cpu)
+    except OSError:
+      usage, util, mem = {}, None, None    # no /proc (not linux)
+    with self.lock:
+      stages = {}
+      jobs = []
+      for job in self.jobs:
+        counts = stages.setdefault(job.stage or 'other', {'queued': 0, 'running': 0, 'done': 0, 'failed': 0, 'timeout': 0, 'cancelled': 0})
+        counts[job.status] += 1
+        info = {'name': job.name, 'stage': job.stage, 'status': job.status, 'pid': job.pid, 'log': job.log}
+        if job.start:
+          info['elapsed'] = round((job.end or now) - job.start, 1)
+        if job.status == 'running' and job.pid in usage:
+          info['rss'], info['cpu_seconds'] = usage[job.pid][0], round(usage[job.pid][1], 1)
+        jobs.append(info)
+      eta, complete = self.eta(now)
+    disk = shutil.disk_usage(self.scratch) if os.path.exists(self.scratch) else None
+    if disk and now - self.usedtime >= max(DU_INTERVAL, self.interval):
+      self.used, self.usedtime = du(self.scratch), now
+    return {'time': now, 'host': socket.gethostname(), 'pid': os.getpid(),
+            'subject': self.subject, 'stage': self.stage, 'stages_finished': list(self.finished),
+            'jobs_by_stage': stages, 'jobs': jobs,
+            'node': {'cpus': os.cpu_count(), 'cpu_utilization': util, 'load': os.getloadavg(),
+                     'memory_total': mem and mem['total'], 'memory_available': mem and mem['available']},
+            'scratch': {'path': self.scratch, 'used': self.used if disk else None,
+                        'free': disk and disk.free, 'total': disk and disk.total},
+            'eta_seconds': eta, 'eta_complete': complete}
+
+  def metrics(self):
+    st = self.status
+    lines = []
+    def add(name, value, **labels):
+      if value is not None:
+        lab = ','.join(k + '="' + str(v) + '"' for k, v in labels.items())
+        lines.append('fmripreproc_' + name + ('{' + lab + '}' if lab else '') + ' ' + str(value))
+    for stage, counts in st.get('jobs_by_stage', {}).items():
+      for status, n in counts.items():
+        add('jobs', n, stage=stage, status=status)
+    for job in st.get('jobs', []):
+      if job['status'] == 'running':
+        add('job_elapsed_seconds', job.get('elapsed'), job=job['name'], stage=job['stage'])
+        add('job_rss_bytes', job.get('rss'), job=job['name'], stage=job['stage'])
+        add('job_cpu_seconds_total', job.get('cpu_seconds'), job=job['name'], stage=job['stage'])
+    node = st.get('node', {})
+    add('node_cpu_utilization', node.get('cpu_utilization'))
+    add('node_memory_total_bytes', node.get('memory_total'))
+    add('node_memory_available_bytes', node.get('memory_available'))
+    scratch = st.get('scratch', {})
+    add('scratch_used_bytes', scratch.get('used'))
+    add('scratch_free_bytes', scratch.get('free'))
+    add('eta_seconds', st.get('eta_seconds'), subject=st.get('subject'))
+    return '\n'.join(lines) + '\n'
+
+  def update(self):
+    self.status = self.sample()
+    write_json(self.path, self.status)
+
+  def serve(self):
+    monitor = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path == '/status.json':
+          body, ctype = json.dumps(monitor.status, indent=2), 'application/json'
+        else:
+          body, ctype = monitor.metrics(), 'text/plain; version=0.0.4'
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+      def log_message(self, *args):
+        pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Metrics: http://127.0.0.1:' + str(server.server_address[1]) + '/metrics')
+    return server
+
+  def start(self):
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    self.update()
+    self.server = self.serve() if self.port else None
+
+    def loop():
+      while not self.stop.wait(self.interval):
+        try:
+          self.update()
+        except Exception as e:
+          print('Status: ' + str(e))
+
+    threading.Thread(target=loop, daemon=True).start()
+    print('Status: ' + self.path)
+    return self
+
+  def close(self):
+    self.stop.set()
+    self.update()
+    if self.server:
+      self.server.shutdown()
+      self.server.server_close()
+
+def start_monitor(entry,path,scratch):
+  if entry.statusinterval > 0:
+    entry.monitor = StatusMonitor(entry, path, scratch, entry.statusinterval, entry.metricsport).start()
+  return entry.monitor
 
 def writelist(filename,outlist):
   textfile = open(filename, "w")
@@ -213,6 +975,165 @@ def checkfile_string(filename,txt):
             return True # The string is found
     return False  # The string does not exist in the file
 
+def run_key(ent):
+  """Working directory key for a functional run.
+
+  task + run (e.g. rest01), prefixed by session and acquisition where present
+  (e.g. ses-2_acq-mb_rest01) so runs from different sessions never collide.
+  """
+  key = ent['task'] + (str(ent['run']).zfill(2) if 'run' in ent else '')
+  if ent.get('acquisition'):
+    key = 'acq-' + ent['acquisition'] + '_' + key
+  if ent.get('session'):
+    key = 'ses-' + ent['session'] + '_' + key
+  return key
+
+def session_inputs(layout,entry):
+  """Resolves the fieldmap pairs of every session (once per layout).
+
+  Returns {session: {'fmaps': [{'dir', 'ap', 'pa'}, ...]}} where the session key is
+  None for datasets without sessions. The anatomy is resolved per subject
+  (subject_t1w): all sessions register to the same T1w.
+  """
+  cache = getattr(entry, 'sessioncache', None)
+  if cache and cache[0] is layout:
+    return cache[1]
+
+  sessions = {}
+  for ses in layout.get_sessions(subject=entry.pid) or [None]:
+    filt = {'session': ses} if ses else {}
+
+    # fieldmaps are paired by acquisition + run within a session
+    groups = {}
+    for fmap in layout.get(subject=entry.pid, extension='nii.gz', suffix='epi', scope='raw', **filt):
+      ent = fmap.get_entities()
+      groups.setdefault((ent.get('acquisition'), ent.get('run')), []).append(fmap)
+
+    fmaps = []
+    for (acq, run), files in sorted(groups.items(), key=lambda g: str(g[0])):
+      ap = [f for f in files if 'AP' in f.get_entities()['direction']]
+      pa = [f for f in files if 'PA' in f.get_entities()['direction']]
+      if len(ap) != 1 or len(pa) != 1:
+        raise Exception("Topup cannot be run...unbalanced or missing AP/PA fieldmaps: " + ', '.join(f.filename for f in files))
+      name = 'topup-' + ('ses-' + ses + '_' if ses else '') + ('acq-' + acq + '_' if acq else '') + (str(run).zfill(2) if run else '01')
+      fmaps.append({'dir': name, 'ap': ap[0], 'pa': pa[0]})
+
+    sessions[ses] = {'fmaps': fmaps}
+
+  entry.sessioncache = (layout, sessions)
+  return sessions
+
+def subject_t1w(layout,entry):
+  # anatomical image for the subject (first T1w in the raw dataset)
+  t1w=layout.get(subject=entry.pid, extension='nii.gz', suffix='T1w', scope='raw')
+  if not t1w:
+    raise Exception("No T1w image found for subject: " + entry.pid)
+  return t1w[0]
+
+def split_params(imgpath,entry,resampled=None):
+  """Block size and parallel blocks for volume-wise tools (--split-vols / --split-mem).
+
+  Returns (0, 0) when splitting is off or the series is short. The number of blocks
+  run at once is capped so that their estimated memory (input block + float output
+  block, on the output grid if `resampled` is given) stays within --split-mem.
+  """
+  if not entry.splitvols:
+    return 0, 0
+  img = nib.load(imgpath)
+  nvols = img.shape[3] if len(img.shape) > 3 else 1
+  if nvols <= entry.splitvols:
+    return 0, 0
+  nin = np.prod(img.shape[:3])
+  nout = np.prod(nib.load(resampled).shape[:3]) if resampled else nin
+  blockmb = entry.splitvols * (nin + nout) * 4 / 2**20
+  nblocks = int(np.ceil(nvols / entry.splitvols))
+  njobs = max(1, min(nblocks, os.cpu_count() or 1, int(entry.splitmem // max(blockmb, 1))))
+  return entry.splitvols, njobs
+
+# ------------------------------------------------------------------------------
+#  Template assets: node-local, uncompressed copies of the reference images
+# ------------------------------------------------------------------------------
+
+HCP_TEMPLATES = os.environ.get('HCPPIPEDIR_Templates')   # unset: t1_fnirt_bet2 uses its own 0.8mm templates
+
+TEMPLATE_CACHE_VERSION = "1"   # bump to rebuild the template caches
+
+# name: (root, file) of the source image. Missing sources are used from their own
+# location, sources under an unset root are left to the scripts' defaults
+TEMPLATE_SOURCES = {
+  'MNI152_T1_2mm': ('fsl', 'MNI152_T1_2mm.nii.gz'),
+  'MNI152_T1_2mm_brain': ('fsl', 'MNI152_T1_2mm_brain.nii.gz'),
+  'MNI152_T1_2mm_brain_mask': ('fsl', 'MNI152_T1_2mm_brain_mask.nii.gz'),
+  'MNI152_T1_2mm_brain_mask_dil': ('fsl', 'MNI152_T1_2mm_brain_mask_dil.nii.gz'),
+  'MNI152_T1_1mm': ('fsl', 'MNI152_T1_1mm.nii.gz'),
+  'MNI152_T1_1mm_brain_mask': ('fsl', 'MNI152_T1_1mm_brain_mask.nii.gz'),
+  'MNI152_T1_0.8mm': ('hcp', 'MNI152_T1_0.8mm.nii.gz'),
+  'MNI152_T1_0.8mm_brain_mask': ('hcp', 'MNI152_T1_0.8mm_brain_mask.nii.gz'),
+}
+
+def template_source(name):
+  root, filename = TEMPLATE_SOURCES[name]
+  roots = {'fsl': os.environ.get('FSLDIR') and os.environ['FSLDIR'] + '/data/standard', 'hcp': HCP_TEMPLATES}
+  return roots[root] and roots[root] + '/' + filename
+
+def dilate(mask):
+  # one voxel dilation (26 neighbours) of a boolean 3D mask
+  padded = np.pad(mask, 1)
+  out = np.zeros_like(mask)
+  nx, ny, nz = mask.shape
+  for dx in range(3):
+    for dy in range(3):
+      for dz in range(3):
+        out |= padded[dx:dx + nx, dy:dy + ny, dz:dz + nz]
+  return out
+
+def template_assets(entry):
+  """{name: path} of the cached templates, built on first use.
+
+  The cache lives in --template-cache (node-local by default), one directory per
+  set of sources (keyed on path, size and mtime), and is built once under a lock
+  by whichever process gets there first. Besides the uncompressed copies it
+  holds MNI152_T1_2mm_brain_bin (binary template brain, used to mask standard
+  space maps) and MNI152_T1_2mm_brain_mask_dil when FSL does not provide it.
+  """
+  if getattr(entry, 'assets', None):
+    return entry.assets
+
+  sources = {name: template_source(name) for name in TEMPLATE_SOURCES if template_source(name)}
+  present = {name: src for name, src in sources.items() if os.path.exists(src)}
+  root = getattr(entry, 'templatecache', None) or os.environ.get('TMPDIR', '/tmp') + '/fmripreproc-templates'
+  cache = root + '/' + input_hash(sorted(present.values()), TEMPLATE_CACHE_VERSION)[:12]
+  os.makedirs(root, exist_ok=True)
+
+  with FileLock(cache + '.lock'):
+    if not os.path.exists(cache + '/templates.json'):
+      print('Building template cache: ' + cache)
+      os.makedirs(cache, exist_ok=True)
+      def save(img, name):
+        tmp = cache + '/.' + name + '.' + str(os.getpid()) + '.nii'
+        nib.save(img, tmp)
+        os.replace(tmp, cache + '/' + name + '.nii')
+      imgs = {}
+      for name, src in present.items():
+        imgs[name] = nib.load(src)
+        save(nib.Nifti1Image(np.asanyarray(imgs[name].dataobj), imgs[name].affine, imgs[name].header), name)
+      if 'MNI152_T1_2mm_brain' in imgs:
+        brain = imgs['MNI152_T1_2mm_brain']
+        mask = np.asanyarray(brain.dataobj) > 0
+        save(nib.Nifti1Image(mask.astype(np.uint8), brain.affine), 'MNI152_T1_2mm_brain_bin')
+        if 'MNI152_T1_2mm_brain_mask_dil' not in imgs:
+          save(nib.Nifti1Image(dilate(mask).astype(np.uint8), brain.affine), 'MNI152_T1_2mm_brain_mask_dil')
+      write_json(cache + '/templates.json', {'Sources': present})
+
+  assets = dict(sources)
+  for name in os.listdir(cache):
+    if name.endswith('.nii') and not name.startswith('.'):
+      assets[name[:-len('.nii')]] = cache + '/' + name
+  if 'MNI152_T1_2mm_brain' in assets:
+    assets.setdefault('MNI152_T1_2mm_brain_bin', assets['MNI152_T1_2mm_brain'])
+  entry.assets = assets
+  return assets
+
 def run_bet(layout,entry):
 
   returnflag=False
@@ -223,8 +1144,7 @@ def run_bet(layout,entry):
 
   else:         # Run BET
     print("\nRunning BET...\n")
-    t1w=layout.get(subject=entry.pid, extension='nii.gz', suffix='T1w')
-    t1w=t1w[0]
+    t1w=subject_t1w(layout,entry)
     imgpath = t1w.path
     imgname = t1w.filename
     # output filename...
@@ -233,22 +1153,20 @@ def run_bet(layout,entry):
       ent['run']=str(ent['run']).zfill(2)
 
     # -------- run command  -------- #
-    cmd = "bash " + entry.templates + "/run_bet.sh " + imgpath + " " + entry.wd
+    assets = template_assets(entry)
+    cmd = "bash " + entry.templates + "/run_bet.sh " + imgpath + " " + entry.wd + " " + \
+          " ".join(assets.get(t, '') for t in ('MNI152_T1_2mm', 'MNI152_T1_2mm_brain_mask_dil', 'MNI152_T1_0.8mm', 'MNI152_T1_0.8mm_brain_mask'))
     name = "bet" 
-    p = multiprocessing.Process(target=worker, args=(name,cmd))
-    p.start()
-    print(p)
     returnflag=True
 
-    p.join()  # blocks further execution until job is finished
+    run_jobs([Job(name,cmd)], entry)  # blocks further execution until job is finished
 
   return returnflag
 
 
 def save_bet(layout,entry):
 
-  t1w=layout.get(subject=entry.pid, extension='nii.gz', suffix='T1w')
-  imgpath=t1w[0].path
+  imgpath=subject_t1w(layout,entry).path
 
   # output filename...
   ent = layout.parse_file_entities(imgpath)
@@ -281,67 +1199,33 @@ def save_bet(layout,entry):
 
 def run_topup(layout,entry):
 
-  # check for number of feildmap pairs
-  fmapfiles=layout.get(subject=entry.pid, extension='nii.gz', suffix='epi');
   jobs=[]
   returnflag=False
 
-  if np.remainder(len(fmapfiles), 2) != 0:
-    raise Exception("Topup cannot be run...unbalanced Fieldmap pairs")
-
-  npairs = int(len(fmapfiles)/2)
-  print(fmapfiles)
-
-  fmapfilenames = [item.path for item in fmapfiles]
-
-  for r in range(1,npairs+1):
-    run=str(r).zfill(2)
-
-    fmappair = [x for x in fmapfilenames if 'run-'+run in x]
-
-    if not fmappair:
-      fmappair = fmapfilenames
+  for ses, inputs in session_inputs(layout,entry).items():
+    for pair in inputs['fmaps']:
+      topupdir = entry.wd + '/' + pair['dir']
 
-    # check if output exists already
-    if os.path.exists(entry.wd + '/topup-'+run+'/topup4_field_APPA.nii.gz') and not entry.overwrite:
-      print('Topup-' + run + ' output exists...skipping')
-      continue
-      print(" ")
+      # check if output exists already
+      if os.path.exists(topupdir + '/topup4_field_APPA.nii.gz') and not entry.overwrite:
+        print(pair['dir'] + ' output exists...skipping')
+        continue
 
-    # Run Topup
-    print("\nRunning Topup...\n")
+      # Run Topup
+      print("\nRunning Topup: " + pair['dir'] + "\n")
+      meta = pair['ap'].get_metadata()
 
-    # check two fieldmaps collected with opposing phase encoding directions
-    ap=False ; pa=False
-    for fmap in fmappair:
-      img = layout.get_file(fmap)
-      ent = img.get_entities()
-      
-      if 'AP' in ent['direction']:
-        ap=True; img1=img.path ; meta=img.get_metadata()
-      elif 'PA' in ent['direction']:
-        pa=True ; img2=img.path
-
-    if not ap and not pa:
-      # continue topup... (else throw error?)
-      raise Exception("Topup cannot be run...Missing AP or PA fieldmaps")
-
-    # add notes on intended in working dir
-    os.makedirs(entry.wd + '/topup-'+run,exist_ok=True)
-    writelist(entry.wd + '/topup-'+run+'/intendedfor.list', meta['IntendedFor'])
-    
+      # add notes on intended in working dir
+      os.makedirs(topupdir,exist_ok=True)
+      writelist(topupdir + '/intendedfor.list', meta['IntendedFor'])
 
-    # run script
-    cmd = "bash " + entry.templates + "/run_topup.sh " + img1 + " " + img2 + " " + entry.wd+'/topup-'+run + " " + str(meta['TotalReadoutTime'])
-    name = "topup"+run
-    p = multiprocessing.Process(target=worker, args=(name,cmd))
-    jobs.append(p)
-    p.start()
-    print(p)
-    returnflag=True
+      # run script
+      cmd = "bash " + entry.templates + "/run_topup.sh " + pair['ap'].path + " " + pair['pa'].path + " " + topupdir + " " + str(meta['TotalReadoutTime'])
+      name = pair['dir'].replace('topup-', 'topup')
+      jobs.append(Job(name,cmd,outputs=[pair['dir']]))
+      returnflag=True
 
-  for job in jobs:
-    job.join()  #wait for all topup commands to finish
+  run_jobs(jobs, entry)  #wait for all topup commands to finish (all sessions together)
 
   return returnflag
     ## end run_topup
@@ -353,7 +1237,7 @@ def run_distcorrepi(layout,entry):
   jobs=[];
   returnflag=False
 
-  for func in layout.get(subject=entry.pid, extension='nii.gz', suffix=['bold','sbref']):
+  for func in layout.get(subject=entry.pid, extension='nii.gz', suffix=['bold','sbref'], scope='raw'):
       
       imgpath = func.path
       imgname = func.filename
@@ -362,6 +1246,9 @@ def run_distcorrepi(layout,entry):
       if 'run' in ent:
         ent['run']=str(ent['run']).zfill(2)
 
+      if run_failed(entry, run_key(ent)):
+        continue
+
       # get file metadata
       meta=func.get_metadata()
       aqdir=meta['PhaseEncodingDirection']
@@ -400,20 +1287,17 @@ def run_distcorrepi(layout,entry):
         raise Exception("Cannot identify fieldmap intended for distortion correction:" +imgname)
 
       # -------- run command  -------- #
-      cmd = "bash " + entry.templates + "/run_distcorrepi.sh " + imgpath + " " + fout + " " + param + " " + topupdir + " " + entry.wd
+      chunkvols, njobs = split_params(imgpath, entry)
+      cmd = "bash " + entry.templates + "/run_distcorrepi.sh " + imgpath + " " + fout + " " + param + " " + topupdir + " " + entry.wd + " " + str(chunkvols) + " " + str(njobs)
       print(cmd)
       print(" ")
-      name = "distcorr-" + ent['task'] + str(ent['run']) + "-" + ent['suffix']
-      p = multiprocessing.Process(target=worker, args=(name,cmd))
-      jobs.append(p)
-      p.start()
+      name = "distcorr-" + run_key(ent) + "-" + ent['suffix']
+      jobs.append(Job(name,cmd,after=[topupdir.replace('topup-', 'topup')],outputs=['distcorrepi']))
 
       itr = itr+1
-      print(p)
       returnflag=True
 
-  for job in jobs:
-    job.join()  #wait for all distcorrepi commands to finish
+  run_jobs(jobs, entry)  #wait for all distcorrepi commands to finish
   
   return returnflag    
   ## end run_discorrpei
@@ -425,15 +1309,17 @@ def run_preprocess(layout,entry):
   jobs=[];
   returnflag=False
 
-  for func in layout.get(subject=entry.pid, extension='nii.gz', suffix='bold'):
+  for func in layout.get(subject=entry.pid, extension='nii.gz', suffix='bold', scope='raw'):
       
       imgpath = func.path
       imgname = func.filename
       ent = layout.parse_file_entities(imgpath)
       if 'run' in ent:
         ent['run']=str(ent['run']).zfill(2)
+      if run_failed(entry, run_key(ent)):
+        continue
       
-      if os.path.exists(entry.wd + '/preproc/' + ent['task'] + str(ent['run']) + '_mcf.nii.gz') and not entry.overwrite:
+      if os.path.exists(entry.wd + '/preproc/' + run_key(ent) + '_mcf.nii.gz') and not entry.overwrite:
           itr=itr+1
           print("Motion correction output exists...skipping: " + imgname)
           continue
@@ -446,20 +1332,17 @@ def run_preprocess(layout,entry):
 
       # -------- run command  -------- #
 
-      cmd = "bash " + entry.templates + "/run_preprocess.sh " + imgpath + " " + ent['task'] + str(ent['run']) + " " + entry.wd + " " + str(entry.trimvols)
+      chunkvols, njobs = split_params(imgpath, entry)
+      cmd = "bash " + entry.templates + "/run_preprocess.sh " + imgpath + " " + run_key(ent) + " " + entry.wd + " " + str(entry.trimvols) + " " + str(entry.croppad) + " " + str(chunkvols) + " " + str(njobs)
       print(cmd)
       print(" ")
-      name = "preproc-" + ent['task'] + str(ent['run'])
-      p = multiprocessing.Process(target=worker, args=(name,cmd))
-      jobs.append(p)
-      p.start()
+      name = "preproc-" + run_key(ent)
+      jobs.append(Job(name,cmd,after=['bet', 'distcorr-' + run_key(ent) + '-bold'],outputs=['preproc']))
 
       itr = itr+1
-      print(p)
       returnflag=True
 
-  for job in jobs:
-    job.join()  # wait for all preproc commands to finish
+  run_jobs(jobs, entry)  # wait for all preproc commands to finish
   
   return returnflag    
   ## end run_preprocess
@@ -467,7 +1350,7 @@ def run_preprocess(layout,entry):
 def save_preprocess(layout,entry):
 
   # Move output files to permanent location
-  for func in layout.get(subject=entry.pid, extension='nii.gz', suffix='bold'):
+  for func in layout.get(subject=entry.pid, extension='nii.gz', suffix='bold', scope='raw'):
       
     imgpath = func.path
     imgname = func.filename
@@ -476,6 +1359,8 @@ def save_preprocess(layout,entry):
     ent = layout.parse_file_entities(imgpath)
     if 'run' in ent:
       ent['run']=str(ent['run']).zfill(2)
+    if run_failed(entry, run_key(ent)):
+      continue
 
     # Define the pattern to build out of the components passed in the dictionary
     pattern = "fmripreproc/sub-{subject}/[ses-{session}/][{type}/]sub-{subject}[_ses-{session}][_task-{task}][_acq-{acquisition}][_rec-{reconstruction}][_run-{run}][_echo-{echo}][_dir-{direction}][_space-{space}][_desc-{desc}]_{suffix}.nii.gz",
@@ -497,14 +1382,31 @@ def save_preprocess(layout,entry):
     print("Motion corrected image: " + outfile)
 
     os.system('mkdir -p $(dirname ' + entry.outputs + '/' + outfile + ')')
-    os.system('cp -p ' + entry.wd + '/preproc/' + ent['task'] + str(ent['run']) + '_mcf.nii.gz ' + entry.outputs + "/" + outfile)
-    if os.path.exists(entry.wd + '/preproc/' + ent['task'] + str(ent['run']) + '_SBRef_bet.nii.gz'):
-      os.system('cp -p ' + entry.wd + '/preproc/' + ent['task'] + str(ent['run']) + '_SBRef_bet.nii.gz ' + entry.outputs + "/" + outfile_sbref)
+    crop = crop_box(entry, run_key(ent))
+    publish_series(entry.wd + '/preproc/' + run_key(ent) + '_mcf.nii.gz', entry.outputs + "/" + outfile, entry, crop)
+    if os.path.exists(entry.wd + '/preproc/' + run_key(ent) + '_SBRef_bet.nii.gz'):
+      sbref = entry.wd + '/preproc/' + run_key(ent) + '_SBRef_bet.nii.gz'
+    else:
+      sbref = entry.wd + '/preproc/' + run_key(ent) + '_meanvol_bet.nii.gz'
+    if crop:
+      uncrop_image(sbref, entry.outputs + "/" + outfile_sbref, crop)
     else:
-      os.system('cp -p ' + entry.wd + '/preproc/' + ent['task'] + str(ent['run']) + '_meanvol_bet.nii.gz ' + entry.outputs + "/" + outfile_sbref)
+      os.system('cp -p ' + sbref + ' ' + entry.outputs + "/" + outfile_sbref)
+    # later stages work on the float (and, with --crop-epi, cropped) working copies,
+    # not on the published series, which may be quantized (--output-dtype=int16)
+    os.makedirs(entry.wd + '/native', exist_ok=True)
+    for src, dst in ((entry.wd + '/preproc/' + run_key(ent) + '_mcf.nii.gz', outfile), (sbref, outfile_sbref)):
+      os.system('ln -sf ' + src + ' ' + entry.wd + '/native/' + os.path.basename(dst))
+
+    store_metrics(entry, ent, ['motion'])
 
   ## END SAVE_PREPROCESS
 
+def t1w_warp(entry):
+  # fnirt warp of the brain extraction (struc_acpc, the desc-brain T1w grid) to MNI 2mm, or 'none'
+  warp = entry.wd + '/bet/t1bet/str2standard.nii.gz'
+  return warp if os.path.exists(warp) else 'none'
+
 def run_registration(layout,entry):
   
   jobs=[];
@@ -512,11 +1414,13 @@ def run_registration(layout,entry):
 
   for func in layout.get(subject=entry.pid, desc='preproc', extension='nii.gz', suffix=['bold']):
       
-      imgpath = func.path
+      imgpath = stage_input(entry, func.path)
       imgname = func.filename
       ent = layout.parse_file_entities(imgpath)
       if 'run' in ent:
         ent['run']=str(ent['run']).zfill(2)
+      if run_failed(entry, run_key(ent)):
+        continue
 
       t1w = layout.get(subject=entry.pid,  desc='brain', extension='nii.gz', suffix='T1w')
       t1wpath = t1w[0].path
@@ -524,7 +1428,13 @@ def run_registration(layout,entry):
       t1whead = layout.get(subject=entry.pid,  desc='head', extension='nii.gz', suffix='T1w')
       t1wheadpath = t1whead[0].path
 
-      if os.path.exists(entry.wd + '/reg/' + ent['task'] + str(ent['run']) +'/' + 'func_data2standard.nii.gz') and not entry.overwrite:
+      # lazy standard space: the final transform is the last output
+      if entry.stdspace == 'lazy':
+        regdone = entry.wd + '/reg/' + run_key(ent) +'/' + 'standard2example_func.mat'
+      else:
+        regdone = entry.wd + '/reg/' + run_key(ent) +'/' + 'func_data2standard.nii.gz'
+
+      if os.path.exists(regdone) and not entry.overwrite:
           print("Registration complete...skipping: " + imgname)
           continue
           print(" ")
@@ -536,19 +1446,15 @@ def run_registration(layout,entry):
       print('Using: ' + t1wpath)
 
       # -------- run command  -------- #
-      stdpath = os.popen('echo $FSLDIR/data/standard/MNI152_T1_2mm_brain.nii.gz').read().rstrip()
+      stdpath = template_assets(entry)['MNI152_T1_2mm_brain']
 
-      cmd = "bash " + entry.templates + "/run_registration.sh " + imgpath + " " + t1wheadpath + " " + t1wpath + " " + stdpath + " " + entry.wd 
-      name = "registration-" + ent['task'] + str(ent['run']) + "-" + ent['suffix']
-      p = multiprocessing.Process(target=worker, args=(name,cmd))
-      jobs.append(p)
-      p.start()
-
-      print(p)
+      chunkvols, njobs = split_params(imgpath, entry, resampled=stdpath)
+      cmd = "bash " + entry.templates + "/run_registration.sh " + imgpath + " " + t1wheadpath + " " + t1wpath + " " + stdpath + " " + entry.wd + " " + run_key(ent) + " " + entry.stdspace + " " + str(chunkvols) + " " + str(njobs) + " " + t1w_warp(entry)
+      name = "registration-" + run_key(ent) + "-" + ent['suffix']
+      jobs.append(Job(name,cmd,after=['preproc-' + run_key(ent)],outputs=['reg/' + run_key(ent)]))
       returnflag=True
 
-  for job in jobs:
-    job.join()  # wait for all preproc commands to finish
+  run_jobs(jobs, entry)  # wait for all preproc commands to finish
 
   return returnflag
   
@@ -557,6 +1463,7 @@ def run_registration(layout,entry):
 def save_registration(layout,entry):
 
   # move outputs to permanent location...
+  passed = None  # a run that passed the checks, source of the t1w images below
   for func in layout.get(subject=entry.pid, space='native', desc='preproc', extension='nii.gz', suffix=['bold']):
       
     imgpath = func.path
@@ -566,6 +1473,9 @@ def save_registration(layout,entry):
     ent = layout.parse_file_entities(imgpath)
     if 'run' in ent:
       ent['run']=str(ent['run']).zfill(2)
+    if run_failed(entry, run_key(ent)):
+      continue
+    passed = passed or run_key(ent)
 
     # Define the pattern to build out of the components passed in the dictionary
     pattern = "fmripreproc/sub-{subject}/[ses-{session}/][{type}/]sub-{subject}[_ses-{session}][_task-{task}][_acq-{acquisition}][_rec-{reconstruction}][_run-{run}][_echo-{echo}][_dir-{direction}][_space-{space}][_desc-{desc}]_{suffix}.nii.gz",
@@ -589,18 +1499,36 @@ def save_registration(layout,entry):
     print("Registered image: " + outfile)
 
     os.system('mkdir -p $(dirname ' + entry.outputs + '/' + outfile + ')')
-    os.system('cp -p ' + entry.wd + '/reg/' + ent['task'] + str(ent['run']) + '/' + 'func_data2standard.nii.gz ' + entry.outputs + '/' + outfile)
-    os.system('cp -p ' + entry.wd + '/reg/' + ent['task'] + str(ent['run']) + '/' + 'example_func2standard.nii.gz ' + entry.outputs + '/' + outfile_sbref)
+    if entry.stdspace == 'full':
+      publish_series(entry.wd + '/reg/' + run_key(ent) + '/' + 'func_data2standard.nii.gz', entry.outputs + '/' + outfile, entry)
+    os.system('cp -p ' + entry.wd + '/reg/' + run_key(ent) + '/' + 'example_func2standard.nii.gz ' + entry.outputs + '/' + outfile_sbref)
     # copy registration matricies
     os.system('mkdir -p ' + entry.outputs + '/' + outdir_reg)
-    os.system('cp -p ' + entry.wd + '/reg/' + ent['task'] + str(ent['run']) + '/' + '*.mat ' + entry.outputs + '/' + outdir_reg)
-
-  # move t1w images...
+    os.system('cp -p ' + entry.wd + '/reg/' + run_key(ent) + '/' + '*.mat ' + entry.outputs + '/' + outdir_reg)
+    warp = entry.wd + '/reg/' + run_key(ent) + '/highres2standard_warp.nii.gz'
+    if os.path.exists(warp):
+      os.system('cp -pL ' + warp + ' ' + entry.outputs + '/' + outdir_reg)
+    crop = crop_box(entry, run_key(ent))
+    if crop:
+      uncrop_matrices(entry.outputs + '/' + outdir_reg, crop)
+
+    # describe the transforms so the series can be resampled later (resample_to_standard)
+    xfm = {'Reference': template_source('MNI152_T1_2mm_brain'),
+           'FuncToStandard': 'example_func2standard.mat',
+           'Interpolation': 'trilinear'}
+    if os.path.exists(warp):
+      # nonlinear: applywarp --premat=FuncToHighres -w HighresToStandardWarp --rel
+      xfm.update({'FuncToHighres': 'example_func2highres.mat', 'HighresToStandardWarp': 'highres2standard_warp.nii.gz'})
+    write_json(entry.outputs + '/' + outdir_reg + '/transforms.json', xfm)
+
+  # move t1w images (registered with every run, copied from one that passed)...
+  if not passed:
+    print("No registered run passed the checks...skipping standard space t1w")
+    return
   t1w = layout.get(subject=entry.pid, desc='brain', extension='nii.gz', suffix='T1w')
   t1wpath = t1w[0].path
 
   # output filename...
-  entfunc = layout.parse_file_entities(imgpath)  # save from above
   ent = layout.parse_file_entities(t1wpath)
   if 'run' in ent:
       ent['run']=str(ent['run']).zfill(2)
@@ -621,8 +1549,8 @@ def save_registration(layout,entry):
   print("Registered image: " + outfile)
 
   os.system('mkdir -p $(dirname ' + entry.outputs + '/' + outfile + ')')
-  os.system('cp -p ' + entry.wd + '/reg/' + entfunc['task'] + str(entfunc['run']) + '/' + 'highres2standard.nii.gz ' + entry.outputs + outfile)
-  os.system('cp -p ' + entry.wd + '/reg/' + entfunc['task'] + str(entfunc['run']) + '/' + 'mask2standard.nii.gz ' + entry.outputs + maskfile)
+  os.system('cp -p ' + entry.wd + '/reg/' + passed + '/' + 'highres2standard.nii.gz ' + entry.outputs + outfile)
+  os.system('cp -p ' + entry.wd + '/reg/' + passed + '/' + 'mask2standard.nii.gz ' + entry.outputs + maskfile)
 
 ## END SAVE_REGISTRATION
 
@@ -633,16 +1561,15 @@ def run_snr(layout,entry):
 
   for func in layout.get(subject=entry.pid, space='native', desc='preproc', extension='nii.gz', suffix=['bold']):
       
-      imgpath = func.path
+      imgpath = stage_input(entry, func.path)
       imgname = func.filename
       ent = layout.parse_file_entities(imgpath)
       if 'run' in ent:
         ent['run']=str(ent['run']).zfill(2)
+      if run_failed(entry, run_key(ent)):
+        continue
 
-      t1w = layout.get(subject=entry.pid, space='T1w', desc='brain', extension='nii.gz', suffix='T1w')
-      t1wpath = t1w[0].path
-
-      if os.path.exists(entry.wd + '/snr/' + ent['task'] + str(ent['run']) +'/snr_calc/' + ent['task'] + '/' + 'snr.nii.gz') and not entry.overwrite:
+      if os.path.exists(entry.wd + '/snr/' + run_key(ent) +'/snr_calc/' + run_key(ent) + '/' + 'snr2standard.nii.gz') and not entry.overwrite:
           print("SNR complete...skipping: " + imgname)
           continue
           print(" ")
@@ -654,17 +1581,14 @@ def run_snr(layout,entry):
 
       # -------- run command  -------- #
       
-      cmd = "bash " + entry.templates + "/run_snr.sh " + imgpath + " " + t1wpath + " " + entry.wd 
-      name = "snr-" + ent['task'] + str(ent['run']) + "-" + ent['suffix']
-      p = multiprocessing.Process(target=worker, args=(name,cmd))
-      jobs.append(p)
-      p.start()
-
-      print(p)
+      # tsnr in native space, uses example_func2standard.mat from registration
+      assets = template_assets(entry)
+      cmd = "bash " + entry.templates + "/run_snr.sh " + imgpath + " " + entry.wd + " " + run_key(ent) + " " + assets['MNI152_T1_2mm_brain'] + " " + assets['MNI152_T1_2mm_brain_bin']
+      name = "snr-" + run_key(ent) + "-" + ent['suffix']
+      jobs.append(Job(name,cmd,after=['registration-' + run_key(ent) + '-' + ent['suffix']],outputs=['snr/' + run_key(ent)]))
       returnflag=True
 
-  for job in jobs:
-    job.join()  # wait for all preproc commands to finish
+  run_jobs(jobs, entry)  # wait for all preproc commands to finish
 
   return returnflag
 
@@ -682,6 +1606,8 @@ def save_snr(layout,entry):
     ent = layout.parse_file_entities(imgpath)
     if 'run' in ent:
       ent['run']=str(ent['run']).zfill(2)
+    if run_failed(entry, run_key(ent)):
+      continue
 
     # Define the pattern to build out of the components passed in the dictionary
     pattern = "fmripreproc/sub-{subject}/[ses-{session}/][{type}/]sub-{subject}[_ses-{session}][_task-{task}][_acq-{acquisition}][_rec-{reconstruction}][_run-{run}][_echo-{echo}][_dir-{direction}][_space-{space}][_desc-{desc}]_{suffix}.nii.gz",
@@ -697,7 +1623,8 @@ def save_snr(layout,entry):
     print("SNR image: " + outfile)
 
     os.system('mkdir -p $(dirname ' + entry.outputs + '/' + outfile + ')')
-    os.system('cp -p ' + entry.wd + '/snr/' + ent['task'] + str(ent['run']) +'/snr_calc/' + ent['task'] + '/' + 'snr.nii.gz ' + entry.outputs + '/' + outfile)
+    os.system('cp -p ' + entry.wd + '/snr/' + run_key(ent) +'/snr_calc/' + run_key(ent) + '/' + 'snr2standard.nii.gz ' + entry.outputs + '/' + outfile)
+    store_metrics(entry, ent, ['snr', 'snr_slice'])
 
 #  --------------------- complete -------------------------- #
 
@@ -711,14 +1638,16 @@ def run_outliers(layout,entry):
       ent = layout.parse_file_entities(imgpath)
       if 'run' in ent:
         ent['run']=str(ent['run']).zfill(2)
+      if run_failed(entry, run_key(ent)):
+        continue
 
       # run from preproc images...
-      img1=ent['task'] + str(ent['run'])+".nii.gz"
-      img2=ent['task'] + str(ent['run'])+"_mcf.nii.gz"
+      img1=run_key(ent)+".nii.gz"
+      img2=run_key(ent)+"_mcf.nii.gz"
       path=entry.wd + '/preproc/'
 
-      if os.path.exists(entry.wd + '/preproc/' + ent['task'] + str(ent['run']) + '_fd_outliers.tsv') and not entry.overwrite:
-          print("Outlier Detection complete...skipping: " + ent['task'] + str(ent['run']))
+      if os.path.exists(entry.wd + '/preproc/' + run_key(ent) + '_fd_outliers.tsv') and not entry.overwrite:
+          print("Outlier Detection complete...skipping: " + run_key(ent))
           continue
           print(" ")
 
@@ -727,17 +1656,14 @@ def run_outliers(layout,entry):
 
       # -------- run command  -------- #
       
-      cmd = "bash " + entry.templates + "/run_outliers.sh " + path+img1 + " " + path+img2 + " " + entry.wd 
-      name = "outlier-" + ent['task'] + str(ent['run']) + "-" + ent['suffix']
-      p = multiprocessing.Process(target=worker, args=(name,cmd))
-      jobs.append(p)
-      p.start()
-
-      print(p)
+      # CompCor masks are warped to the functional grid with the registration and FAST outputs
+      cmd = "bash " + entry.templates + "/run_outliers.sh " + path+img1 + " " + path+img2 + " " + entry.wd + " " + entry.wd + '/reg/' + run_key(ent) + " " + entry.wd + '/segment'
+      name = "outlier-" + run_key(ent) + "-" + ent['suffix']
+      after = ['preproc-' + run_key(ent), 'registration-' + run_key(ent) + '-' + ent['suffix'], 'fast']
+      jobs.append(Job(name,cmd,after=after,outputs=['preproc']))
       returnflag=True
 
-  for job in jobs:
-    job.join()  # wait for all preproc commands to finish
+  run_jobs(jobs, entry)  # wait for all preproc commands to finish
 
   return returnflag
 
@@ -755,10 +1681,12 @@ def save_outliers(layout,entry):
     ent = layout.parse_file_entities(imgpath)
     if 'run' in ent:
       ent['run']=str(ent['run']).zfill(2)
+    if run_failed(entry, run_key(ent)):
+      continue
 
     # compile all outputs to single confounds file
     workingpath=entry.wd + '/preproc/'
-    generate_confounds_file(workingpath,ent['task'] + str(ent['run']))
+    generate_confounds_file(workingpath,run_key(ent))
 
 
     # Define the pattern to build out of the components passed in the dictionary
@@ -775,7 +1703,8 @@ def save_outliers(layout,entry):
     print("Outliers file: " + outfile)
 
     os.system('mkdir -p $(dirname ' + entry.outputs + '/' + outfile + ')')
-    os.system('cp -p ' + entry.wd + '/preproc/' + ent['task'] + str(ent['run']) + '_confounds.tsv ' + entry.outputs + '/' + outfile)
+    os.system('cp -p ' + entry.wd + '/preproc/' + run_key(ent) + '_confounds.tsv ' + entry.outputs + '/' + outfile)
+    store_metrics(entry, ent, ['confounds'])
 
     #save_outliers
 
@@ -789,32 +1718,20 @@ def run_fast(layout,entry):
 
   else:         # Run BET
     print("\nRunning FAST...\n")
-    t1w=layout.get(subject=entry.pid, extension='nii.gz', suffix='T1w')
-    t1w=t1w[0]
-    imgpath = t1w.path
-    imgname = t1w.filename
-    # output filename...
-    ent = layout.parse_file_entities(imgpath)
-    if 'run' in ent:
-      ent['run']=str(ent['run']).zfill(2)
-
-    
+    # segment the brain extracted T1w (bet stage), the highres image used by registration
+    imgpath = entry.wd + '/bet/t1bet/struc_acpc_brain.nii.gz'
 
     # -------- run command  -------- #
     cmd = "bash " + entry.templates + "/run_fast.sh " + imgpath + " " + entry.wd
     name = "fast" 
-    p = multiprocessing.Process(target=worker, args=(name,cmd))
-    p.start()
-    print(p)
     returnflag=True
 
-    p.join()  # blocks further execution until job is finished
+    run_jobs([Job(name,cmd,after=['bet'])], entry)  # blocks further execution until job is finished
   return returnflag
 
 def save_fast(layout,entry):
 
-  t1w=layout.get(subject=entry.pid, extension='nii.gz', suffix='T1w')
-  imgpath=t1w[0].path
+  imgpath=subject_t1w(layout,entry).path
 
   # output filename...
   ent = layout.parse_file_entities(imgpath)
@@ -852,23 +1769,25 @@ def run_aroma_icamodel(layout,entry):
 
   for func in layout.get(subject=entry.pid, space='native', desc='preproc', extension='nii.gz', suffix=['bold']):
       
-      imgpath = func.path
+      imgpath = stage_input(entry, func.path)
       imgname = func.filename
       ent = layout.parse_file_entities(imgpath)
       if 'run' in ent:
         ent['run']=str(ent['run']).zfill(2)
+      if run_failed(entry, run_key(ent)):
+        continue
 
       t1w = layout.get(subject=entry.pid, space='T1w', desc='brain', extension='nii.gz', suffix='T1w')
       t1wpath = t1w[0].path
 
-      if os.path.exists(entry.wd + '/aroma/' + ent['task'] + str(ent['run']) +'_aroma_noHP.feat' + '/' + 'filtered_func_data.nii.gz') and not entry.overwrite:
+      if os.path.exists(entry.wd + '/aroma/' + run_key(ent) +'_aroma_noHP.feat' + '/' + 'filtered_func_data.nii.gz') and not entry.overwrite:
           print("AROMA model complete...skipping: " + imgname)
           continue
           print(" ")
 
       # ------- Running registration: T1w space and MNI152Nonlin2006 (FSLstandard) ------- #
       fsf_template = entry.templates + "/models/aroma_noHP.fsf"
-      stdimg = os.popen('echo $FSLDIR/data/standard/MNI152_T1_2mm_brain.nii.gz').read().rstrip()
+      stdimg = template_assets(entry)['MNI152_T1_2mm_brain']
 
       s=', '
       print('Running AROMA Model: ' + imgpath)
@@ -876,17 +1795,12 @@ def run_aroma_icamodel(layout,entry):
 
       # -------- run command  -------- #
 
-      cmd = "bash " + entry.templates + "/run_aroma_model.sh " + imgpath + " " + t1wpath + " " + fsf_template + " " + stdimg + " " + entry.wd 
-      name = "aroma-model-" + ent['task'] + str(ent['run']) 
-      p = multiprocessing.Process(target=worker, args=(name,cmd))
-      jobs.append(p)
-      p.start()
-
-      print(p)
+      cmd = "bash " + entry.templates + "/run_aroma_model.sh " + imgpath + " " + t1wpath + " " + fsf_template + " " + stdimg + " " + entry.wd + " " + run_key(ent) + " " + t1w_warp(entry)
+      name = "aroma-model-" + run_key(ent) 
+      jobs.append(Job(name,cmd,after=['preproc-' + run_key(ent)],outputs=['aroma']))
       returnflag=True
 
-  for job in jobs:
-    job.join()  # wait for all aroma model commands to finish
+  run_jobs(jobs, entry)  # wait for all aroma model commands to finish
 
   return returnflag
   ## end run_aroma_icamodel
@@ -903,40 +1817,37 @@ def run_aroma_classify(layout,entry):
       ent = layout.parse_file_entities(imgpath)
       if 'run' in ent:
         ent['run']=str(ent['run']).zfill(2)
+      if run_failed(entry, run_key(ent)):
+        continue
 
       t1w = layout.get(subject=entry.pid, space='T1w', desc='brain', extension='nii.gz', suffix='T1w')
       t1wpath = t1w[0].path
 
-      if os.path.exists(entry.wd + '/aroma/aroma_classify/' + ent['task'] + str(ent['run']) + '/' + 'denoised_func_data_nonaggr.nii.gz') and not entry.overwrite:
-          print("AROMA classification complete...skipping: " + ent['task'] + str(ent['run']) )
+      if os.path.exists(entry.wd + '/aroma/aroma_classify/' + run_key(ent) + '/' + 'denoised_func_data_nonaggr.nii.gz') and not entry.overwrite:
+          print("AROMA classification complete...skipping: " + run_key(ent) )
           continue
           print(" ")
 
       # check necessary input exists
-      if not os.path.exists(entry.wd + '/aroma/' + ent['task'] + str(ent['run']) +'_aroma_noHP.feat' + '/' + 'filtered_func_data.nii.gz'):
-        raise Exception("Cannot identify aroma feat model intended for aroma classification:" +ent['task'] + str(ent['run']) )
+      if not os.path.exists(entry.wd + '/aroma/' + run_key(ent) +'_aroma_noHP.feat' + '/' + 'filtered_func_data.nii.gz'):
+        raise Exception("Cannot identify aroma feat model intended for aroma classification:" +run_key(ent) )
 
       # ------- Running registration: T1w space and MNI152Nonlin2006 (FSLstandard) ------- #
       
-      print('Running classification Model: ' + ent['task'] + str(ent['run']) )
+      print('Running classification Model: ' + run_key(ent) )
 
 
       # -------- run command  -------- #
-      featdir=entry.wd + '/aroma/' + ent['task'] + str(ent['run']) +'_aroma_noHP.feat'
-      outdir=entry.wd + '/aroma/aroma_classify/' + ent['task'] + str(ent['run'])
+      featdir=entry.wd + '/aroma/' + run_key(ent) +'_aroma_noHP.feat'
+      outdir=entry.wd + '/aroma/aroma_classify/' + run_key(ent)
 
       cmd = "bash " + entry.templates + "/run_aroma_classify.sh " + featdir + " " + outdir 
 
-      name = "aroma-classify-" + ent['task'] + str(ent['run']) 
-      p = multiprocessing.Process(target=worker, args=(name,cmd))
-      jobs.append(p)
-      p.start()
-
-      print(p)
+      name = "aroma-classify-" + run_key(ent) 
+      jobs.append(Job(name,cmd,after=['aroma-model-' + run_key(ent)]))
       returnflag=True
 
-  for job in jobs:
-    job.join()  # wait for all preproc commands to finish
+  run_jobs(jobs, entry)  # wait for all preproc commands to finish
 
   return returnflag
 
@@ -952,6 +1863,8 @@ def save_aroma_outputs(layout,entry):
     ent = layout.parse_file_entities(imgpath)
     if 'run' in ent:
       ent['run']=str(ent['run']).zfill(2)
+    if run_failed(entry, run_key(ent)):
+      continue
 
     # Define the pattern to build out of the components passed in the dictionary
     pattern = "fmripreproc/sub-{subject}/[ses-{session}/][{type}/]sub-{subject}[_ses-{session}][_task-{task}][_acq-{acquisition}][_rec-{reconstruction}][_run-{run}][_echo-{echo}][_dir-{direction}][_space-{space}][_desc-{desc}]_{suffix}.nii.gz",
@@ -967,8 +1880,8 @@ def save_aroma_outputs(layout,entry):
     print("AROMA image: " + outfile)
 
     os.system('mkdir -p $(dirname ' + entry.outputs + '/' + outfile + ')')
-    infile = entry.wd + '/aroma/aroma_classify/' + ent['task'] + str(ent['run']) + '/' + 'denoised_func_data_nonaggr.nii.gz'
-    os.system('cp -p ' + infile + ' ' + entry.outputs + '/' + outfile)
+    infile = entry.wd + '/aroma/aroma_classify/' + run_key(ent) + '/' + 'denoised_func_data_nonaggr.nii.gz'
+    publish_series(infile, entry.outputs + '/' + outfile, entry, crop_box(entry, run_key(ent)))
 
 def generate_confounds_file(path,task):
 
@@ -996,30 +1909,761 @@ def generate_confounds_file(path,task):
       d.columns = colnames
       df = pd.concat([df,d],axis=1)
 
+  # 24 motion parameters and CompCor components
+  if os.path.exists(path + "/" + task + "_mcf.par"):
+    d = motion_expansion(np.loadtxt(path + "/" + task + "_mcf.par", ndmin=2)[:, :6])
+    df = pd.concat([df,d],axis=1)
+  if os.path.exists(path + "/" + task + "_wm_func.nii.gz"):
+    d = compcor_confounds(path + "/" + task + "_mcf.nii.gz", path + "/" + task)
+    df = pd.concat([df,d],axis=1)
+
   # output a single confounds file
   df.to_csv(path +"/"+ task + "_confounds.tsv",sep="\t")
 
   # END GENERATE_CONFOUNDS_FILE
 
+COMPCOR_COMPONENTS = 5       # components kept per CompCor mask
+TCOMPCOR_FRACTION = 0.02     # tCompCor: highest variance fraction of brain voxels
+
+def motion_expansion(par):
+  """24 motion regressors: the 6 mcflirt parameters, their backward differences and the squares of both"""
+  df = pd.DataFrame(par, columns=MOTION_COLUMNS)
+  deriv = df.diff().fillna(0).add_suffix('_derivative1')
+  df = pd.concat([df, deriv], axis=1)
+  return pd.concat([df, (df ** 2).add_suffix('_power2')], axis=1)
+
+def detrend_design(nvols):
+  # constant and linear trend regressors
+  t = np.linspace(-1, 1, nvols) if nvols > 1 else np.zeros(1)
+  return np.column_stack([np.ones(nvols), t])
+
+def gather_timeseries(img,masks,chunk=16):
+  """Volumes x voxels matrices for each boolean mask, read one block of volumes at a time"""
+  nvols = img.shape[3] if len(img.shape) > 3 else 1
+  mats = [np.empty((nvols, int(m.sum())), dtype=np.float32) for m in masks]
+  for t0, t1, block in series_blocks(img, chunk):
+    for m, M in zip(masks, mats):
+      M[t0:t1] = block[m].T
+  return mats
+
+def residual_variance(img,mask,chunk=16):
+  """Per voxel variance after removing the mean and linear trend, in one streaming pass.
+
+  Only the sums x, t*x and x*x are kept per voxel; the residual sum of squares
+  follows from the normal equations of the detrending fit.
+  """
+  nvols = img.shape[3] if len(img.shape) > 3 else 1
+  X = detrend_design(nvols)
+  xs = np.zeros((2, int(mask.sum())))
+  xx = np.zeros(xs.shape[1])
+  for t0, t1, block in series_blocks(img, chunk):
+    v = block[mask].astype(np.float64)
+    xs += X[t0:t1].T @ v.T
+    xx += (v ** 2).sum(axis=1)
+  fit = np.linalg.solve(X.T @ X, xs)
+  return (xx - (xs * fit).sum(axis=0)) / max(nvols - 2, 1)
+
+def randomized_svd(M,k,oversample=10,niter=4,seed=0):
+  """Leading k left singular vectors and singular values of M (Halko et al. 2011)"""
+  rng = np.random.default_rng(seed)
+  Q = M @ rng.standard_normal((M.shape[1], min(k + oversample, M.shape[1])))
+  for i in range(niter):
+    Q, r = np.linalg.qr(Q)
+    Q, r = np.linalg.qr(M.T @ Q)
+    Q = M @ Q
+  Q, r = np.linalg.qr(Q)
+  U, sv, Vt = np.linalg.svd(Q.T @ M, full_matrices=False)
+  return (Q @ U)[:, :k], sv[:k]
+
+def compcor(M,ncomp=COMPCOR_COMPONENTS):
+  """Principal components of detrended, variance normalized voxel time series (in place)"""
+  X = detrend_design(M.shape[0])
+  M -= (X @ np.linalg.lstsq(X, M, rcond=None)[0]).astype(M.dtype)
+  std = M.std(axis=0)
+  std[std == 0] = 1
+  M /= std
+  k = min(ncomp, M.shape[0], M.shape[1])
+  if k == 0:
+    return np.zeros((M.shape[0], 0))
+  U, sv = randomized_svd(M, k)
+  return U
+
+def compcor_confounds(series,prefix):
+  """aCompCor (white matter, csf) and tCompCor components of a motion corrected series.
+
+  Masks are <prefix>_{wm,csf,brain}_func.nii.gz from run_outliers.sh. The series
+  is read in blocks of volumes, so memory is set by the number of mask voxels.
+  """
+  img = nib.load(series, mmap=True)
+  wm, csf, brain = [np.asarray(nib.load(prefix + '_' + m + '_func.nii.gz').dataobj) > 0 for m in ('wm', 'csf', 'brain')]
+
+  # tCompCor voxels: highest residual variance within the brain mask
+  var = residual_variance(img, brain)
+  high = np.zeros_like(brain)
+  if var.size:
+    n = max(int(np.ceil(TCOMPCOR_FRACTION * var.size)), 1)
+    idx = np.flatnonzero(brain)[np.argsort(var)[-n:]]
+    high.flat[idx] = True
+
+  df = pd.DataFrame()
+  for name, M in zip(('a_comp_cor_wm', 'a_comp_cor_csf', 't_comp_cor'), gather_timeseries(img, [wm, csf, high])):
+    U = compcor(M)
+    df = pd.concat([df, pd.DataFrame(U, columns=[name + '_' + str(i).zfill(2) for i in range(U.shape[1])])], axis=1)
+  return df
+
+# ------------------------------------------------------------------------------
+#  Dataset metrics store: <outputs>/fmripreproc/metrics
+# ------------------------------------------------------------------------------
+#
+#  One file per run and table, <table>/sub-<id>/<run name>.parquet (.npz without
+#  pyarrow), written atomically: concurrent writers never touch the same file.
+#  summary.<ext> holds one row per run and is updated under summary.lock.
+#
+#  confounds   volume, fd, dvars, fd_outlier, dvars_outlier
+#  motion      volume, rot_x, rot_y, rot_z (rad), trans_x, trans_y, trans_z (mm)
+#  snr         snr_min, snr_max, snr_mean (whole brain, native space)
+#  snr_slice   slice, min, max, mean, std
+#  summary     nvols, fd_mean, fd_max, fd_outliers, dvars_mean, dvars_outliers,
+#              rot_max, trans_max, snr_min, snr_max, snr_mean
+#  Every table starts with subject, session, task, acquisition, run.
+
+try:
+  import pyarrow
+  METRICS_FORMAT = 'parquet'
+except ImportError:
+  METRICS_FORMAT = 'npz'
+
+METRICS_IDS = ['subject', 'session', 'task', 'acquisition', 'run']
+MOTION_COLUMNS = ['rot_x', 'rot_y', 'rot_z', 'trans_x', 'trans_y', 'trans_z']
+SUMMARY_COLUMNS = ['nvols', 'fd_mean', 'fd_max', 'fd_outliers', 'dvars_mean', 'dvars_outliers',
+                   'rot_max', 'trans_max', 'snr_min', 'snr_max', 'snr_mean']
+
+def write_table(filename,df):
+  tmp = filename + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.tmp'
+  if filename.endswith('.parquet'):
+    df.to_parquet(tmp, index=False)
+  else:
+    with open(tmp, 'wb') as f:
+      np.savez(f, **{c: df[c].to_numpy() if pd.api.types.is_numeric_dtype(df[c]) else df[c].to_numpy(dtype=str)
+                     for c in df.columns})
+  os.replace(tmp, filename)
+  # a copy in the other format (written with or without pyarrow) is superseded
+  for other in latest_tables([filename.rsplit('.', 1)[0] + '.' + ext for ext in ('parquet', 'npz')], stale=True):
+    os.remove(other)
+
+def latest_tables(files,stale=False):
+  # the newest file of every table written in both formats (or, with stale, the others)
+  latest = {}
+  for f in files:
+    if os.path.exists(f):
+      latest.setdefault(f.rsplit('.', 1)[0], []).append(f)
+  pick = []
+  for versions in latest.values():
+    versions.sort(key=os.path.getmtime)
+    pick += versions[:-1] if stale else versions[-1:]
+  return sorted(pick)
+
+def read_table(filename):
+  if filename.endswith('.parquet'):
+    return pd.read_parquet(filename)
+  with np.load(filename) as z:
+    return pd.DataFrame({c: z[c] for c in z.files})
+
+def metrics_ids(ent):
+  return {'subject': ent['subject'], 'session': ent.get('session', ''), 'task': ent.get('task', ''),
+          'acquisition': ent.get('acquisition', ''), 'run': str(ent['run']).zfill(2) if 'run' in ent else ''}
+
+def metrics_file(outputs,table,ids,ext=None):
+  name = '_'.join(k + '-' + ids[i] for k, i in (('sub', 'subject'), ('ses', 'session'), ('task', 'task'),
+                                                  ('acq', 'acquisition'), ('run', 'run')) if ids[i])
+  return outputs + '/fmripreproc/metrics/' + table + '/sub-' + ids['subject'] + '/' + name + '.' + (ext or METRICS_FORMAT)
+
+def run_metrics(entry,ent,table):
+  """Builds a table for one run from the working directory files"""
+  key = run_key(ent)
+  if table == 'motion':
+    par = np.loadtxt(entry.wd + '/preproc/' + key + '_mcf.par', ndmin=2)
+    df = pd.DataFrame(par[:, :6], columns=MOTION_COLUMNS)
+  elif table == 'confounds':
+    c = pd.read_csv(entry.wd + '/preproc/' + key + '_confounds.tsv', sep='\t', index_col=0)
+    df = pd.DataFrame({'fd': c['fd'].to_numpy(), 'dvars': c['dvars'].to_numpy()})
+    for m in ('fd', 'dvars'):
+      flags = c.filter(like=m + '_outliers_')
+      df[m + '_outlier'] = flags.to_numpy().any(axis=1) if flags.shape[1] else False
+  elif table in ('snr', 'snr_slice'):
+    calc = entry.wd + '/snr/' + key + '/snr_calc/' + key + '/'
+    if table == 'snr':
+      w = pd.read_csv(calc + 'whole_brain.csv')
+      df = pd.DataFrame({'snr_min': w['min'], 'snr_max': w['max'], 'snr_mean': w['nonzeroMean']})
+    else:
+      df = pd.read_csv(calc + 'by_slice.csv')[['slice', 'min', 'max', 'mean', 'std']]
+      crop = crop_box(entry, key)
+      if crop:
+        df['slice'] += crop['offset'][2]   # slices of the full acquisition grid
+  if table in ('motion', 'confounds'):
+    df.insert(0, 'volume', np.arange(len(df)))
+  return df
+
+def summary_row(outputs,ids):
+  # one summary row from whatever tables exist for the run
+  row = dict(ids)
+  def load(table):
+    for f in latest_tables([metrics_file(outputs, table, ids, ext) for ext in ('parquet', 'npz')]):
+      return read_table(f)
+  c = load('confounds')
+  if c is not None:
+    row.update(nvols=len(c), fd_mean=c['fd'].mean(), fd_max=c['fd'].max(), fd_outliers=int(c['fd_outlier'].sum()),
+               dvars_mean=c['dvars'].mean(), dvars_outliers=int(c['dvars_outlier'].sum()))
+  m = load('motion')
+  if m is not None:
+    row.update(rot_max=m[MOTION_COLUMNS[:3]].abs().to_numpy().max(), trans_max=m[MOTION_COLUMNS[3:]].abs().to_numpy().max())
+    row.setdefault('nvols', len(m))
+  snr = load('snr')
+  if snr is not None:
+    row.update(snr.iloc[0][['snr_min', 'snr_max', 'snr_mean']].to_dict())
+  return row
+
+def store_metrics(entry,ent,tables):
+  """Adds one run's tables to the dataset store and refreshes its summary row"""
+  ids = metrics_ids(ent)
+  for table in tables:
+    try:
+      df = run_metrics(entry, ent, table)
+    except (OSError, KeyError, ValueError) as e:
+      print('Metrics: ' + table + ' not stored for ' + run_key(ent) + ' (' + str(e) + ')')
+      continue
+    for i, k in enumerate(METRICS_IDS):
+      df.insert(i, k, ids[k])
+    filename = metrics_file(entry.outputs, table, ids)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    write_table(filename, df)
+
+  mdir = entry.outputs + '/fmripreproc/metrics'
+  os.makedirs(mdir, exist_ok=True)
+  with FileLock(mdir + '/summary.lock'):
+    summary = read_metrics(entry.outputs)
+    if len(summary):
+      same = np.logical_and.reduce([summary[k].astype(str) == ids[k] for k in METRICS_IDS])
+      summary = summary[~same]
+    summary = pd.concat([summary, pd.DataFrame([summary_row(entry.outputs, ids)])], ignore_index=True)
+    summary = summary.reindex(columns=METRICS_IDS + SUMMARY_COLUMNS).sort_values(METRICS_IDS)
+    write_table(mdir + '/summary.' + METRICS_FORMAT, summary.reset_index(drop=True))
+
+def read_metrics(outputs,table='summary',**filters):
+  """Reads a table of the dataset store, e.g. read_metrics(out).query('fd_mean > 0.3')
+
+  filters select by id column (subject='01', task='rest'); per run tables
+  only open the partitions of the requested subject.
+  """
+  mdir = outputs + '/fmripreproc/metrics/'
+  if table == 'summary':
+    files = latest_tables([mdir + 'summary.parquet', mdir + 'summary.npz'])
+  else:
+    files = latest_tables(f for ext in ('parquet', 'npz') for f in glob.glob(mdir + table + '/sub-' + filters.get('subject', '*') + '/*.' + ext))
+  if not files:
+    return pd.DataFrame(columns=METRICS_IDS)
+  df = pd.concat([read_table(f) for f in files], ignore_index=True)
+  for k, v in filters.items():
+    df = df[df[k].astype(str) == str(v)]
+  return df.reset_index(drop=True)
+
+def metrics_main(argv):
+  # command line: fmripreproc_wrapper.py metrics --out=<outputs> [--table=] [--query=]
+  try:
+    opts, args = getopt.getopt(argv, "ho:", ["help", "out=", "table=", "query="])
+  except getopt.GetoptError:
+    print_help()
+    sys.exit(2)
+  opts = dict(opts)
+  outputs = opts.get('--out', opts.get('-o'))
+  if '-h' in opts or '--help' in opts or not outputs:
+    print_help()
+    sys.exit()
+  df = read_metrics(outputs, opts.get('--table', 'summary'))
+  if '--query' in opts:
+    df = df.query(opts['--query'])
+  print(df.to_csv(sep='\t', index=False), end='')
+
 
 # def run_aroma_preprocess(layout,entry):
 #   # run second motion correction - seems uncessesary??
 
-def generate_report():
+# ------------------------------------------------------------------------------
+#  Publishing 4D derivatives (--output-dtype)
+# ------------------------------------------------------------------------------
+
+PUBLISH_CACHE_VERSION = "1"   # bump to republish every int16 series
+
+def series_blocks(img,chunk=16):
+  """Yields (t0, t1, float32 data) blocks of volumes from a 4D image.
+
+  A file backed image is read front to back through one open stream: slicing
+  dataobj per block would restart the gzip decompression for every block.
+  """
+  nvols = img.shape[3] if len(img.shape) > 3 else 1
+  shape = img.shape[:3]
+  filename = img.file_map['image'].filename
+  if not filename or not nib.is_proxy(img.dataobj) or img.dataobj.order != 'F':
+    for t0 in range(0, nvols, chunk):
+      t1 = min(t0 + chunk, nvols)
+      block = np.asarray(img.dataobj[..., t0:t1] if len(img.shape) > 3 else img.dataobj, dtype=np.float32)
+      yield t0, t1, block.reshape(shape + (t1 - t0,), order='F')
+    return
+  proxy = img.dataobj
+  dtype = np.dtype(proxy.dtype)
+  volbytes = int(np.prod(shape)) * dtype.itemsize
+  slope = 1.0 if proxy.slope is None or not np.isfinite(proxy.slope) or proxy.slope == 0 else float(proxy.slope)
+  inter = 0.0 if proxy.inter is None or not np.isfinite(proxy.inter) else float(proxy.inter)
+  with nib.openers.ImageOpener(filename, 'rb') as f:
+    f.seek(proxy.offset)
+    for t0 in range(0, nvols, chunk):
+      t1 = min(t0 + chunk, nvols)
+      raw = f.read(volbytes * (t1 - t0))
+      if len(raw) != volbytes * (t1 - t0):
+        raise IOError('truncated image data in ' + filename)
+      block = np.frombuffer(raw, dtype=dtype).astype(np.float32)
+      if slope != 1.0 or inter != 0.0:
+        block = block * np.float32(slope) + np.float32(inter)
+      yield t0, t1, block.reshape(shape + (t1 - t0,), order='F')
+
+def write_series(filename,hdr,blocks):
+  """Streams 4D data blocks (already in the header's dtype) to a nifti file.
+
+  Nifti stores data in fortran order, so each block of whole volumes is one
+  contiguous stretch of the file. Written under a temporary name and renamed.
+  """
+  tmp = os.path.dirname(filename) + '/.' + os.path.basename(filename) + '.' + str(os.getpid()) + '.tmp'
+  dtype = hdr.get_data_dtype().newbyteorder(hdr.endianness)
+  hdr['vox_offset'] = 0
+  opener = gzip.open if filename.endswith('.gz') else open
+  with opener(tmp, 'wb') as f:
+    hdr.write_to(f)
+    f.write(b'\x00' * (int(hdr['vox_offset']) - f.tell()))
+    for block in blocks:
+      f.write(np.asarray(block, dtype=dtype).tobytes(order='F'))
+  os.replace(tmp, filename)
+
+def publish_series(infile,outfile,entry,crop=None):
+  """Copies a 4D derivative to its published location, as int16 if requested.
+
+  With --output-dtype=int16 the series is streamed twice: the first pass finds
+  the data range that sets the scaling (scl_slope/scl_inter), the second writes
+  the scaled series and measures the maximum quantization error, which is
+  recorded in the json sidecar. Integer valued data that fit in int16 are stored exactly.
+  A cropped series (crop_box) is put back on the acquisition grid.
+  """
+  if entry.outdtype == 'float32':
+    if crop:
+      uncrop_image(infile, outfile, crop)
+    else:
+      os.system('cp -p ' + infile + ' ' + outfile)
+    return
+
+  sidecar = re.sub(r'\.nii(\.gz)?$', '.json', outfile)
+  key = input_hash([infile] + ([crop['ref']] if crop else []), PUBLISH_CACHE_VERSION, 'int16', crop and crop['offset'])
+  if os.path.exists(outfile) and os.path.exists(sidecar):
+    with open(sidecar) as f:
+      if json.load(f).get('SourceHash') == key:
+        print('Published series up to date: ' + outfile)
+        return
+
+  img = nib.load(infile, mmap=True)
+  if crop:
+    hdr = uncrop_header(img, crop)
+    blocks = lambda: uncrop_blocks(img, crop)
+  else:
+    hdr = img.header.copy()
+    blocks = lambda: series_blocks(img)
+  lo, hi, integral = np.inf, -np.inf, True
+  for t0, t1, block in blocks():
+    lo = min(lo, float(block.min()))
+    hi = max(hi, float(block.max()))
+    integral = integral and bool(np.all(block == np.round(block)))
+
+  if integral and lo >= -32768 and hi <= 32767:
+    slope, inter = 1.0, 0.0
+  else:
+    inter = (hi + lo) / 2
+    slope = (hi - lo) / 65534 if hi > lo else 1.0
+
+  hdr.set_data_dtype(np.int16)
+  hdr.set_slope_inter(slope, inter)
+  maxerr = [0.0]
+
+  def quantize():
+    for t0, t1, block in blocks():
+      q = np.clip(np.round((block - inter) / slope), -32768, 32767)
+      maxerr[0] = max(maxerr[0], float(np.abs(q * slope + inter - block).max()))
+      yield q
+
+  write_series(outfile, hdr, quantize())
+  print('Published int16 series: ' + outfile + ' (max quantization error ' + str(maxerr[0]) + ')')
+
+  meta = {}
+  if os.path.exists(sidecar):
+    with open(sidecar) as f:
+      meta = json.load(f)
+  meta.update({'DataType': 'int16', 'SclSlope': slope, 'SclInter': inter,
+               'QuantizationMaxError': maxerr[0], 'SourceHash': key})
+  write_json(sidecar, meta)
+
+# ------------------------------------------------------------------------------
+#  Brain bounding box cropping (--crop-epi)
+# ------------------------------------------------------------------------------
+
+def crop_box(entry,key):
+  """Crop of a run made by run_preprocess.sh, or None.
+
+  {'offset': (x0, y0, z0), 'size': (nx, ny, nz), 'ref': full grid reference image}
+  """
+  box = entry.wd + '/preproc/' + key + '_crop.txt'
+  if not os.path.exists(box):
+    return None
+  with open(box) as f:
+    roi = [int(v) for v in f.read().split()]
+  return {'offset': tuple(roi[0::2]), 'size': tuple(roi[1::2]), 'ref': entry.wd + '/preproc/' + key + '_crop_ref.nii.gz'}
+
+def stage_input(entry,path):
+  # working copy (float, cropped with --crop-epi) of a published native series, if there is one
+  native = entry.wd + '/native/' + os.path.basename(path)
+  return native if os.path.exists(native) else path
+
+def uncrop_header(img,crop):
+  # header of the acquisition grid (affine of the reference), float32 data
+  ref = nib.load(crop['ref'])
+  hdr = ref.header.copy()
+  shape = ref.shape[:3] + img.shape[3:4]
+  hdr.set_data_shape(shape)
+  hdr.set_zooms(ref.header.get_zooms()[:3] + img.header.get_zooms()[3:4])
+  hdr.set_xyzt_units(*img.header.get_xyzt_units())
+  hdr.set_data_dtype(np.float32)
+  hdr.set_slope_inter(1, 0)
+  return hdr
+
+def uncrop_blocks(img,crop):
+  # series_blocks of a cropped image, padded with zeros to the acquisition grid
+  (x0, y0, z0), (nx, ny, nz) = crop['offset'], crop['size']
+  full = nib.load(crop['ref']).shape[:3]
+  for t0, t1, block in series_blocks(img):
+    out = np.zeros(full + (t1 - t0,), dtype=np.float32)
+    out[x0:x0 + nx, y0:y0 + ny, z0:z0 + nz] = block
+    yield t0, t1, out
+
+def uncrop_image(infile,outfile,crop):
+  # streams a cropped 3D/4D image back onto the acquisition grid
+  img = nib.load(infile, mmap=True)
+  write_series(outfile, uncrop_header(img, crop), (block for t0, t1, block in uncrop_blocks(img, crop)))
+
+def uncrop_matrices(regdir,crop):
+  """Rewrites the flirt matrices of a reg directory for the uncropped example_func.
+
+  Flirt works in scaled voxel coordinates with x flipped for neurological
+  (positive determinant) images, so the crop is a shift of
+  ((x0 or NX-x0-nx) * dx, y0 * dy, z0 * dz) from the full grid.
+  """
+  ref = nib.load(crop['ref'])
+  zooms = ref.header.get_zooms()[:3]
+  (x0, y0, z0), (nx, ny, nz) = crop['offset'], crop['size']
+  if np.linalg.det(ref.affine[:3, :3]) > 0:
+    x0 = ref.shape[0] - x0 - nx
+  shift = np.eye(4)
+  shift[:3, 3] = np.array([x0, y0, z0]) * zooms     # cropped = full - shift
+  for mat in glob.glob(regdir + '/*.mat'):
+    name = os.path.basename(mat)
+    m = np.loadtxt(mat)
+    if name.startswith('example_func2'):
+      m = m @ np.linalg.inv(shift)
+    elif name.endswith('2example_func.mat'):
+      m = shift @ m
+    else:
+      continue
+    np.savetxt(mat, m, fmt='%.10f', delimiter='  ')
+
+# ------------------------------------------------------------------------------
+#  On demand standard space resampling (--standard-space=lazy)
+# ------------------------------------------------------------------------------
+
+RESAMPLE_CACHE_VERSION = "1"   # bump to discard the cached standard space results
+
+def registration_dir(bold):
+  # published reg/ directory that belongs to a native space preproc series
+  name = re.sub(r'(_echo-[^_]+)?(_dir-[^_]+)?_space-native_desc-preproc_bold\.nii(\.gz)?$', '_reg', os.path.basename(bold))
+  return os.path.join(os.path.dirname(bold), name)
+
+def derivatives_root(path):
+  # fmripreproc derivatives directory containing a published file
+  return path[:re.search(r'/sub-[^/_]+/', path).start()]
+
+def resample_to_standard(bold,entry,mask=None,roi=None,chunk=50):
+  """Resamples a published native space series to standard space.
+
+  The series is cut into blocks of `chunk` volumes that are resampled in
+  parallel, so memory use does not grow with the run length. With `mask` the
+  result is masked; with `roi` (a label image) only the mean time series of each
+  label are kept (tsv). Results are cached in <derivatives>/cache/standard keyed
+  on the inputs, and the cached path is returned.
+  """
+  bold = os.path.abspath(bold)
+  regdir = registration_dir(bold)
+  with open(regdir + '/transforms.json') as f:
+    xfm = json.load(f)
+  mat = regdir + '/' + xfm['FuncToStandard']
+  std = xfm['Reference']
+  warp = None
+  if 'HighresToStandardWarp' in xfm:
+    mat = regdir + '/' + xfm['FuncToHighres']
+    warp = regdir + '/' + xfm['HighresToStandardWarp']
+
+  cachedir = derivatives_root(bold) + '/cache/standard'
+  os.makedirs(cachedir, exist_ok=True)
+  key = input_hash([bold, mat, std] + [x for x in (mask, roi, warp) if x], RESAMPLE_CACHE_VERSION, mask, roi)
+  base = re.sub(r'_space-native', '_space-MNI152Nonlin2006', os.path.basename(bold).split('.')[0])
+  out = cachedir + '/' + base + '_' + key[:12] + ('.tsv' if roi else '.nii.gz')
+  if os.path.exists(out):
+    print('Using cached standard space result: ' + out)
+    return out
+
+  nvols = nib.load(bold).shape[3]
+  tmp = tempfile.mkdtemp(dir=cachedir, prefix='.tmp-')
+  jobs = []
+  chunks = []
+  for t0 in range(0, nvols, chunk):
+    n = min(chunk, nvols - t0)
+    name = 'resample-' + base + '-' + str(t0).zfill(5)
+    chunks.append(tmp + '/' + str(t0).zfill(5))
+    cmd = "bash " + entry.templates + "/resample_chunk.sh " + bold + " " + str(t0) + " " + str(n) + " " + mat + " " + std + " " + chunks[-1] + " " + (mask or 'none') + " " + (roi or 'none') + " " + (warp or 'none')
+    jobs.append(Job(name, cmd))
+  if not roi:
+    jobs.append(Job('resample-' + base + '-merge', 'fslmerge -t ' + tmp + '/merged ' + ' '.join(chunks), after=[j.name for j in jobs]))
+
+  try:
+    if not run_jobs(jobs, entry):
+      raise Exception("Standard space resampling failed: " + bold)
+    if roi:
+      ts = np.vstack([np.loadtxt(c + '.txt', ndmin=2) for c in chunks])
+      df = pd.DataFrame(ts, columns=['roi_' + str(i + 1) for i in range(ts.shape[1])])
+      df.to_csv(tmp + '/merged.tsv', sep='\t', index=False)
+      os.replace(tmp + '/merged.tsv', out)
+    else:
+      os.replace(tmp + '/merged.nii.gz', out)
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+  print('Standard space result: ' + out)
+  return out
+
+def resample_main(argv):
+  # command line: fmripreproc_wrapper.py resample --bold=... [--mask=] [--roi=] [--chunk=] [--nprocs=]
+  try:
+    opts, args = getopt.getopt(argv, "h", ["help", "bold=", "mask=", "roi=", "chunk=", "nprocs="])
+  except getopt.GetoptError:
+    print_help()
+    sys.exit(2)
+  opts = dict(opts)
+  if '-h' in opts or '--help' in opts or '--bold' not in opts:
+    print_help()
+    sys.exit()
+
+  bold = os.path.abspath(opts['--bold'])
+  entry = types.SimpleNamespace(templates=os.path.dirname(os.path.abspath(__file__)) + '/fmripreproc_code',
+                                wd=derivatives_root(bold) + '/cache/standard',
+                                nprocs=int(opts.get('--nprocs', 0)), jobtimeout=None, failedjobs=[], jobresults={}, monitor=None)
+  return resample_to_standard(bold, entry, mask=opts.get('--mask'), roi=opts.get('--roi'),
+                              chunk=int(opts.get('--chunk', 50)))
+
+# ------------------------------------------------------------------------------
+#  QC Report
+# ------------------------------------------------------------------------------
+
+QC_CACHE_VERSION = "1"   # bump to force every thumbnail to be redrawn
+
+def write_png(filename,img):
+  # minimal 8-bit greyscale png writer so carpet plots do not need a plotting library
+  img = np.ascontiguousarray(img, dtype=np.uint8)
+  h, w = img.shape
+  raw = b''.join(b'\x00' + img[r].tobytes() for r in range(h))
+
+  def chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+  with open(filename, 'wb') as f:
+    f.write(b'\x89PNG\r\n\x1a\n')
+    f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 0, 0, 0, 0)))
+    f.write(chunk(b'IDAT', zlib.compress(raw, 6)))
+    f.write(chunk(b'IEND', b''))
+
+def carpet_plot(series,mask,outpng,maxrows=600,maxcols=800,chunk=32):
+  """Carpet plot streamed from a 4D series, a few volumes at a time"""
+
+  img = nib.load(series, mmap=True)
+  nvols = img.shape[3] if len(img.shape) > 3 else 1
+
+  # voxel rows: evenly spaced subset of the brain mask (fortran order matches nifti storage)
+  m = np.asarray(nib.load(mask).dataobj).reshape(-1, order='F') != 0
+  rows = np.flatnonzero(m)
+  if rows.size == 0:
+    raise Exception("Empty mask for carpet plot: " + mask)
+  rows = rows[np.linspace(0, rows.size - 1, min(maxrows, rows.size)).astype(int)]
+
+  carpet = np.zeros((rows.size, nvols), dtype=np.float32)
+  for t0 in range(0, nvols, chunk):
+    t1 = min(t0 + chunk, nvols)
+    block = np.asarray(img.dataobj[..., t0:t1], dtype=np.float32)
+    carpet[:, t0:t1] = block.reshape(-1, t1 - t0, order='F')[rows, :]
+
+  # bin time points down to the plot width
+  if nvols > maxcols:
+    edges = np.linspace(0, nvols, maxcols + 1).astype(int)
+    carpet = np.add.reduceat(carpet, edges[:-1], axis=1) / np.diff(edges)
+
+  # voxel-wise z-score, clipped at +/-2.5
+  carpet = carpet - carpet.mean(axis=1, keepdims=True)
+  sd = carpet.std(axis=1, keepdims=True)
+  sd[sd == 0] = 1
+  carpet = np.clip(carpet / sd, -2.5, 2.5)
+  write_png(outpng, (carpet + 2.5) / 5 * 255)
+
+def qc_commands(cmds,cwd):
+  # runs the fsl commands of a figure one by one, so any failure fails the figure
+  for cmd in cmds:
+    result = subprocess.run(cmd, shell=True, cwd=cwd, stdout=PIPE, stderr=PIPE)
+    if result.returncode != 0:
+      raise Exception(cmd.split()[0] + ' exited with ' + str(result.returncode) + ': ' + result.stderr.decode(errors='replace').strip())
+
+def qc_registration(infile,reffile,outpng):
+  # registration overlay mosaic (fsl slicer + pngappend)
+  tmp = tempfile.mkdtemp(dir=os.path.dirname(outpng))
+  slices = ['-x 0.35 sla.png', '-x 0.45 slb.png', '-x 0.55 slc.png', '-x 0.65 sld.png',
+            '-y 0.35 sle.png', '-y 0.45 slf.png', '-y 0.55 slg.png', '-y 0.65 slh.png',
+            '-z 0.35 sli.png', '-z 0.45 slj.png', '-z 0.55 slk.png', '-z 0.65 sll.png']
+  pngs = [x.split()[-1] for x in slices]
+  cmds = ["slicer " + infile + " " + reffile + " -s 2 " + " ".join(slices),
+          "pngappend " + " + ".join(pngs) + " " + outpng]
+  try:
+    qc_commands(cmds, tmp)
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+def qc_traces(confounds,parfile,outpng):
+  # motion estimates, FD and DVARS traces (fsl_tsplot)
+  tmp = tempfile.mkdtemp(dir=os.path.dirname(outpng))
+  df = pd.read_csv(confounds, sep='\t', index_col=0)
+  cmds = []
+  pngs = []
+  if os.path.exists(parfile):
+    cmds.append("fsl_tsplot -i " + parfile + " -t 'MCFLIRT estimated rotations (radians)' -u 1 --start=1 --finish=3 -a x,y,z -w 640 -h 144 -o rot.png")
+    cmds.append("fsl_tsplot -i " + parfile + " -t 'MCFLIRT estimated translations (mm)' -u 1 --start=4 --finish=6 -a x,y,z -w 640 -h 144 -o trans.png")
+    pngs += ['rot.png', 'trans.png']
+  for col, title in [('fd', 'Framewise displacement (mm)'), ('dvars', 'DVARS')]:
+    if col in df.columns:
+      np.savetxt(tmp + '/' + col + '.txt', df[col].fillna(0).values)
+      cmds.append("fsl_tsplot -i " + col + ".txt -t '" + title + "' -u 1 --start=1 --finish=1 -w 640 -h 144 -o " + col + ".png")
+      pngs.append(col + '.png')
+  cmds.append("pngappend " + " - ".join(pngs) + " " + outpng)
+  try:
+    qc_commands(cmds, tmp)
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+def qc_render(task):
+  """Render a single QC thumbnail (runs inside the report worker pool)"""
+
+  kind, inputs, outpng, key = task
+  try:
+    if kind == 'registration':
+      qc_registration(inputs[0], inputs[1], outpng)
+    elif kind == 'traces':
+      qc_traces(inputs[0], inputs[1], outpng)
+    elif kind == 'carpet':
+      carpet_plot(inputs[0], inputs[1], outpng)
+  except Exception as e:
+    print('QC figure failed: ' + os.path.basename(outpng) + ' (' + str(e) + ')')
+    return outpng, None
+  return outpng, key
+
+def generate_report(layout,entry):
   # generates a summary report of the preprocessing pipeline.
   # 1. registration quality (fsl images)
   # 2. outlier detection (plot)
-  # 3. carpet plot for each func? - before / after aroma?
+  # 3. carpet plot for each func - before / after aroma
   # 4. description of methods
+  #
+  # thumbnails are cached on a hash of their inputs, so re-running the report only
+  # redraws figures for runs that changed.
+
+  print("\nGenerating QC report...\n")
+  figdir = entry.outputs + '/fmripreproc/sub-' + entry.pid + '/figures'
+  os.makedirs(figdir, exist_ok=True)
+
+  cachefile = figdir + '/qc_cache.json'
+  cache = {}
+  if os.path.exists(cachefile):
+    with open(cachefile) as f:
+      cache = json.load(f)
+
+  tasks = []
+  runs = []
+  for func in layout.get(subject=entry.pid, space='native', desc='preproc', extension='nii.gz', suffix=['bold']):
+    ent = layout.parse_file_entities(func.path)
+    if 'run' in ent:
+      ent['run']=str(ent['run']).zfill(2)
+    name = run_key(ent)
+
+    regdir = entry.wd + '/reg/' + name + '/'
+    preproc = entry.wd + '/preproc/' + name
+    mask = preproc + '_SBRef_bet.nii.gz'
+    if not os.path.exists(mask):
+      mask = preproc + '_meanvol_bet.nii.gz'
+    aroma = entry.wd + '/aroma/aroma_classify/' + name + '/denoised_func_data_nonaggr.nii.gz'
+
+    figs = [('registration', 'func2highres', [regdir + 'example_func2highres.nii.gz', regdir + 'highres.nii.gz']),
+            ('registration', 'highres2standard', [regdir + 'highres2standard.nii.gz', (glob.glob(regdir + 'standard.nii*') or [regdir + 'standard.nii.gz'])[0]]),
+            ('traces', 'confounds', [preproc + '_confounds.tsv', preproc + '_mcf.par']),
+            ('carpet', 'carpet-preproc', [preproc + '_mcf.nii.gz', mask]),
+            ('carpet', 'carpet-aroma', [aroma, mask])]
+
+    rendered = []
+    for kind, label, inputs in figs:
+      if not os.path.exists(inputs[0]):
+        continue
+      png = name + '_' + label + '.png'
+      key = input_hash(inputs, QC_CACHE_VERSION, kind)
+      rendered.append((label, png))
+      if cache.get(png) == key and os.path.exists(figdir + '/' + png):
+        continue
+      tasks.append((kind, inputs, figdir + '/' + png, key))
+    runs.append((name, rendered))
+
+  print('QC figures to render: ' + str(len(tasks)) + ' (cached: ' + str(sum(len(r) for n, r in runs) - len(tasks)) + ')')
+
+  if tasks:
+    with multiprocessing.Pool(min(len(tasks), os.cpu_count() or 1)) as pool:
+      for png, key in pool.imap_unordered(qc_render, tasks):
+        if key:
+          cache[os.path.basename(png)] = key
+        else:
+          cache.pop(os.path.basename(png), None)
+
+  with open(cachefile, 'w') as f:
+    json.dump(cache, f, indent=2)
+
+  # html summary next to the subject derivatives
+  html = ['<html><head><title>fmripreproc: sub-' + entry.pid + '</title></head><body>',
+          '<h1>fmripreproc QC report: sub-' + entry.pid + '</h1>']
+  for name, rendered in runs:
+    html.append('<h2>' + name + '</h2>')
+    for label, png in rendered:
+      if png in cache:
+        html.append('<h3>' + label + '</h3><img src="sub-' + entry.pid + '/figures/' + png + '">')
+  html.append('<h2>Methods</h2><p>Carpet plots show a subsample of brain voxels (z-scored per voxel) '
+              'from the motion corrected series and, where available, the AROMA non-aggressive denoised series.</p>')
+  html.append('</body></html>')
+  with open(entry.outputs + '/fmripreproc/sub-' + entry.pid + '.html', 'w') as f:
+    f.write('\n'.join(html))
 
   return True
 
-
-  # generate snr tests...
-  # /projects/ics/software/fsl/6.0.3/bin/slicer highres2standard standard -s 2 -x 0.35 sla.png -x 0.45 slb.png -x 0.55 slc.png -x 0.65 sld.png -y 0.35 sle.png -y 0.45 slf.png -y 0.55 slg.png -y 0.65 slh.png -z 0.35 sli.png -z 0.45 slj.png -z 0.55 slk.png -z 0.65 sll.png ; /projects/ics/software/fsl/6.0.3/bin/pngappend sla.png + slb.png + slc.png + sld.png + sle.png + slf.png + slg.png + slh.png + sli.png + slj.png + slk.png + sll.png highres2standard1.png
-  # /projects/ics/software/fsl/6.0.3/bin/fsl_tsplot -i prefiltered_func_data_mcf.par -t 'MCFLIRT estimated translations (mm)' -u 1 --start=4 --finish=6 -a x,y,z -w 640 -h 144 -o trans.png
-   
-
+  ## end generate_report
 
 def run_cleanup(entry):
 
@@ -1037,63 +2681,1009 @@ def run_cleanup(entry):
     ## end run_cleanup
 
 
-def main(argv):
+# ------------------------------------------------------------------------------
+#  Sanity checks between stages
+# ------------------------------------------------------------------------------
+#
+#  After each stage its outputs are checked from headers and a sample of
+#  voxels. Failures are recorded in <wd>/failed/<stage>.json ({run key: reason},
+#  'subject' for the anatomy and fieldmaps); the failed runs are skipped by every
+#  downstream stage and a failed subject-level stage blocks its downstream stages.
+
+# defaults of --check-bbr-cost, --check-max-translation and --check-max-rotation
+CHECK_BBR_COST = 0.8          # epi_reg cost above which a registration is rejected
+CHECK_MAX_TRANSLATION = 15.0  # mm, mcflirt translations relative to the reference
+CHECK_MAX_ROTATION = 0.26     # radians (~15 degrees)
+
+def sample_volume(path,step=2):
+  # header and every step-th voxel of the first volume
+  img = nib.load(path)
+  idx = (slice(None, None, step),) * 3 + ((0,) if len(img.shape) > 3 else ())
+  return img, np.asarray(img.dataobj[idx], dtype=np.float32)
+
+def nvols(img):
+  return img.shape[3] if len(img.shape) > 3 else 1
+
+def check_image(path,mask=False):
+  """Reason the image is unusable, or None"""
+  if not os.path.exists(path):
+    return 'missing ' + os.path.basename(path)
+  try:
+    img, data = sample_volume(path, 1 if mask else 2)
+  except Exception as e:
+    return 'unreadable ' + os.path.basename(path) + ' (' + str(e) + ')'
+  if not np.isfinite(data).all():
+    return 'non-finite values in ' + os.path.basename(path)
+  if mask and not data.any():
+    return 'empty mask ' + os.path.basename(path)
+  return None
+
+def check_runs(layout,entry):
+  # (run key, raw bold) of every functional run
+  runs = []
+  for func in layout.get(subject=entry.pid, extension='nii.gz', suffix='bold', scope='raw'):
+    ent = layout.parse_file_entities(func.path)
+    if 'run' in ent:
+      ent['run']=str(ent['run']).zfill(2)
+    runs.append((run_key(ent), func))
+  return runs
+
+def check_bet(layout,entry):
+  t1bet = entry.wd + '/bet/t1bet/'
+  reason = check_image(t1bet + 'struc_acpc_brain_mask.nii.gz', mask=True) or check_image(t1bet + 'struc_acpc_brain.nii.gz')
+  return {'subject': reason} if reason else {}
+
+def check_topup(layout,entry):
+  for topupdir in sorted(glob.glob(entry.wd + '/topup-*')):
+    for field in ('topup4_field_APPA', 'topup4_field_PAAP'):
+      reason = check_image(topupdir + '/' + field + '.nii.gz')
+      if reason:
+        return {'subject': os.path.basename(topupdir) + ': ' + reason}
+  return {}
+
+def check_distcorrepi(layout,entry):
+  failed = {}
+  for key, func in check_runs(layout,entry):
+    if run_failed(entry, key, quiet=True):
+      continue
+    dc = entry.wd + '/distcorrepi/dc_' + func.filename
+    reason = check_image(dc)
+    if not reason and nib.load(dc).shape != nib.load(func.path).shape:
+      reason = 'dc_' + func.filename + ' shape ' + str(nib.load(dc).shape) + ' differs from the raw series'
+    if reason:
+      failed[key] = reason
+  return failed
+
+def check_preprocess(layout,entry):
+  failed = {}
+  for key, func in check_runs(layout,entry):
+    if run_failed(entry, key, quiet=True):
+      continue
+    mcf = entry.wd + '/preproc/' + key + '_mcf.nii.gz'
+    reason = check_image(mcf)
+    if not reason:
+      raw, img = nib.load(func.path), nib.load(mcf)
+      par = np.loadtxt(entry.wd + '/preproc/' + key + '_mcf.par', ndmin=2)
+      if nvols(img) != nvols(raw) - int(entry.trimvols):
+        reason = key + '_mcf has ' + str(nvols(img)) + ' volumes, expected ' + str(nvols(raw) - int(entry.trimvols)) + ' (--trimvols=' + str(entry.trimvols) + ')'
+      elif not np.isclose(img.header.get_zooms()[3], raw.header.get_zooms()[3], atol=1e-3):
+        reason = key + '_mcf TR ' + str(img.header.get_zooms()[3]) + ' differs from the raw series'
+      elif np.abs(par[:, 3:6]).max() > entry.checkmaxtrans:
+        reason = 'translation ' + str(round(np.abs(par[:, 3:6]).max(), 1)) + ' mm exceeds ' + str(entry.checkmaxtrans)
+      elif np.abs(par[:, :3]).max() > entry.checkmaxrot:
+        reason = 'rotation ' + str(round(np.abs(par[:, :3]).max(), 3)) + ' rad exceeds ' + str(entry.checkmaxrot)
+    if reason:
+      failed[key] = reason
+  return failed
+
+def check_registration(layout,entry):
+  failed = {}
+  for key, func in check_runs(layout,entry):
+    if run_failed(entry, key, quiet=True):
+      continue
+    regdir = entry.wd + '/reg/' + key + '/'
+    reason = None
+    for mat in ('example_func2highres.mat', 'example_func2standard.mat'):
+      if not os.path.exists(regdir + mat):
+        reason = 'missing ' + mat
+        break
+    if not reason:
+      m = np.loadtxt(regdir + 'example_func2highres.mat')
+      scales = np.linalg.svd(m[:3, :3], compute_uv=False)
+      if not np.isfinite(m).all() or scales.min() < 0.8 or scales.max() > 1.25:
+        reason = 'example_func2highres.mat is not a rigid transform (scales ' + str(np.round(scales, 2)) + ')'
+      elif os.path.exists(regdir + 'example_func2highres_cost.txt'):
+        with open(regdir + 'example_func2highres_cost.txt') as f:
+          cost = f.read().split()
+        if cost and float(cost[0]) > entry.checkbbrcost:
+          reason = 'epi_reg bbr cost ' + cost[0] + ' exceeds ' + str(entry.checkbbrcost)
+    if reason:
+      failed[key] = reason
+  return failed
+
+def check_snr(layout,entry):
+  failed = {}
+  for key, func in check_runs(layout,entry):
+    if run_failed(entry, key, quiet=True):
+      continue
+    reason = check_image(entry.wd + '/snr/' + key + '/snr_calc/' + key + '/snr2standard.nii.gz')
+    if reason:
+      failed[key] = reason
+  return failed
+
+def check_fast(layout,entry):
+  for n in range(3):
+    reason = check_image(entry.wd + '/segment/t1w_brain_seg_' + str(n) + '.nii.gz', mask=True)
+    if reason:
+      return {'subject': reason}
+  return {}
+
+def check_outliers(layout,entry):
+  failed = {}
+  for key, func in check_runs(layout,entry):
+    if run_failed(entry, key, quiet=True):
+      continue
+    prefix = entry.wd + '/preproc/' + key
+    expected = nvols(nib.load(prefix + '_mcf.nii.gz'))
+    reason = None
+    for metric in ('fd_metrics', 'dvars_metrics'):
+      if not os.path.exists(prefix + '_' + metric + '.tsv'):
+        reason = 'missing ' + key + '_' + metric + '.tsv'
+        break
+      values = np.loadtxt(prefix + '_' + metric + '.tsv', ndmin=1)
+      if len(values) != expected or not np.isfinite(values).all():
+        reason = key + '_' + metric + '.tsv has ' + str(len(values)) + ' values (expected ' + str(expected) + ' finite values)'
+        break
+    for tissue in ('wm', 'csf'):
+      if not reason and os.path.exists(prefix + '_' + tissue + '_func.nii.gz'):
+        reason = check_image(prefix + '_' + tissue + '_func.nii.gz', mask=True)
+    if reason:
+      failed[key] = reason
+  return failed
+
+def check_aroma(layout,entry,aromafile):
+  failed = {}
+  for key, func in check_runs(layout,entry):
+    if run_failed(entry, key, quiet=True):
+      continue
+    path = aromafile(key)
+    reason = check_image(path)
+    if not reason:
+      expected = nvols(nib.load(entry.wd + '/preproc/' + key + '_mcf.nii.gz'))
+      if nvols(nib.load(path)) != expected:
+        reason = os.path.basename(path) + ' has ' + str(nvols(nib.load(path))) + ' volumes, expected ' + str(expected)
+    if reason:
+      failed[key] = reason
+  return failed
+
+STAGE_CHECKS = {
+  'bet': check_bet,
+  'topup': check_topup,
+  'distcorrepi': check_distcorrepi,
+  'preprocess': check_preprocess,
+  'registration': check_registration,
+  'snr': check_snr,
+  'fast': check_fast,
+  'outliers': check_outliers,
+  'aroma-model': lambda layout, entry: check_aroma(layout, entry, lambda key: entry.wd + '/aroma/' + key + '_aroma_noHP.feat/filtered_func_data.nii.gz'),
+  'aroma-classify': lambda layout, entry: check_aroma(layout, entry, lambda key: entry.wd + '/aroma/aroma_classify/' + key + '/denoised_func_data_nonaggr.nii.gz'),
+}
+
+def failure_records(entry):
+  # {stage: {run key or 'subject': reason}}
+  records = {}
+  for f in glob.glob(entry.wd + '/failed/*.json'):
+    with open(f) as fp:
+      records[os.path.basename(f)[:-len('.json')]] = json.load(fp)
+  return records
+
+def upstream_stages(name):
+  return [stage for stage, run, save, after in STAGES if stage != name and name in downstream_stages([stage])]
+
+def run_failed(entry,key,quiet=False):
+  """True if the run failed a check in the current stage or upstream of it"""
+  stages = upstream_stages(entry.currentstage) + [entry.currentstage] if entry.currentstage else []
+  for stage, failed in failure_records(entry).items():
+    if stage in stages and key in failed:
+      if not quiet:
+        print('Skipping ' + key + ': failed ' + stage + ' check (' + failed[key] + ')')
+      return True
+  return False
+
+def record_failures(entry,name,failed):
+  # replaces the failure record of a stage
+  record = entry.wd + '/failed/' + name + '.json'
+  if os.path.exists(record):
+    os.remove(record)
+  if failed:
+    os.makedirs(entry.wd + '/failed', exist_ok=True)
+    write_json(record, failed)
+    for key, reason in failed.items():
+      print('CHECK FAILED [' + name + '] ' + key + ': ' + reason)
 
-  # get user entry
-  entry = parse_arguments(argv)
+# ------------------------------------------------------------------------------
+#  Pipeline stages
+# ------------------------------------------------------------------------------
+
+# (stage, run step, save step, upstream stages) in execution order
+STAGES = [
+  ('bet', run_bet, save_bet, []),
+  ('topup', run_topup, None, []),
+  ('distcorrepi', run_distcorrepi, None, ['topup']),
+  ('preprocess', run_preprocess, save_preprocess, ['bet', 'distcorrepi']),
+  ('registration', run_registration, save_registration, ['preprocess']),
+  ('snr', run_snr, save_snr, ['registration']),
+  ('fast', run_fast, save_fast, ['bet']),
+  ('outliers', run_outliers, save_outliers, ['preprocess', 'registration', 'fast']),
+  ('aroma-model', run_aroma_icamodel, None, ['preprocess']),
+  ('aroma-classify', run_aroma_classify, save_aroma_outputs, ['aroma-model']),
+  ('report', generate_report, None, ['registration', 'outliers', 'aroma-classify']),
+]
+
+# working and published outputs of each stage ({wd}: working directory, {out}: fmripreproc
+# derivatives, ** any session directory), removed when the stage is forced to run again
+STAGE_OUTPUTS = {
+  'bet': ['{wd}/bet', '{out}/sub-{pid}/**/anat/*_space-T1w_desc-brain_*', '{out}/sub-{pid}/**/anat/*_space-T1w_desc-head_T1w.nii.gz'],
+  'topup': ['{wd}/topup-*'],
+  'distcorrepi': ['{wd}/distcorrepi'],
+  'preprocess': ['{wd}/preproc', '{wd}/native', '{out}/sub-{pid}/**/func/*_space-native_desc-preproc_*'],
+  'registration': ['{wd}/reg', '{out}/sub-{pid}/**/func/*_space-MNI152Nonlin2006_desc-preproc_bold.*',
+                   '{out}/sub-{pid}/**/func/*_space-MNI152Nonlin2006_desc-preproc_sbref.*', '{out}/sub-{pid}/**/func/*_reg',
+                   '{out}/sub-{pid}/**/anat/*_space-MNI152Nonlin2006_desc-brain_*'],
+  'snr': ['{wd}/snr', '{out}/sub-{pid}/**/func/*_space-MNI152Nonlin2006_desc-preproc_snr.nii.gz'],
+  'outliers': ['{wd}/preproc/*_fd_*', '{wd}/preproc/*_dvars_*', '{wd}/preproc/*_confounds.tsv', '{wd}/preproc/*_outlier_detection.log',
+               '{wd}/preproc/*_csf_func.nii.gz', '{wd}/preproc/*_wm_func.nii.gz', '{wd}/preproc/*_brain_func.nii.gz',
+               '{out}/sub-{pid}/**/func/*_desc-preproc_confounds.tsv'],
+  'fast': ['{wd}/segment'] + ['{out}/sub-{pid}/**/anat/*_space-T1w_desc-' + t + '_mask.nii.gz' for t in ('whitematter', 'greymatter', 'csf')],
+  'aroma-model': ['{wd}/aroma'],
+  'aroma-classify': ['{wd}/aroma/aroma_classify', '{out}/sub-{pid}/**/func/*_desc-smoothAROMAnonaggr_bold.*'],
+  'report': ['{out}/sub-{pid}/figures/qc_cache.json'],
+}
+
+def downstream_stages(names):
+  # names plus every stage that depends on them (STAGES is in dependency order)
+  closure = set(names)
+  for name, run, save, after in STAGES:
+    if closure & set(after):
+      closure.add(name)
+  return closure
+
+def stage_names(entry):
+  return [name for name, run, save, after in STAGES
+          if (name != 'report' or entry.runQC) and (entry.stages is None or name in entry.stages)]
+
+def invalidate_stages(entry):
+  """Removes the working and published outputs of the forced stages; upstream results are kept"""
+  for name in stage_names(entry):
+    if name not in entry.forcestages:
+      continue
+    for pattern in STAGE_OUTPUTS[name]:
+      for path in glob.glob(pattern.format(wd=entry.wd, out=entry.outputs + '/fmripreproc', pid=entry.pid), recursive=True):
+        print('Invalidating ' + name + ': ' + path)
+        if os.path.isdir(path) and not os.path.islink(path):
+          shutil.rmtree(path)
+        else:
+          os.remove(path)
+
+def run_stage(name,layout,entry):
+  """Runs one stage for entry.pid, checks and publishes its outputs.
+
+  Returns False if any job failed or a subject-level check failed (here or
+  upstream). Runs failing their checks are recorded and skipped downstream.
+  """
+  records = failure_records(entry)
+  blocked = [stage for stage in upstream_stages(name) if 'subject' in records.get(stage, {})]
+  if blocked:
+    print('Skipping ' + name + ': ' + ', '.join(blocked) + ' failed its check (' + records[blocked[0]]['subject'] + ')')
+    return False
+
+  nfailed = len(entry.failedjobs)
+  entry.currentstage = name
+  if entry.monitor:
+    entry.monitor.begin_stage(entry.pid, name)
+  record_failures(entry, name, {})
+  try:
+    for stage, run, save, after in STAGES:
+      if stage == name:
+        run(layout, entry)
+        failed = STAGE_CHECKS[name](layout, entry) if name in STAGE_CHECKS else {}
+        record_failures(entry, name, failed)
+        if save and 'subject' not in failed:
+          save(layout, entry)
+  finally:
+    entry.currentstage = None
+
+  # add derivatives to bids object
+  if name == 'preprocess':
+    add_derivatives(layout, entry)
+
+  ok = len(entry.failedjobs) == nfailed and 'subject' not in failed
+  if entry.monitor:
+    entry.monitor.end_stage(ok)
+  return ok
+
+def run_pipeline(layout,entry):
+  # pipeline: (1) BET, (2) topup, (3) distortion correction, (4) mcflirt, ...
+  for name in stage_names(entry):
+    run_stage(name, layout, entry)
+
+  for stage, failed in failure_records(entry).items():
+    for key, reason in failed.items():
+      print('Failed check [' + stage + '] ' + key + ': ' + reason + ' (downstream stages skipped)')
+
+# ------------------------------------------------------------------------------
+#  Work queue: any number of instances (one node or many) sharing <outputs>
+# ------------------------------------------------------------------------------
+
+class FileLock:
+  """Exclusive lockf() lock on a file in the shared output directory"""
+  def __init__(self, filename):
+    self.filename = filename
+
+  def __enter__(self):
+    self.f = open(self.filename, 'a')
+    fcntl.lockf(self.f, fcntl.LOCK_EX)
+    return self
+
+  def __exit__(self, *exc):
+    fcntl.lockf(self.f, fcntl.LOCK_UN)
+    self.f.close()
+
+class WorkQueue:
+  """(subject, stage) work items stored as files in <outputs>/fmripreproc/queue.
+
+  items/<id>.json   item description (created once, enqueue is idempotent)
+  items/<id>.claim  owner of a running item; its mtime is the owner's heartbeat
+  items/<id>.done   finished successfully
+  items/<id>.failed number of failed attempts
+  All state changes happen while holding queue.lock.
+  """
+  def __init__(self, qdir, stale=600, maxattempts=2):
+    self.qdir = qdir
+    self.items = qdir + '/items'
+    self.stale = stale
+    self.maxattempts = maxattempts
+    os.makedirs(self.items, exist_ok=True)
+    self.lock = FileLock(qdir + '/queue.lock')
+
+  def path(self, item, ext):
+    return self.items + '/' + item['id'] + '.' + ext
+
+  def enqueue(self, subject, stages):
+    with self.lock:
+      for order, (name, run, save, after) in enumerate(STAGES):
+        if name not in stages:
+          continue
+        item = {'id': 'sub-' + subject + '_' + name, 'subject': subject, 'stage': name,
+                'after': [a for a in after if a in stages], 'order': order}
+        if not os.path.exists(self.path(item, 'json')):
+          write_json(self.path(item, 'json'), item)
+
+  def attempts(self, item):
+    if not os.path.exists(self.path(item, 'failed')):
+      return 0
+    with open(self.path(item, 'failed')) as f:
+      return int(f.read().split()[0])
+
+  def set_attempts(self, item, n):
+    with open(self.path(item, 'failed'), 'w') as f:
+      f.write(str(n) + '\n')
+
+  def state(self, item, items):
+    # done, failed (permanently), blocked (by a failed upstream stage), claimed, waiting or ready
+    if os.path.exists(self.path(item, 'done')):
+      return 'done'
+    if self.attempts(item) >= self.maxattempts:
+      return 'failed'
+    deps = [items[item['subject'], a] for a in item['after'] if (item['subject'], a) in items]
+    depstates = [self.state(d, items) for d in deps]
+    if any(d in ('failed', 'blocked') for d in depstates):
+      return 'blocked'
+    if os.path.exists(self.path(item, 'claim')):
+      try:
+        if time.time() - os.path.getmtime(self.path(item, 'claim')) < self.stale:
+          return 'claimed'
+      except FileNotFoundError:
+        pass
+      return 'abandoned'
+    if any(d != 'done' for d in depstates):
+      return 'waiting'
+    return 'ready'
+
+  def load(self):
+    items = {}
+    for f in glob.glob(self.items + '/*.json'):
+      with open(f) as fh:
+        item = json.load(fh)
+      items[item['subject'], item['stage']] = item
+    return items
+
+  def claim(self, worker):
+    """Claims the next runnable item. Returns (item, finished)."""
+    with self.lock:
+      items = self.load()
+      states = {k: self.state(v, items) for k, v in items.items()}
+      for k in sorted(items, key=lambda k: (items[k]['order'], k[0])):
+        item = items[k]
+        if states[k] == 'abandoned':
+          # owner stopped heart-beating (crashed or lost its node): count it as a failed attempt
+          print('Queue: reclaiming abandoned item ' + item['id'])
+          self.set_attempts(item, self.attempts(item) + 1)
+          os.remove(self.path(item, 'claim'))
+          if self.attempts(item) >= self.maxattempts:
+            continue
+        elif states[k] != 'ready':
+          continue
+        with open(self.path(item, 'claim'), 'w') as f:
+          f.write(worker + '\n')
+        return item, False
+      finished = all(st in ('done', 'failed', 'blocked') for st in states.values())
+      return None, finished
+
+  def owner(self, item):
+    try:
+      with open(self.path(item, 'claim')) as f:
+        return f.read().strip()
+    except FileNotFoundError:
+      return None
+
+  def heartbeat(self, item, worker):
+    # keep touching the claim file while the item runs
+    stop = threading.Event()
+
+    def beat():
+      # stops once the claim is gone or reclaimed: finish() then discards the result
+      while not stop.wait(max(self.stale / 4, 1)):
+        try:
+          if self.owner(item) != worker:
+            break
+          os.utime(self.path(item, 'claim'))
+        except FileNotFoundError:
+          break
+      if not stop.is_set():
+        print('Queue: lost the claim on ' + item['id'] + ', its result will be discarded')
+
+    threading.Thread(target=beat, daemon=True).start()
+    return stop
+
+  def finish(self, item, worker, ok):
+    with self.lock:
+      if self.owner(item) != worker:
+        print('Queue: ' + item['id'] + ' was reclaimed by another worker, result discarded')
+        return
+      if ok:
+        open(self.path(item, 'done'), 'w').close()
+      else:
+        self.set_attempts(item, self.attempts(item) + 1)
+      os.remove(self.path(item, 'claim'))
+
+def subject_entry(entry,subject):
+  # copy of the user entry for one subject (own working directory)
+  sub = copy.copy(entry)
+  sub.pid = subject
+  sub.failedjobs = []
+  sub.jobresults = {}
+  if entry.wdbase:
+    sub.wd = entry.wdbase + '/sub-' + subject
+  else:
+    sub.wd = entry.outputs + '/fmripreproc/scratch/sub-' + subject
+  os.makedirs(sub.wd + '/logs', mode=511, exist_ok=True)
+  return sub
+
+def run_queue(entry,poll=30,layout=None):
+  """Worker loop: pull (subject, stage) items from the shared queue until it is drained"""
+
+  layout = bids_data(entry, layout)
+  queue = WorkQueue(entry.outputs + '/fmripreproc/queue', stale=entry.queuestale)
+
+  subjects = entry.pid.split(',') if entry.pid else layout.get_subjects()
+  for subject in subjects:
+    queue.enqueue(subject, stage_names(entry))
+
+  worker = socket.gethostname() + ':' + str(os.getpid())
+  print('Queue worker ' + worker + ': ' + str(len(subjects)) + ' subject(s) enqueued')
+
+  scratch = entry.wdbase or entry.outputs + '/fmripreproc/scratch'
+  monitor = start_monitor(entry, queue.qdir + '/status/' + worker.replace(':', '-') + '.json', scratch)
+
+  while True:
+    item, finished = queue.claim(worker)
+    if item is None:
+      if finished:
+        break
+      time.sleep(poll)
+      continue
+
+    print('\nQueue: ' + worker + ' running ' + item['id'])
+    sub = subject_entry(entry, item['subject'])
+    stop = queue.heartbeat(item, worker)
+    ok = False
+    try:
+      if item['order'] > [s[0] for s in STAGES].index('preprocess'):
+        add_derivatives(layout, sub)
+      ok = run_stage(item['stage'], layout, sub)
+    except Exception as e:
+      print('Queue: ' + item['id'] + ' failed: ' + str(e))
+    finally:
+      stop.set()
+      queue.finish(item, worker, ok)
+
+  print('Queue drained: worker ' + worker + ' exiting')
+  if monitor:
+    monitor.close()
+
+# ------------------------------------------------------------------------------
+#  Watch mode: process runs as they land in the BIDS directory
+# ------------------------------------------------------------------------------
+
+class DirWatcher:
+  """Blocks until something changes in the subject directory.
+
+  Uses inotify through libc (the bids root and every directory below the
+  subject); falls back to polling dataset_signature where inotify is missing
+  or out of watches.
+  """
+  MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200   # modify, attrib, close_write, moved_from/to, create, delete
+
+  def __init__(self, root, subdir, poll=10):
+    self.root = root
+    self.subdir = subdir
+    self.poll = poll
+    self.fd = None
+    try:
+      self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+      fd = self.libc.inotify_init1(os.O_CLOEXEC)
+      if fd >= 0:
+        self.fd = fd
+    except (OSError, AttributeError):
+      pass
+    if self.fd is None:
+      print('Watch: inotify unavailable, polling every ' + str(poll) + 's')
+
+  def add_watches(self):
+    # re-adding an existing watch is a no-op, so new directories are simply picked up here
+    dirs = [self.root] + [root for root, d, f in os.walk(self.subdir)]
+    for d in dirs:
+      if self.libc.inotify_add_watch(self.fd, d.encode(), self.MASK) < 0:
+        print('Watch: cannot watch ' + d + ' (' + os.strerror(ctypes.get_errno()) + '), polling instead')
+        os.close(self.fd)
+        self.fd = None
+        return
+
+  def signature(self):
+    if os.path.isdir(self.subdir):
+      return dataset_signature(self.subdir)
+    return str(sorted(os.listdir(self.root)))
+
+  def wait(self, timeout=None):
+    if self.fd is not None:
+      self.add_watches()
+    if self.fd is not None:
+      if select.select([self.fd], [], [], timeout)[0]:
+        time.sleep(1)   # let a burst of events arrive, then drain them all
+        while select.select([self.fd], [], [], 0)[0]:
+          os.read(self.fd, 65536)
+      return
+    start = self.signature()
+    deadline = time.time() + timeout if timeout is not None else None
+    while deadline is None or time.time() < deadline:
+      time.sleep(self.poll if deadline is None else max(min(self.poll, deadline - time.time()), 0))
+      if self.signature() != start:
+        return
+
+def input_sets(subdir,stable):
+  """Splits the subject's files into complete input sets and everything else.
+
+  stable: {path: bool} for every file below subdir.
+  Returns (complete files, {'t1w', 'fmap', 'bold'}: number of complete sets).
+  T1w set: the image and its sidecars. Fieldmap pair: AP + PA images and
+  sidecars. BOLD set: every file sharing the run prefix (bold image + json,
+  sbref when the subject has any, events ...), and a complete fieldmap pair
+  must list the run in IntendedFor.
+  """
+  def members(prefix):
+    return [p for p in stable if p.startswith(prefix + '_') or p.startswith(prefix + '.')]
+
+  complete = set()
+  counts = {'t1w': 0, 'fmap': 0, 'bold': 0}
+
+  for p in stable:
+    if '/anat/' in p and p.endswith('_T1w.nii.gz'):
+      files = members(p[:-len('.nii.gz')])
+      if all(stable[f] for f in files):
+        complete.update(files)
+        counts['t1w'] += 1
+
+  pairs = {}
+  for p in stable:
+    if '/fmap/' in p and p.endswith('_epi.nii.gz'):
+      pairs.setdefault(re.sub(r'_dir-[^_/]+', '', p), []).append(p)
+  intended = set()
+  for images in pairs.values():
+    dirs = sorted(re.search(r'_dir-([^_/]+)', os.path.basename(p)).group(1) for p in images)
+    files = [f for p in images for f in (p, p[:-len('.nii.gz')] + '.json') if f in stable]
+    if len(dirs) != 2 or not any('AP' in d for d in dirs) or not any('PA' in d for d in dirs):
+      continue
+    if not all(stable[f] for f in files):
+      continue
+    for f in files:
+      if f.endswith('.json'):
+        with open(f) as fh:
+          intended.update(os.path.basename(i) for i in json.load(fh).get('IntendedFor', []))
+    complete.update(files)
+    counts['fmap'] += 1
+
+  usesbref = any(p.endswith('_sbref.nii.gz') for p in stable)
+  for p in stable:
+    if '/func/' in p and p.endswith('_bold.nii.gz'):
+      prefix = p[:-len('_bold.nii.gz')]
+      files = members(prefix)
+      need = [p, prefix + '_bold.json'] + ([prefix + '_sbref.nii.gz'] if usesbref else [])
+      if all(f in stable for f in need) and all(stable[f] for f in files) and os.path.basename(p) in intended:
+        complete.update(files)
+        counts['bold'] += 1
+
+  return complete, counts
+
+def watch_stages(entry,counts):
+  # stages whose inputs are complete: distortion correction can start before the T1w is in
+  ready = {'bet': counts['t1w'], 'fast': counts['t1w'], 'topup': counts['fmap'], 'distcorrepi': counts['bold']}
+  return [name for name in stage_names(entry) if ready.get(name, counts['t1w'] and counts['bold'])]
+
+def watch_group(subdir,path):
+  # unit of work in watch mode: 'anat' (subject level), a session, or None without sessions
+  rel = os.path.relpath(path, subdir).split('/')
+  if 'anat' in rel[:-1]:
+    return 'anat'
+  return rel[0] if rel[0].startswith('ses-') and len(rel) > 1 else None
+
+def run_watch(entry):
+  """Processes a subject while its session is still being converted.
+
+  Every change below sub-<pid> triggers a rescan; files count as stable once
+  unchanged for --watch-settle seconds. Whenever the complete inputs of the
+  anatomy or of a session change (or more stages become ready for them), the
+  layout is re-indexed and the ready stages run again for those only: files of
+  other sessions are left out of the index, and bet/fast are skipped while the
+  T1w is unchanged. Stops after --watch-idle seconds without new complete inputs.
+  """
+  subdir = os.path.abspath(entry.inputs) + '/sub-' + entry.pid
+  watcher = DirWatcher(os.path.abspath(entry.inputs), subdir)
+  seen = {}            # path: (size, mtime, unchanged since)
+  processed = {}       # watch_group: (complete files with size and mtime, stages run)
+  lastnew = time.time()
+  first = True
+
+  while True:
+    now = time.time()
+    files = {}
+    for root, dirs, names in os.walk(subdir):
+      for name in names:
+        path = os.path.join(root, name)
+        try:
+          st = os.stat(path)
+        except FileNotFoundError:
+          continue
+        key = (st.st_size, st.st_mtime)
+        if path not in seen or seen[path][:2] != key:
+          # files already in place at startup count from their mtime
+          seen[path] = key + (min(st.st_mtime, now) if first else now,)
+        files[path] = now - seen[path][2] >= entry.watchsettle
+    seen = {p: v for p, v in seen.items() if p in files}
+    first = False
+
+    complete, counts = input_sets(subdir, files)
+    stages = watch_stages(entry, counts)
+    groups = {}
+    for p in sorted(complete):
+      groups.setdefault(watch_group(subdir, p), []).append((p, seen[p][:2]))
+    todo = [g for g in groups if g not in processed or processed[g][0] != groups[g] or not set(stages) <= processed[g][1]]
+    if todo and stages:
+      run = [name for name in stages if name not in ('bet', 'fast') or 'anat' in todo]
+      print('\nWatch: ' + str(counts['bold']) + ' complete bold run(s), ' + str(counts['fmap']) + ' fieldmap pair(s), '
+            + str(counts['t1w']) + ' T1w: running ' + ', '.join(run) + ' for ' + ', '.join(str(g or 'the subject') for g in todo))
+      # the T1w stays indexed: every session registers to it
+      ignore = [p for p in files if p not in complete or watch_group(subdir, p) not in todo + ['anat']]
+      try:
+        layout = bids_data(entry, ignore=ignore)
+        for name in run:
+          run_stage(name, layout, entry)
+      except Exception as e:
+        print('Watch: ' + str(e) + ' (retrying when more inputs arrive)')
+      for g in todo:
+        processed[g] = (groups[g], set(stages))
+      lastnew = time.time()
+
+    pending = [p for p in files if p not in complete]
+    if pending:
+      print('Watch: waiting for ' + str(len(pending)) + ' incomplete input file(s)')
+    idle = entry.watchidle - (time.time() - lastnew) if entry.watchidle else None
+    if idle is not None and idle <= 0:
+      print('Watch: no new inputs for ' + str(entry.watchidle) + 's, exiting')
+      return
+    # unstable files: look again once they may have settled
+    timeout = entry.watchsettle / 2 if not all(files.values()) else None
+    if idle is not None:
+      timeout = idle if timeout is None else min(timeout, idle)
+    watcher.wait(timeout)
+
+# ------------------------------------------------------------------------------
+#  Serve mode: long running daemon with a warm BIDS index (fmripreproc_client.py)
+# ------------------------------------------------------------------------------
+
+def dataset_signature(inputs,files=True):
+  """Changes whenever a file is added, removed or rewritten in the raw dataset.
+
+  With files=False only the directories and the top level files are stat'ed: a
+  cheap check that still sees files added, removed or renamed into place, and
+  edits of the dataset wide sidecars.
+  """
+  sig = hashlib.sha1()
+  for root, dirs, names in os.walk(inputs):
+    dirs[:] = sorted(d for d in dirs if d not in ('derivatives', 'sourcedata', 'code') and not d.startswith('.'))
+    for name in [''] + (sorted(names) if files or root == inputs else []):
+      st = os.stat(os.path.join(root, name))
+      sig.update((os.path.join(root, name) + ':' + str(st.st_size) + ':' + str(st.st_mtime_ns) + '\n').encode())
+  return sig.hexdigest()
+
+def request_inputs(argv,cwd):
+  # --in of a request, without parsing the rest of it
+  for i, arg in enumerate(argv):
+    if arg in ('-i', '--in') and i + 1 < len(argv):
+      return os.path.abspath(os.path.join(cwd, argv[i + 1]))
+    if arg.startswith('--in=') or (arg.startswith('-i') and len(arg) > 2 and not arg.startswith('--')):
+      return os.path.abspath(os.path.join(cwd, arg.split('=', 1)[1] if arg.startswith('--') else arg[2:]))
+  return None
+
+def default_index_dir():
+  # pybids databases of the datasets indexed by the server
+  return os.environ.get('FMRIPREPROC_INDEX', os.environ.get('TMPDIR', '/tmp') + '/fmripreproc-index-' + str(os.getuid()))
+
+class PipelineServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+  """Accepts pipeline requests on a unix socket.
+
+  A request is one json line {"argv": [...], "cwd": ...} with the same arguments
+  as the command line. The daemon reads it, makes sure the index of --in and the
+  template assets are warm, and forks: the child inherits them with the imports,
+  parses the request in the client's cwd and runs the pipeline with its
+  stdout/stderr connected to the client, finishing with an exit status line.
+  Closing the client cancels the request (running jobs are killed).
+
+  The index is a pybids database per dataset (index_dir/<dataset>-<signature>),
+  kept open by the daemon while a cheap dataset_signature check (directories
+  only) is unchanged. Otherwise the full signature names the database to open,
+  built first if no daemon has indexed that state of the dataset yet; only then
+  does the accept loop wait.
+  """
+  block_on_close = False
+  EXIT = '\0fmripreproc-exit '
+
+  def __init__(self, path, maxrequests=4, indexdir=None):
+    self.indexdir = indexdir or default_index_dir()
+    self.max_children = maxrequests
+    self.layouts = {}   # inputs: (cheap signature, database, layout)
+    self.assets = None
+    os.makedirs(self.indexdir, mode=0o700, exist_ok=True)
+    socketserver.UnixStreamServer.__init__(self, path, None)
+
+  def layout(self, inputs):
+    # layout of the dataset, from the warm cache while its directories are unchanged
+    stamp = dataset_signature(inputs, files=False)
+    cached = self.layouts.get(inputs)
+    if cached and cached[0] == stamp and os.path.exists(cached[1] + '/layout_index.sqlite'):
+      return cached[2]
+    dataset = self.indexdir + '/' + hashlib.sha1(inputs.encode()).hexdigest()[:12]
+    db = dataset + '-' + dataset_signature(inputs)[:12]
+    bids.config.set_option('extension_initial_dot', True)
+    with FileLock(dataset + '.lock'):
+      if not os.path.exists(db + '/layout_index.sqlite'):
+        print('Serve: indexing ' + inputs)
+        tmp = db + '.' + str(os.getpid()) + '.tmp'
+        bids.BIDSLayout(inputs, derivatives=False).save(tmp)
+        os.replace(tmp, db)
+        for old in glob.glob(dataset + '-*'):
+          if old != db:
+            shutil.rmtree(old, ignore_errors=True)   # open connections keep their (unlinked) file
+    layout = bids.BIDSLayout(inputs, derivatives=False, database_path=db)
+    layout.connection_manager.session.close()   # no sqlite connection shared with the children
+    self.layouts[inputs] = (stamp, db, layout)
+    return layout
+
+  def templates(self):
+    # template assets of the default --template-cache, rebuilt if it was cleaned up
+    if not self.assets or not all(os.path.exists(p) for p in self.assets.values() if p.endswith('.nii')):
+      self.assets = template_assets(types.SimpleNamespace(templatecache=None))
+    return self.assets
+
+  def process_request(self, request, client_address):
+    # parent: read the request and warm its dataset before forking
+    try:
+      request.settimeout(10)
+      self.req = json.loads(request.makefile('rb').readline())
+      request.settimeout(None)
+      inputs = request_inputs(self.req['argv'], self.req.get('cwd', '/'))
+    except Exception as e:
+      self.req = e   # reported to the client by the child
+    else:
+      try:
+        if inputs and os.path.isdir(inputs):
+          self.layout(inputs)
+          self.templates()
+      except Exception as e:
+        print('Serve: cannot prepare ' + inputs + ' (' + str(e) + ')')   # the child tries again
+    socketserver.ForkingMixIn.process_request(self, request, client_address)
+
+  def finish_request(self, request, client_address):
+    # child: run the request with output streamed to the client
+    self.socket.close()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1)
+    status = None
+    try:
+      if isinstance(self.req, Exception):
+        raise self.req
+      req = self.req
+      argv = req['argv']
+      print('Serve: request ' + ' '.join(argv))
+      sys.stdout.flush()
+    except Exception as e:
+      request.sendall(('Error: bad request (' + str(e) + ')\n' + self.EXIT + '2\n').encode())
+      return
+    os.dup2(request.fileno(), 1)
+    os.dup2(request.fileno(), 2)
+    sys.stdout.reconfigure(line_buffering=True)
+    signal.signal(signal.SIGINT, signal.default_int_handler)   # ignored if the daemon runs in the background
+    finished = threading.Event()
+    closed = threading.Event()
+
+    def hangup():
+      # the client never sends more data: EOF means it went away
+      request.recv(1)
+      if not finished.is_set():
+        closed.set()
+        os.dup2(saved, 1)
+        os.dup2(saved, 2)
+        print('Serve: client closed, cancelling ' + ' '.join(argv))
+        os.kill(os.getpid(), signal.SIGINT)
+
+    threading.Thread(target=hangup, daemon=True).start()
+    entry, layout = None, None
+    try:
+      os.chdir(req.get('cwd', '/'))
+      if argv[:1] not in (['resample'], ['metrics'], ['serve']):
+        entry = parse_arguments(argv)
+        inputs = os.path.abspath(entry.inputs)
+        layout = self.layouts[inputs][2] if inputs in self.layouts else self.layout(inputs)
+        if entry.templatecache is None:
+          entry.assets = self.templates()
+    except SystemExit as e:
+      status = e.code if isinstance(e.code, int) else 2
+    except KeyboardInterrupt:
+      status = 130
+    except Exception as e:
+      print('Error: ' + str(e))
+      status = 2
+    if status is None:
+      status = 0
+      try:
+        if argv[:1] == ['resample']:
+          resample_main(argv[1:])
+        elif argv[:1] == ['metrics']:
+          metrics_main(argv[1:])
+        elif argv[:1] == ['serve']:
+          raise Exception('serve: requests cannot start another server')
+        else:
+          run_entry(entry, layout)
+          status = 1 if entry.failedjobs else 0
+      except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+      except KeyboardInterrupt:
+        status = 130
+      except Exception:
+        traceback.print_exc()
+        status = 1
+    finished.set()
+    if not closed.is_set():
+      print(self.EXIT + str(status))
+
+def serve_main(argv):
+  """fmripreproc serve [--socket=] [--max-requests=] [--index-dir=]"""
+
+  path = default_socket()
+  maxrequests = 4
+  indexdir = None
+  try:
+    opts, args = getopt.getopt(argv, "h", ["help", "socket=", "max-requests=", "index-dir="])
+  except getopt.GetoptError:
+    print_help()
+    sys.exit(2)
+  for opt, arg in opts:
+    if opt in ("-h", "--help"):
+      print_help()
+      sys.exit()
+    elif opt in ("--socket"):
+      path = arg
+    elif opt in ("--max-requests"):
+      maxrequests = int(arg)
+    elif opt in ("--index-dir"):
+      indexdir = arg
+
+  if os.path.exists(path):
+    try:
+      with socket.socket(socket.AF_UNIX) as probe:
+        probe.connect(path)
+      raise Exception('serve: a server is already listening on ' + path)
+    except ConnectionRefusedError:
+      os.remove(path)   # left over from a server that did not shut down
+
+  def stop(signum, frame):
+    raise KeyboardInterrupt
+
+  signal.signal(signal.SIGTERM, stop)
+  oldmask = os.umask(0o077)   # socket only usable by this user
+  server = PipelineServer(path, maxrequests, indexdir)
+  os.umask(oldmask)
+  print('Serve: listening on ' + path)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    print('Serve: shutting down')
+  finally:
+    for pid in server.active_children or ():
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except ProcessLookupError:
+        pass
+    server.server_close()
+    os.remove(path)
+
+def run_entry(entry,layout=None):
+
+  if entry.queue:
+    run_queue(entry, layout=layout)
+    return
 
   os.makedirs(entry.wd, mode=511, exist_ok=True)
   logdir = entry.wd + '/logs'
 
   os.makedirs(logdir, mode=511, exist_ok=True)
 
-  # get participant bids path:
-  bids = bids_data(entry)
-
-  # pipeline: (1) BET, (2) topup, (3) distortion correction, (4) mcflirt
-  # bet
-  if run_bet(bids,entry):
-    save_bet(bids,entry)
-
-  # distortion correction
-  run_topup(bids,entry)
-  run_distcorrepi(bids,entry)
+  invalidate_stages(entry)
 
-  # motion correction + trim
-  if run_preprocess(bids,entry):
-    save_preprocess(bids,entry)
+  monitor = start_monitor(entry, entry.wd + '/status.json', entry.wd)
+  try:
+    if entry.watch:
+      # indexed by run_watch as inputs become complete
+      run_watch(entry)
+    else:
+      # get participant bids path:
+      bids = bids_data(entry, layout)
+      run_pipeline(bids,entry)
+  finally:
+    if monitor:
+      monitor.close()
 
-  # add derivatives to bids object
-  bids.add_derivatives(entry.outputs + '/fmripreproc/')
-
-  # registration
-  if run_registration(bids,entry):
-    save_registration(bids,entry)
-
-  # snr
-  if run_snr(bids,entry):
-    save_snr(bids,entry)
-
-  # generate confounds
-  run_outliers(bids,entry)
-  save_outliers(bids,entry)
-
-  # fast
-  if run_fast(bids,entry):
-    save_fast(bids,entry)
-
-  # aroma
-  if run_aroma_icamodel(bids,entry) or run_aroma_classify(bids,entry):
-    save_aroma_outputs(bids,entry)
-
-  save_bet(bids,entry)
-  save_preprocess(bids,entry)
-  save_registration(bids,entry)
-  save_snr(bids,entry)
-  save_fast(bids,entry)
-  save_aroma_outputs(bids,entry)
   # clean-up
   # run_cleanup(entry)
+
+def main(argv):
+
+  # other commands
+  if argv[:1] == ['resample']:
+    resample_main(argv[1:])
+    return
+  if argv[:1] == ['metrics']:
+    metrics_main(argv[1:])
+    return
+  if argv[:1] == ['serve']:
+    serve_main(argv[1:])
+    return
+
+  # get user entry
+  entry = parse_arguments(argv)
+
+  run_entry(entry)
     
 __version__ = "0.0.2"  # version is needed for packaging
 
@@ -0,0 +1,17 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+WRAPPER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fmripreproc_wrapper.py')
+
+@pytest.fixture(scope='session')
+def wrapper():
+  # fmripreproc_wrapper.py is a script, not a package: load it as a module
+  # (it imports fmripreproc_client from its own directory)
+  sys.path.insert(0, os.path.dirname(WRAPPER))
+  spec = importlib.util.spec_from_file_location('fmripreproc_wrapper', WRAPPER)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
@@ -0,0 +1,148 @@
+import os
+import types
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+
+class Layout:
+  # the part of a BIDSLayout used by check_runs: one raw bold run per task
+  def __init__(self, paths):
+    self.files = [types.SimpleNamespace(path=p, filename=os.path.basename(p)) for p in paths]
+
+  def get(self, **filters):
+    return self.files
+
+  def parse_file_entities(self, path):
+    return {'task': os.path.basename(path).split('task-')[1].split('_')[0], 'run': 1}
+
+
+def save(path, data, tr=2.0):
+  img = nib.Nifti1Image(np.asarray(data, dtype=np.float32), np.eye(4))
+  img.header.set_zooms((2.0, 2.0, 2.0, tr)[:np.ndim(data)])
+  nib.save(img, str(path))
+  return str(path)
+
+
+@pytest.fixture
+def run(wrapper, tmp_path):
+  (tmp_path / 'raw').mkdir()
+  (tmp_path / 'wd' / 'preproc').mkdir(parents=True)
+  raw = save(tmp_path / 'raw' / 'sub-01_task-rest_run-01_bold.nii.gz', np.ones((4, 4, 3, 12)))
+  entry = types.SimpleNamespace(pid='01', wd=str(tmp_path / 'wd'), trimvols='2', currentstage=None,
+                                checkbbrcost=wrapper.CHECK_BBR_COST, checkmaxtrans=wrapper.CHECK_MAX_TRANSLATION,
+                                checkmaxrot=wrapper.CHECK_MAX_ROTATION)
+  return entry, Layout([raw])
+
+
+def preproc(entry, nvols=10, tr=2.0, par=None):
+  save(entry.wd + '/preproc/rest01_mcf.nii.gz', np.ones((4, 4, 3, nvols)), tr)
+  np.savetxt(entry.wd + '/preproc/rest01_mcf.par', np.zeros((nvols, 6)) if par is None else par)
+
+
+def test_check_image(wrapper, tmp_path):
+  assert wrapper.check_image(str(tmp_path / 'none.nii.gz')) == 'missing none.nii.gz'
+  assert wrapper.check_image(save(tmp_path / 'ok.nii.gz', np.ones((4, 4, 4)))) is None
+  assert 'non-finite' in wrapper.check_image(save(tmp_path / 'nan.nii.gz', np.full((4, 4, 4), np.nan)))
+  mask = np.zeros((4, 4, 4))
+  assert 'empty mask' in wrapper.check_image(save(tmp_path / 'empty.nii.gz', mask), mask=True)
+  mask[1, 1, 1] = 1    # a single voxel off the sampling stride still counts for masks
+  assert wrapper.check_image(save(tmp_path / 'one.nii.gz', mask), mask=True) is None
+  (tmp_path / 'bad.nii.gz').write_bytes(b'not a nifti')
+  assert 'unreadable' in wrapper.check_image(str(tmp_path / 'bad.nii.gz'))
+
+
+def test_check_preprocess_passes(wrapper, run):
+  entry, layout = run
+  preproc(entry)
+  assert wrapper.check_preprocess(layout, entry) == {}
+
+
+@pytest.mark.parametrize('kwargs, reason', [
+  ({'nvols': 12}, 'expected 10 (--trimvols=2)'),
+  ({'tr': 1.5}, 'TR'),
+  ({'par': np.tile([0, 0, 0, 0, 0, 15.5], (10, 1))}, 'translation 15.5 mm'),
+  ({'par': np.tile([0, -0.3, 0, 0, 0, 1], (10, 1))}, 'rotation 0.3 rad'),
+])
+def test_check_preprocess_thresholds(wrapper, run, kwargs, reason):
+  entry, layout = run
+  preproc(entry, **kwargs)
+  failed = wrapper.check_preprocess(layout, entry)
+  assert list(failed) == ['rest01']
+  assert reason in failed['rest01']
+
+
+def test_motion_at_the_limits_passes(wrapper, run):
+  entry, layout = run
+  limits = [wrapper.CHECK_MAX_ROTATION] * 3 + [wrapper.CHECK_MAX_TRANSLATION] * 3
+  preproc(entry, par=np.tile(limits, (10, 1)))
+  assert wrapper.check_preprocess(layout, entry) == {}
+
+
+def test_motion_limits_from_the_command_line(wrapper, run, tmp_path):
+  entry, layout = run
+  preproc(entry, par=np.tile([0, 0, 0, 0, 0, 5], (10, 1)))
+  assert wrapper.check_preprocess(layout, entry) == {}
+  (tmp_path / 'bids').mkdir()
+  args = wrapper.parse_arguments(['--in=' + str(tmp_path / 'bids'), '--out=' + str(tmp_path / 'out'), '--participant-label=01',
+                                  '--check-max-translation=3', '--check-max-rotation=0.1', '--check-bbr-cost=0.6'])
+  assert (args.checkmaxtrans, args.checkmaxrot, args.checkbbrcost) == (3.0, 0.1, 0.6)
+  entry.checkmaxtrans = args.checkmaxtrans
+  assert 'translation 5.0 mm exceeds 3.0' in wrapper.check_preprocess(layout, entry)['rest01']
+
+
+def test_checks_skip_runs_failed_upstream(wrapper, run):
+  entry, layout = run
+  wrapper.record_failures(entry, 'distcorrepi', {'rest01': 'missing dc_sub-01_task-rest_run-01_bold.nii.gz'})
+  entry.currentstage = 'preprocess'
+  assert wrapper.check_preprocess(layout, entry) == {}   # no second reason for the same run
+
+
+@pytest.mark.parametrize('mat, cost, reason', [
+  (np.eye(4), '0.45 2.1', None),
+  (np.eye(4), '0.95 2.1', 'epi_reg bbr cost 0.95'),
+  (np.diag([1.5, 1, 1, 1]), None, 'not a rigid transform'),
+])
+def test_check_registration(wrapper, run, mat, cost, reason):
+  entry, layout = run
+  regdir = entry.wd + '/reg/rest01/'
+  os.makedirs(regdir)
+  np.savetxt(regdir + 'example_func2highres.mat', mat)
+  np.savetxt(regdir + 'example_func2standard.mat', np.eye(4))
+  if cost:
+    with open(regdir + 'example_func2highres_cost.txt', 'w') as f:
+      f.write(cost + '\n')
+  failed = wrapper.check_registration(layout, entry)
+  if reason:
+    assert reason in failed['rest01']
+  else:
+    assert failed == {}
+
+
+def test_failed_runs_are_skipped_downstream_only(wrapper, run):
+  entry, layout = run
+  wrapper.record_failures(entry, 'preprocess', {'rest01': 'translation too large'})
+
+  entry.currentstage = 'registration'
+  assert wrapper.run_failed(entry, 'rest01', quiet=True)
+  assert not wrapper.run_failed(entry, 'rest02', quiet=True)
+  entry.currentstage = 'fast'          # not downstream of preprocess
+  assert not wrapper.run_failed(entry, 'rest01', quiet=True)
+  entry.currentstage = 'distcorrepi'   # upstream
+  assert not wrapper.run_failed(entry, 'rest01', quiet=True)
+
+  # a passing rerun clears the record
+  wrapper.record_failures(entry, 'preprocess', {})
+  entry.currentstage = 'registration'
+  assert not wrapper.run_failed(entry, 'rest01', quiet=True)
+  assert wrapper.failure_records(entry) == {}
+
+
+def test_preprocess_skips_runs_that_failed_distortion_correction(wrapper, run, capsys):
+  entry, layout = run
+  entry.overwrite, entry.templates, entry.croppad = False, '/nonexistent', None
+  wrapper.record_failures(entry, 'distcorrepi', {'rest01': 'dc_ series missing'})
+  entry.currentstage = 'preprocess'
+  assert wrapper.run_preprocess(layout, entry) is False
+  assert 'Skipping rest01: failed distcorrepi check' in capsys.readouterr().out
@@ -0,0 +1,80 @@
+import nibabel as nib
+import numpy as np
+
+
+def test_motion_expansion(wrapper):
+  par = np.random.default_rng(0).normal(size=(30, 6))
+  df = wrapper.motion_expansion(par)
+  assert df.shape == (30, 24)
+  np.testing.assert_allclose(df[wrapper.MOTION_COLUMNS].to_numpy(), par)
+  deriv = df[[c + '_derivative1' for c in wrapper.MOTION_COLUMNS]].to_numpy()
+  np.testing.assert_allclose(deriv[0], 0)
+  np.testing.assert_allclose(deriv[1:], np.diff(par, axis=0))
+  np.testing.assert_allclose(df['trans_x_power2'], par[:, 3] ** 2)
+  np.testing.assert_allclose(df['trans_x_derivative1_power2'], deriv[:, 3] ** 2)
+
+
+def test_randomized_svd_matches_exact(wrapper):
+  rng = np.random.default_rng(1)
+  M = rng.normal(size=(120, 5)) @ np.diag([50, 30, 20, 10, 5]) @ rng.normal(size=(5, 800)) + rng.normal(size=(120, 800))
+  U, sv = wrapper.randomized_svd(M, 5)
+  Ue, sve, Vte = np.linalg.svd(M, full_matrices=False)
+  np.testing.assert_allclose(sv, sve[:5], rtol=1e-6)
+  # same subspace, up to the sign of each vector
+  np.testing.assert_allclose(np.abs(np.sum(U * Ue[:, :5], axis=0)), 1, atol=1e-6)
+
+
+def test_compcor_finds_shared_signals_and_removes_trends(wrapper):
+  rng = np.random.default_rng(2)
+  t = np.arange(200)
+  signals = np.column_stack([np.sin(t / 5.0), np.cos(t / 13.0)])
+  M = (signals @ rng.normal(size=(2, 300)) * 5 + rng.normal(size=(200, 300))
+       + 100 + np.outer(t, rng.normal(size=300))).astype(np.float32)
+  U = wrapper.compcor(M, ncomp=5)
+
+  assert U.shape == (200, 5)
+  np.testing.assert_allclose(U.T @ U, np.eye(5), atol=1e-4)
+  X = wrapper.detrend_design(200)
+  np.testing.assert_allclose(X.T @ U, 0, atol=1e-3)
+  for s in signals.T:
+    s = s - X @ np.linalg.lstsq(X, s, rcond=None)[0]
+    fit = U[:, :2] @ (U[:, :2].T @ s)
+    assert np.sum(fit ** 2) / np.sum(s ** 2) > 0.95
+
+
+def test_compcor_of_an_empty_mask(wrapper):
+  assert wrapper.compcor(np.zeros((50, 0), dtype=np.float32)).shape == (50, 0)
+
+
+def test_streaming_passes_match_in_memory(wrapper, tmp_path):
+  rng = np.random.default_rng(3)
+  data = (rng.normal(size=(5, 4, 3, 40)) + np.linspace(0, 3, 40)).astype(np.float32)
+  path = str(tmp_path / 'bold.nii.gz')
+  nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+  mask = rng.random((5, 4, 3)) > 0.5
+  img = nib.load(path, mmap=True)
+
+  M, = wrapper.gather_timeseries(img, [mask], chunk=7)
+  np.testing.assert_allclose(M, data[mask].T)
+
+  X = wrapper.detrend_design(40)
+  resid = data[mask].T - X @ np.linalg.lstsq(X, data[mask].T, rcond=None)[0]
+  np.testing.assert_allclose(wrapper.residual_variance(img, mask, chunk=7), (resid ** 2).sum(axis=0) / 38, rtol=1e-4)
+
+
+def test_compcor_confounds_columns(wrapper, tmp_path):
+  rng = np.random.default_rng(4)
+  data = rng.normal(size=(6, 6, 4, 30)).astype(np.float32)
+  nib.save(nib.Nifti1Image(data, np.eye(4)), str(tmp_path / 'bold.nii.gz'))
+  masks = {'wm': np.zeros((6, 6, 4)), 'csf': np.zeros((6, 6, 4)), 'brain': np.ones((6, 6, 4))}
+  masks['wm'][:3] = 1
+  masks['csf'][3:, :2] = 1
+  for name, m in masks.items():
+    nib.save(nib.Nifti1Image(m.astype(np.uint8), np.eye(4)), str(tmp_path / ('run_' + name + '_func.nii.gz')))
+
+  df = wrapper.compcor_confounds(str(tmp_path / 'bold.nii.gz'), str(tmp_path / 'run'))
+  assert len(df) == 30
+  assert [c for c in df.columns if c.startswith('a_comp_cor_wm')] == ['a_comp_cor_wm_0' + str(i) for i in range(5)]
+  assert len([c for c in df.columns if c.startswith('a_comp_cor_csf')]) == 5
+  # tCompCor: 2% of 144 brain voxels -> 3 voxels -> 3 components
+  assert len([c for c in df.columns if c.startswith('t_comp_cor')]) == 3
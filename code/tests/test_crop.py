@@ -0,0 +1,67 @@
+import nibabel as nib
+import numpy as np
+import pytest
+
+FULL = (20, 18, 12)
+OFFSET, SIZE = (3, 4, 2), (11, 9, 7)
+ZOOMS = (2.0, 2.5, 3.0)
+
+
+def reference(tmp_path, neurological):
+  affine = np.diag(ZOOMS + (1.0,))
+  if not neurological:
+    affine[0] = -affine[0]    # radiological: negative determinant
+  path = str(tmp_path / 'ref.nii.gz')
+  nib.save(nib.Nifti1Image(np.zeros(FULL, dtype=np.float32), affine), path)
+  return {'offset': OFFSET, 'size': SIZE, 'ref': path}
+
+
+def flirt_coords(voxel, shape, affine):
+  # flirt scaled voxel coordinates: x is flipped when the determinant is positive
+  v = np.array(voxel, dtype=float)
+  if np.linalg.det(affine[:3, :3]) > 0:
+    v[0] = shape[0] - 1 - v[0]
+  return np.append(v * ZOOMS, 1.0)
+
+
+def test_uncrop_image_restores_acquisition_grid(wrapper, tmp_path):
+  crop = reference(tmp_path, True)
+  (x0, y0, z0), (nx, ny, nz) = OFFSET, SIZE
+  data = np.random.default_rng(0).normal(size=SIZE + (5,)).astype(np.float32) + 10
+  cropped = str(tmp_path / 'cropped.nii.gz')
+  nib.save(nib.Nifti1Image(data, np.eye(4)), cropped)
+  out = str(tmp_path / 'full.nii.gz')
+  wrapper.uncrop_image(cropped, out, crop)
+
+  img = nib.load(out)
+  full = img.get_fdata(dtype=np.float32)
+  assert img.shape == FULL + (5,)
+  np.testing.assert_allclose(img.affine, nib.load(crop['ref']).affine)
+  np.testing.assert_array_equal(full[x0:x0 + nx, y0:y0 + ny, z0:z0 + nz], data)
+  full[x0:x0 + nx, y0:y0 + ny, z0:z0 + nz] = 0
+  assert not full.any()
+
+
+@pytest.mark.parametrize('neurological', [True, False])
+def test_uncrop_matrices_map_the_same_voxels(wrapper, tmp_path, neurological):
+  crop = reference(tmp_path, neurological)
+  affine = nib.load(crop['ref']).affine
+  regdir = tmp_path / 'reg'
+  regdir.mkdir()
+  rng = np.random.default_rng(1)
+  func2highres = np.vstack([rng.normal(size=(3, 4)), [0, 0, 0, 1]])
+  np.savetxt(regdir / 'example_func2highres.mat', func2highres)
+  np.savetxt(regdir / 'highres2example_func.mat', np.linalg.inv(func2highres))
+  np.savetxt(regdir / 'highres2standard.mat', func2highres)
+  wrapper.uncrop_matrices(str(regdir), crop)
+
+  voxel = np.array([4, 2, 5])                       # voxel of the cropped image
+  full_voxel = voxel + OFFSET
+  cropped_xyz = flirt_coords(voxel, SIZE, affine)
+  full_xyz = flirt_coords(full_voxel, FULL, affine)
+  new = np.loadtxt(regdir / 'example_func2highres.mat')
+  np.testing.assert_allclose(new @ full_xyz, func2highres @ cropped_xyz, atol=1e-6)
+  inv = np.loadtxt(regdir / 'highres2example_func.mat')
+  np.testing.assert_allclose(inv @ (func2highres @ cropped_xyz), full_xyz, atol=1e-6)
+  # matrices that do not involve example_func are left alone
+  np.testing.assert_allclose(np.loadtxt(regdir / 'highres2standard.mat'), func2highres)
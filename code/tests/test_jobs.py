@@ -0,0 +1,89 @@
+import os
+import signal
+import time
+import types
+
+import pytest
+
+
+def make_entry(tmp_path, **kwargs):
+  entry = types.SimpleNamespace(wd=str(tmp_path / 'wd'), nprocs=0, jobtimeout=None, monitor=None,
+                                failedjobs=[], jobresults={}, jobscratch=None)
+  entry.__dict__.update(kwargs)
+  os.makedirs(entry.wd, exist_ok=True)
+  return entry
+
+
+def script(tmp_path, name, body):
+  path = tmp_path / (name + '.sh')
+  path.write_text(body)
+  return 'bash ' + str(path)
+
+
+def test_jobs_run_and_log(wrapper, tmp_path):
+  entry = make_entry(tmp_path)
+  jobs = [wrapper.Job('a', script(tmp_path, 'a', 'echo hello a\n')), wrapper.Job('b', 'true')]
+  assert wrapper.run_jobs(jobs, entry)
+  assert [j.status for j in jobs] == ['done', 'done']
+  assert 'hello a' in open(entry.wd + '/logs/a.log').read()
+  assert entry.jobresults == {'a': 'done', 'b': 'done'}
+
+
+def test_failure_cancels_the_dependent_tree(wrapper, tmp_path):
+  entry = make_entry(tmp_path)
+  jobs = [wrapper.Job('a', 'false'),
+          wrapper.Job('b', 'true', after=['a']),
+          wrapper.Job('c', 'true', after=['b']),
+          wrapper.Job('d', 'true')]
+  assert not wrapper.run_jobs(jobs, entry)
+  assert [j.status for j in jobs] == ['failed', 'cancelled', 'cancelled', 'done']
+  assert entry.failedjobs == ['a', 'b', 'c']
+
+
+def test_dependencies_on_earlier_calls(wrapper, tmp_path):
+  entry = make_entry(tmp_path)
+  wrapper.run_jobs([wrapper.Job('stage1-ok', 'true'), wrapper.Job('stage1-bad', 'false')], entry)
+  jobs = [wrapper.Job('x', 'true', after=['stage1-ok']),
+          wrapper.Job('y', 'true', after=['stage1-bad']),
+          wrapper.Job('z', 'true', after=['not-run'])]   # skipped earlier: outputs were present
+  wrapper.run_jobs(jobs, entry)
+  assert [j.status for j in jobs] == ['done', 'cancelled', 'done']
+
+
+def test_timeout_kills_the_process_group(wrapper, tmp_path):
+  entry = make_entry(tmp_path, jobtimeout=1)
+  pidfile = tmp_path / 'child.pid'
+  cmd = script(tmp_path, 'slow', 'sleep 60 &\necho $! > ' + str(pidfile) + '\nwait\n')
+  job = wrapper.Job('slow', cmd)
+  start = time.time()
+  assert not wrapper.run_jobs([job], entry)
+  assert job.status == 'timeout'
+  assert time.time() - start < 20
+  time.sleep(0.5)
+  with pytest.raises(ProcessLookupError):
+    os.kill(int(pidfile.read_text()), 0)    # the background child went with the group
+
+
+def test_interrupt_cancels_running_jobs(wrapper, tmp_path):
+  entry = make_entry(tmp_path)
+  job = wrapper.Job('slow', 'sleep 60')
+  old = signal.signal(signal.SIGALRM, lambda *a: signal.raise_signal(signal.SIGINT))
+  signal.setitimer(signal.ITIMER_REAL, 1)
+  try:
+    with pytest.raises(KeyboardInterrupt):
+      wrapper.run_jobs([job], entry)
+  finally:
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    signal.signal(signal.SIGALRM, old)
+  assert job.status == 'cancelled'
+  with pytest.raises(ProcessLookupError):
+    os.kill(job.pid, 0)
+
+
+def test_long_output_lines(wrapper, tmp_path):
+  entry = make_entry(tmp_path)
+  cmd = script(tmp_path, 'long', "python3 -c \"print('x' * (3 * 2**20)); print('end')\"\n")
+  job = wrapper.Job('long', cmd)
+  assert wrapper.run_jobs([job], entry)
+  log = open(entry.wd + '/logs/long.log').read()
+  assert 'x' * (3 * 2**20) in log and log.rstrip().endswith('end')
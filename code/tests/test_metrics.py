@@ -0,0 +1,51 @@
+import os
+import types
+
+import numpy as np
+import pandas as pd
+
+
+def make_run(wd, key, fd):
+  os.makedirs(wd + '/preproc', exist_ok=True)
+  np.savetxt(wd + '/preproc/' + key + '_mcf.par', [[0.01, 0, 0, 0.5, 0, 0], [0, -0.02, 0, 0, -1.5, 0]])
+  pd.DataFrame({'fd': fd, 'dvars': [1.0, 2.0], 'fd_outliers_01': [0, 1]}).to_csv(
+    wd + '/preproc/' + key + '_confounds.tsv', sep='\t')
+
+
+def test_store_and_read_summary(wrapper, tmp_path, monkeypatch):
+  monkeypatch.setattr(wrapper, 'METRICS_FORMAT', 'npz')
+  entry = types.SimpleNamespace(wd=str(tmp_path / 'wd'), outputs=str(tmp_path / 'out'))
+  make_run(entry.wd, 'rest01', [0.0, 0.4])
+  make_run(entry.wd, 'rest02', [0.0, 0.2])
+  for run in ('1', '2'):
+    wrapper.store_metrics(entry, {'subject': '01', 'task': 'rest', 'run': run}, ['motion', 'confounds', 'snr'])
+
+  summary = wrapper.read_metrics(entry.outputs)
+  assert list(summary['run']) == ['01', '02']
+  first = summary.iloc[0]
+  assert first['nvols'] == 2 and first['fd_max'] == 0.4 and first['fd_outliers'] == 1
+  assert first['trans_max'] == 1.5 and first['rot_max'] == 0.02
+  assert len(wrapper.read_metrics(entry.outputs, 'motion', subject='01', run='02')) == 2
+
+  # storing a run again replaces its row
+  make_run(entry.wd, 'rest01', [0.0, 0.8])
+  wrapper.store_metrics(entry, {'subject': '01', 'task': 'rest', 'run': '1'}, ['confounds'])
+  summary = wrapper.read_metrics(entry.outputs)
+  assert len(summary) == 2
+  assert summary[summary['run'] == '01']['fd_max'].item() == 0.8
+
+
+def test_read_metrics_uses_the_newest_format(wrapper, tmp_path):
+  mdir = tmp_path / 'out/fmripreproc/metrics'
+  mdir.mkdir(parents=True)
+  row = pd.DataFrame({'subject': ['01'], 'session': [''], 'task': ['rest'], 'acquisition': [''], 'run': ['01'], 'nvols': [10]})
+  wrapper.write_table(str(mdir / 'summary.npz'), row)
+  (mdir / 'summary.parquet').write_text('written before pyarrow was removed')
+  os.utime(mdir / 'summary.parquet', (1, 1))
+
+  assert len(wrapper.read_metrics(str(tmp_path / 'out'))) == 1
+  assert wrapper.latest_tables([str(mdir / 'summary.parquet'), str(mdir / 'summary.npz')], stale=True) == [str(mdir / 'summary.parquet')]
+
+  # rewriting the table drops the superseded copy
+  wrapper.write_table(str(mdir / 'summary.npz'), row)
+  assert sorted(os.listdir(mdir)) == ['summary.npz']
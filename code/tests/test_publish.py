@@ -0,0 +1,86 @@
+import json
+import os
+import types
+
+import nibabel as nib
+import numpy as np
+
+
+def entry(dtype):
+  return types.SimpleNamespace(outdtype=dtype)
+
+
+def save(path, data, dtype=None):
+  img = nib.Nifti1Image(data, np.diag([2.0, 2.0, 2.0, 1.0]))
+  if dtype:
+    img.set_data_dtype(dtype)
+  img.header.set_zooms((2.0, 2.0, 2.0, 0.8)[:data.ndim])
+  nib.save(img, str(path))
+  return str(path)
+
+
+def test_series_blocks_matches_full_load(wrapper, tmp_path):
+  data = np.random.default_rng(0).normal(100, 20, (6, 5, 4, 37)).astype(np.float32)
+  for name, dtype in (('float.nii.gz', None), ('scaled.nii.gz', np.int16), ('plain.nii', None)):
+    path = save(tmp_path / name, data, dtype)
+    img = nib.load(path, mmap=True)
+    blocks = list(wrapper.series_blocks(img, chunk=16))
+    assert [(t0, t1) for t0, t1, b in blocks] == [(0, 16), (16, 32), (32, 37)]
+    np.testing.assert_allclose(np.concatenate([b for t0, t1, b in blocks], axis=3),
+                               nib.load(path).get_fdata(dtype=np.float32), rtol=1e-6, atol=1e-5)
+
+
+def test_int16_round_trip_within_quantization_error(wrapper, tmp_path):
+  data = np.random.default_rng(1).normal(500, 150, (6, 5, 4, 20)).astype(np.float32)
+  src = save(tmp_path / 'src.nii.gz', data)
+  out = str(tmp_path / 'out.nii.gz')
+  wrapper.publish_series(src, out, entry('int16'))
+
+  img = nib.load(out)
+  with open(tmp_path / 'out.json') as f:
+    meta = json.load(f)
+  assert img.get_data_dtype() == np.int16
+  assert img.shape == data.shape
+  err = np.abs(img.get_fdata() - data).max()
+  assert err <= meta['SclSlope'] / 2 + 1e-3
+  assert np.isclose(err, meta['QuantizationMaxError'], atol=1e-3)
+  assert meta['DataType'] == 'int16'
+
+
+def test_int16_stores_integer_data_exactly(wrapper, tmp_path):
+  data = np.random.default_rng(2).integers(-3000, 3000, (4, 4, 3, 10)).astype(np.float32)
+  src = save(tmp_path / 'src.nii.gz', data)
+  out = str(tmp_path / 'out.nii.gz')
+  wrapper.publish_series(src, out, entry('int16'))
+
+  with open(tmp_path / 'out.json') as f:
+    meta = json.load(f)
+  assert (meta['SclSlope'], meta['SclInter'], meta['QuantizationMaxError']) == (1.0, 0.0, 0.0)
+  np.testing.assert_array_equal(nib.load(out).get_fdata(), data)
+
+
+def test_int16_publish_is_skipped_when_source_unchanged(wrapper, tmp_path, capsys):
+  src = save(tmp_path / 'src.nii.gz', np.ones((3, 3, 3, 4), dtype=np.float32))
+  out = str(tmp_path / 'out.nii.gz')
+  wrapper.publish_series(src, out, entry('int16'))
+  wrapper.publish_series(src, out, entry('int16'))
+  assert 'Published series up to date' in capsys.readouterr().out
+
+
+def test_float32_is_copied(wrapper, tmp_path):
+  data = np.random.default_rng(3).normal(size=(3, 3, 3, 4)).astype(np.float32)
+  src = save(tmp_path / 'src.nii.gz', data)
+  out = str(tmp_path / 'out.nii.gz')
+  wrapper.publish_series(src, out, entry('float32'))
+  np.testing.assert_array_equal(nib.load(out).get_fdata(dtype=np.float32), data)
+
+
+def test_stage_input_prefers_the_float_working_copy(wrapper, tmp_path):
+  published = save(tmp_path / 'sub-01_task-rest_space-native_desc-preproc_bold.nii.gz', np.ones((2, 2, 2, 3)), np.int16)
+  e = types.SimpleNamespace(wd=str(tmp_path / 'wd'), croppad=None)
+  assert wrapper.stage_input(e, published) == published
+  os.makedirs(e.wd + '/native')
+  mcf = save(tmp_path / 'rest_mcf.nii.gz', np.ones((2, 2, 2, 3), dtype=np.float32), np.float32)
+  os.symlink(mcf, e.wd + '/native/' + os.path.basename(published))
+  assert wrapper.stage_input(e, published) == e.wd + '/native/' + os.path.basename(published)
+  assert nib.load(wrapper.stage_input(e, published)).get_data_dtype() != nib.load(published).get_data_dtype()
@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import time
+
+
+def claim_all(queue, worker):
+  claimed = []
+  while True:
+    item, finished = queue.claim(worker)
+    if item is None:
+      return claimed, finished
+    claimed.append(item['stage'])
+
+
+def test_enqueue_is_idempotent(wrapper, tmp_path):
+  queue = wrapper.WorkQueue(str(tmp_path / 'queue'))
+  queue.enqueue('01', ['bet', 'topup'])
+  queue.enqueue('01', ['bet', 'topup'])
+  assert sorted(os.listdir(queue.items)) == ['sub-01_bet.json', 'sub-01_topup.json']
+
+
+def test_claim_follows_stage_dependencies(wrapper, tmp_path):
+  queue = wrapper.WorkQueue(str(tmp_path / 'queue'))
+  queue.enqueue('01', ['bet', 'topup', 'distcorrepi'])
+
+  claimed, finished = claim_all(queue, 'w1')
+  assert claimed == ['bet', 'topup']   # distcorrepi waits for topup
+  assert not finished
+
+  items = queue.load()
+  queue.finish(items['01', 'topup'], 'w1', True)
+  item, finished = queue.claim('w1')
+  assert item['stage'] == 'distcorrepi'
+
+  queue.finish(items['01', 'bet'], 'w1', True)
+  queue.finish(item, 'w1', True)
+  assert queue.claim('w1') == (None, True)
+
+
+def test_failed_stage_blocks_downstream(wrapper, tmp_path):
+  queue = wrapper.WorkQueue(str(tmp_path / 'queue'), maxattempts=1)
+  queue.enqueue('01', ['topup', 'distcorrepi'])
+  item, finished = queue.claim('w1')
+  queue.finish(item, 'w1', False)
+
+  items = queue.load()
+  assert queue.state(items['01', 'topup'], items) == 'failed'
+  assert queue.state(items['01', 'distcorrepi'], items) == 'blocked'
+  assert queue.claim('w1') == (None, True)
+
+
+def test_heartbeat_keeps_claim_fresh(wrapper, tmp_path):
+  queue = wrapper.WorkQueue(str(tmp_path / 'queue'), stale=2)
+  queue.enqueue('01', ['bet'])
+  item, finished = queue.claim('w1')
+  claim = queue.path(item, 'claim')
+  os.utime(claim, (time.time() - 60, time.time() - 60))
+
+  stop = queue.heartbeat(item, 'w1')
+  try:
+    time.sleep(1.5)
+  finally:
+    stop.set()
+  assert time.time() - os.path.getmtime(claim) < 2
+  assert queue.state(item, queue.load()) == 'claimed'
+
+
+def test_abandoned_claim_is_reclaimed(wrapper, tmp_path):
+  queue = wrapper.WorkQueue(str(tmp_path / 'queue'), stale=60, maxattempts=2)
+  queue.enqueue('01', ['bet'])
+  item, finished = queue.claim('w1')
+  os.utime(queue.path(item, 'claim'), (time.time() - 120, time.time() - 120))
+
+  item2, finished = queue.claim('w2')
+  assert item2['id'] == item['id']
+  assert queue.attempts(item2) == 1
+  assert queue.owner(item2) == 'w2'
+
+  # the first worker's late result is discarded
+  queue.finish(item, 'w1', True)
+  assert not os.path.exists(queue.path(item, 'done'))
+  queue.finish(item2, 'w2', True)
+  assert os.path.exists(queue.path(item, 'done'))
+
+
+def test_heartbeat_stops_when_the_claim_disappears(wrapper, tmp_path, capsys):
+  queue = wrapper.WorkQueue(str(tmp_path / 'queue'), stale=2)
+  queue.enqueue('01', ['bet'])
+  item, finished = queue.claim('w1')
+  real_owner = queue.owner
+  # the claim vanishes between owner() and utime()
+  queue.owner = lambda it: (os.remove(queue.path(it, 'claim')), real_owner(it) or 'w1')[1]
+  stop = queue.heartbeat(item, 'w1')
+  time.sleep(1.5)
+  stop.set()
+  assert 'lost the claim on sub-01_bet' in capsys.readouterr().out
+
+
+def claim_worker(qdir, worker, results):
+  queue = WRAPPER.WorkQueue(qdir)
+  claimed = []
+  while True:
+    item, finished = queue.claim(worker)
+    if item is None:
+      break
+    claimed.append(item['id'])
+    queue.finish(item, worker, True)
+  results.put((worker, claimed))
+
+
+def test_two_processes_never_claim_the_same_item(wrapper, tmp_path):
+  global WRAPPER
+  WRAPPER = wrapper
+  qdir = str(tmp_path / 'queue')
+  queue = wrapper.WorkQueue(qdir)
+  stages = ['bet', 'topup', 'fast']   # no dependencies between them
+  for n in range(20):
+    queue.enqueue(str(n).zfill(2), stages)
+
+  ctx = multiprocessing.get_context('fork')
+  results = ctx.Queue()
+  procs = [ctx.Process(target=claim_worker, args=(qdir, 'w' + str(i), results)) for i in range(2)]
+  for p in procs:
+    p.start()
+  claimed = dict(results.get(timeout=60) for p in procs)
+  for p in procs:
+    p.join(10)
+
+  ids = claimed['w0'] + claimed['w1']
+  assert len(ids) == len(set(ids)) == 60
@@ -0,0 +1,61 @@
+import struct
+import zlib
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+
+def read_png(path):
+  # decodes the 8-bit greyscale, filter 0 pngs written by write_png
+  with open(path, 'rb') as f:
+    data = f.read()
+  assert data[:8] == b'\x89PNG\r\n\x1a\n'
+  pos, chunks = 8, {}
+  while pos < len(data):
+    n, = struct.unpack('>I', data[pos:pos + 4])
+    tag, body = data[pos + 4:pos + 8], data[pos + 8:pos + 8 + n]
+    crc, = struct.unpack('>I', data[pos + 8 + n:pos + 12 + n])
+    assert crc == zlib.crc32(tag + body) & 0xffffffff
+    chunks[tag] = chunks.get(tag, b'') + body
+    pos += 12 + n
+  w, h, depth, ctype = struct.unpack('>IIBB', chunks[b'IHDR'][:10])
+  assert (depth, ctype) == (8, 0)
+  raw = np.frombuffer(zlib.decompress(chunks[b'IDAT']), dtype=np.uint8).reshape(h, w + 1)
+  assert not raw[:, 0].any()
+  return raw[:, 1:]
+
+
+def test_write_png_round_trip(wrapper, tmp_path):
+  img = np.random.default_rng(0).integers(0, 256, (7, 13)).astype(np.uint8)
+  wrapper.write_png(str(tmp_path / 'a.png'), img)
+  np.testing.assert_array_equal(read_png(str(tmp_path / 'a.png')), img)
+
+
+def test_carpet_plot_size_and_range(wrapper, tmp_path):
+  rng = np.random.default_rng(1)
+  nib.save(nib.Nifti1Image(rng.normal(size=(6, 6, 4, 50)).astype(np.float32), np.eye(4)), str(tmp_path / 'bold.nii.gz'))
+  mask = np.zeros((6, 6, 4), dtype=np.uint8)
+  mask[1:5, 1:5, 1:3] = 1
+  nib.save(nib.Nifti1Image(mask, np.eye(4)), str(tmp_path / 'mask.nii.gz'))
+  wrapper.carpet_plot(str(tmp_path / 'bold.nii.gz'), str(tmp_path / 'mask.nii.gz'), str(tmp_path / 'c.png'), maxcols=20)
+  png = read_png(str(tmp_path / 'c.png'))
+  assert png.shape == (32, 20)    # one row per mask voxel, volumes averaged into 20 columns
+  assert png.min() < 80 and png.max() > 170
+
+
+def test_qc_commands_fail_on_any_command(wrapper, tmp_path):
+  wrapper.qc_commands(['true', 'true'], str(tmp_path))
+  with pytest.raises(Exception, match='false exited with 1'):
+    wrapper.qc_commands(['false', 'true'], str(tmp_path))
+
+
+def test_input_hash_follows_contents_and_version(wrapper, tmp_path):
+  f = tmp_path / 'in.txt'
+  f.write_text('a')
+  key = wrapper.input_hash([str(f)], '1', 'x')
+  assert wrapper.input_hash([str(f)], '1', 'x') == key
+  assert wrapper.input_hash([str(f)], '2', 'x') != key
+  assert wrapper.input_hash([str(f)], '1', 'y') != key
+  f.write_text('ab')
+  assert wrapper.input_hash([str(f)], '1', 'x') != key
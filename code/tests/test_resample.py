@@ -0,0 +1,18 @@
+import pytest
+
+FUNC = '/data/derivatives/fmripreproc/sub-01/ses-1/func/'
+
+
+@pytest.mark.parametrize('bold, reg', [
+  ('sub-01_ses-1_task-rest_run-01_space-native_desc-preproc_bold.nii.gz', 'sub-01_ses-1_task-rest_run-01_reg'),
+  ('sub-01_ses-1_task-rest_acq-mb_run-01_echo-2_dir-AP_space-native_desc-preproc_bold.nii.gz', 'sub-01_ses-1_task-rest_acq-mb_run-01_reg'),
+  ('sub-01_ses-1_task-rest_space-native_desc-preproc_bold.nii', 'sub-01_ses-1_task-rest_reg'),
+])
+def test_registration_dir(wrapper, bold, reg):
+  assert wrapper.registration_dir(FUNC + bold) == FUNC + reg
+
+
+def test_derivatives_root(wrapper):
+  assert wrapper.derivatives_root(FUNC + 'sub-01_ses-1_task-rest_bold.nii.gz') == '/data/derivatives/fmripreproc'
+  with pytest.raises(AttributeError):
+    wrapper.derivatives_root('/data/not_bids/file.nii.gz')
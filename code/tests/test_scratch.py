@@ -0,0 +1,77 @@
+import os
+import types
+
+
+def make_wd(tmp_path):
+  wd = tmp_path / 'wd'
+  for d in ('bet', 'preproc', 'logs'):
+    (wd / d).mkdir(parents=True)
+  (wd / 'bet/brain.nii.gz').write_text('brain')
+  (wd / 'preproc/rest01_mcf.par').write_text('par')
+  (wd / 'preproc/rest01_preprocess.log').write_text('first run\n')
+  return str(wd)
+
+
+def test_setup_links_everything_but_the_outputs(wrapper, tmp_path):
+  wd = make_wd(tmp_path)
+  scratch = wrapper.JobScratch(wd, wd + '/jobs', 'preproc-rest01', ['preproc'])
+  scratch.setup()
+  assert os.path.islink(scratch.path + '/bet') and os.path.islink(scratch.path + '/logs')
+  assert not os.path.islink(scratch.path + '/preproc') and os.listdir(scratch.path + '/preproc') == []
+  assert not os.path.exists(scratch.path + '/jobs')
+
+  cmd = scratch.command('bash run.sh ' + wd + '/bet/brain.nii.gz ' + wd + '/preproc/rest01_mcf.par ' + wd)
+  assert cmd == 'bash run.sh ' + ' '.join([scratch.path + '/bet/brain.nii.gz', scratch.path + '/preproc/rest01_mcf.par', scratch.path])
+  # an input read from the output directory is linked to the shared file
+  assert os.readlink(scratch.path + '/preproc/rest01_mcf.par') == wd + '/preproc/rest01_mcf.par'
+
+
+def test_promote_moves_outputs_and_appends_logs(wrapper, tmp_path):
+  wd = make_wd(tmp_path)
+  scratch = wrapper.JobScratch(wd, wd + '/jobs', 'preproc-rest01', ['preproc'])
+  scratch.setup()
+  scratch.command('cat ' + wd + '/preproc/rest01_mcf.par')
+  private = scratch.path + '/preproc/'
+  with open(private + 'rest01_mcf.nii.gz', 'w') as f:
+    f.write('series')
+  with open(private + 'rest01_preprocess.log', 'w') as f:
+    f.write('second run\n')
+  with open(private + 'rest02_preprocess.log', 'w') as f:
+    f.write('new log\n')
+  os.symlink(private + 'rest01_mcf.nii.gz', private + 'rest01.nii.gz')
+  os.makedirs(private + 'rest01.mat')
+  with open(private + 'rest01.mat/MAT_0000', 'w') as f:
+    f.write('mat')
+
+  scratch.promote()
+  shared = wd + '/preproc/'
+  assert open(shared + 'rest01_mcf.nii.gz').read() == 'series'
+  assert open(shared + 'rest01_preprocess.log').read() == 'first run\nsecond run\n'
+  assert open(shared + 'rest02_preprocess.log').read() == 'new log\n'
+  assert os.readlink(shared + 'rest01.nii.gz') == shared + 'rest01_mcf.nii.gz'   # link retargeted
+  assert open(shared + 'rest01.mat/MAT_0000').read() == 'mat'
+  assert not os.path.islink(shared + 'rest01_mcf.par')                           # input left alone
+
+
+def make_entry(tmp_path):
+  entry = types.SimpleNamespace(wd=make_wd(tmp_path), nprocs=0, jobtimeout=None, monitor=None,
+                                failedjobs=[], jobresults={}, jobscratch=None, pid='01')
+  return entry
+
+
+def test_failed_job_leaves_no_partial_outputs(wrapper, tmp_path):
+  entry = make_entry(tmp_path)
+  # the working directory is passed on the command line, as the stage scripts get it
+  body = 'echo partial > $1/preproc/rest01_mcf.nii.gz\necho script log > $1/preproc/rest03_preprocess.log\n'
+  (tmp_path / 'fail.sh').write_text(body + 'exit 1\n')
+  (tmp_path / 'ok.sh').write_text(body)
+
+  assert not wrapper.run_jobs([wrapper.Job('preproc-rest01', 'bash ' + str(tmp_path / 'fail.sh') + ' ' + entry.wd, outputs=['preproc'])], entry)
+  assert sorted(os.listdir(entry.wd + '/preproc')) == ['rest01_mcf.par', 'rest01_preprocess.log']
+  assert os.listdir(entry.wd + '/jobs') == []
+  assert 'script log' in open(entry.wd + '/logs/preproc-rest01.log').read()
+
+  assert wrapper.run_jobs([wrapper.Job('preproc-rest02', 'bash ' + str(tmp_path / 'ok.sh') + ' ' + entry.wd, outputs=['preproc'])], entry)
+  assert open(entry.wd + '/preproc/rest01_mcf.nii.gz').read() == 'partial\n'
+  assert open(entry.wd + '/preproc/rest03_preprocess.log').read() == 'script log\n'
+  assert os.listdir(entry.wd + '/jobs') == []
@@ -0,0 +1,95 @@
+import json
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+
+def make_dataset(root, subjects):
+  root.mkdir(exist_ok=True)
+  (root / 'dataset_description.json').write_text(json.dumps({'Name': 'test', 'BIDSVersion': '1.6.0'}))
+  for sub in subjects:
+    (root / ('sub-' + sub) / 'anat').mkdir(parents=True, exist_ok=True)
+    (root / ('sub-' + sub) / 'anat' / ('sub-' + sub + '_T1w.nii.gz')).write_bytes(b'')
+
+
+def request(path, argv, cwd):
+  # the child streams to the client by redirecting fds 1 and 2: print through them
+  saved = sys.stdout, sys.stderr
+  sys.stdout, sys.stderr = open(1, 'w', closefd=False), open(2, 'w', closefd=False)
+  try:
+    with socket.socket(socket.AF_UNIX) as conn:
+      conn.connect(path)
+      conn.sendall((json.dumps({'argv': argv, 'cwd': cwd}) + '\n').encode())
+      out = conn.makefile('rb').read().decode()
+  finally:
+    sys.stdout, sys.stderr = saved
+  out, status = out.split('\0fmripreproc-exit ')
+  return out, int(status)
+
+
+def test_request_inputs(wrapper):
+  assert wrapper.request_inputs(['--in=ds', '--out=o'], '/data') == '/data/ds'
+  assert wrapper.request_inputs(['--in', '/abs/ds'], '/data') == '/abs/ds'
+  assert wrapper.request_inputs(['-i', 'ds'], '/data') == '/data/ds'
+  assert wrapper.request_inputs(['-ids'], '/data') == '/data/ds'
+  assert wrapper.request_inputs(['resample', '--out=o'], '/data') is None
+
+
+def test_cheap_signature_only_sees_directory_changes(wrapper, tmp_path):
+  make_dataset(tmp_path / 'ds', ['01'])
+  ds = str(tmp_path / 'ds')
+  cheap, full = wrapper.dataset_signature(ds, files=False), wrapper.dataset_signature(ds)
+  t1w = tmp_path / 'ds/sub-01/anat/sub-01_T1w.nii.gz'
+  t1w.write_bytes(b'rewritten')
+  assert wrapper.dataset_signature(ds, files=False) == cheap
+  assert wrapper.dataset_signature(ds) != full
+  (tmp_path / 'ds/participants.tsv').write_text('participant_id\n')
+  assert wrapper.dataset_signature(ds, files=False) != cheap
+
+
+@pytest.fixture
+def server(wrapper, tmp_path, monkeypatch):
+  monkeypatch.setenv('TMPDIR', str(tmp_path))
+  monkeypatch.setenv('FSLDIR', str(tmp_path / 'fsl'))
+  # the child reports the layout it was handed instead of running the pipeline
+  monkeypatch.setattr(wrapper, 'run_entry', lambda entry, layout: print(
+    'layout', id(layout), len(layout.get(suffix='T1w')), 'assets', 'MNI152_T1_2mm_brain' in entry.assets))
+  path = str(tmp_path / 'serve.sock')
+  srv = wrapper.PipelineServer(path, 2, str(tmp_path / 'index'))
+  thread = threading.Thread(target=srv.serve_forever, daemon=True)
+  thread.start()
+  yield srv, path
+  srv.shutdown()
+  srv.server_close()
+
+
+def test_server_reuses_the_layout_until_the_dataset_changes(server, tmp_path):
+  srv, path = server
+  make_dataset(tmp_path / 'ds', ['01'])
+  argv = ['--in=ds', '--out=out', '--participant-label=01']
+
+  out, status = request(path, argv, str(tmp_path))
+  assert status == 0, out
+  first = out.split('layout ')[1].split()
+  assert first[1:] == ['1', 'assets', 'True']
+  out, status = request(path, argv, str(tmp_path))
+  assert out.split('layout ')[1].split()[0] == first[0]   # same warm layout from the daemon
+  assert len(os.listdir(tmp_path / 'index')) == 2       # one database (+ its lock)
+
+  make_dataset(tmp_path / 'ds', ['02'])
+  out, status = request(path, argv, str(tmp_path))
+  assert status == 0, out
+  assert out.split('layout ')[1].split()[1] == '2'
+  assert len([d for d in os.listdir(tmp_path / 'index') if not d.endswith('.lock')]) == 1
+
+
+def test_server_reports_bad_requests(server):
+  srv, path = server
+  with socket.socket(socket.AF_UNIX) as conn:
+    conn.connect(path)
+    conn.sendall(b'not json\n')
+    out = conn.makefile('rb').read().decode()
+  assert out.startswith('Error: bad request') and out.endswith('\0fmripreproc-exit 2\n')
@@ -0,0 +1,58 @@
+import types
+
+import pytest
+
+
+class FakeFile:
+  def __init__(self, **ent):
+    self.ent = ent
+    self.filename = '_'.join(k + '-' + str(v) for k, v in sorted(ent.items())) + '_epi.nii.gz'
+
+  def get_entities(self):
+    return self.ent
+
+
+class FakeLayout:
+  """The part of BIDSLayout that session_inputs uses."""
+
+  def __init__(self, fmaps):
+    self.fmaps = fmaps
+    self.calls = 0
+
+  def get_sessions(self, subject):
+    return sorted(set(f.ent['session'] for f in self.fmaps if 'session' in f.ent))
+
+  def get(self, subject, extension, suffix, scope, session=None):
+    self.calls += 1
+    return [f for f in self.fmaps if session is None or f.ent.get('session') == session]
+
+
+def test_run_key(wrapper):
+  assert wrapper.run_key({'task': 'rest', 'run': '1'}) == 'rest01'
+  assert wrapper.run_key({'task': 'rest'}) == 'rest'
+  assert wrapper.run_key({'task': 'rest', 'run': 2, 'session': '2', 'acquisition': 'mb'}) == 'ses-2_acq-mb_rest02'
+  assert wrapper.run_key({'task': 'rest', 'session': None, 'acquisition': ''}) == 'rest'
+
+
+def test_session_inputs_pairs_fieldmaps_per_session(wrapper):
+  layout = FakeLayout([FakeFile(session='1', direction='AP'), FakeFile(session='1', direction='PA'),
+                       FakeFile(session='2', direction='AP', acquisition='mb', run=2),
+                       FakeFile(session='2', direction='PA', acquisition='mb', run=2)])
+  entry = types.SimpleNamespace(pid='01')
+  sessions = wrapper.session_inputs(layout, entry)
+  assert sorted(sessions) == ['1', '2']
+  assert [f['dir'] for f in sessions['1']['fmaps']] == ['topup-ses-1_01']
+  assert [f['dir'] for f in sessions['2']['fmaps']] == ['topup-ses-2_acq-mb_02']
+  assert sessions['1']['fmaps'][0]['ap'].ent['direction'] == 'AP'
+
+  # cached per layout
+  calls = layout.calls
+  assert wrapper.session_inputs(layout, entry) is sessions
+  assert layout.calls == calls
+  assert wrapper.session_inputs(FakeLayout([]), entry) == {None: {'fmaps': []}}
+
+
+def test_session_inputs_rejects_unbalanced_fieldmaps(wrapper):
+  layout = FakeLayout([FakeFile(direction='AP'), FakeFile(direction='AP', run=2), FakeFile(direction='PA', run=2)])
+  with pytest.raises(Exception, match='unbalanced'):
+    wrapper.session_inputs(layout, types.SimpleNamespace(pid='01'))
@@ -0,0 +1,69 @@
+import os
+import subprocess
+import types
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fmripreproc_code')
+
+# stand-ins for the FSL tools getsnr calls: fslmaths logs its arguments
+FAKE_TOOLS = {
+  'fslmaths': 'echo "$@" >> fslmaths.log; touch ${@: -3:1}.nii.gz',
+  'fslslice': 'touch ${1}_slice_0000.nii.gz ${1}_slice_0001.nii.gz',
+  'fslstats': 'if [ "$3" = "-M" ]; then echo 0 40 12.5; else echo 0 40 10 2.5; fi',
+}
+
+
+def fake_tools(path):
+  path.mkdir()
+  for name, body in FAKE_TOOLS.items():
+    (path / name).write_text('#!/bin/bash\n' + body + '\n')
+    (path / name).chmod(0o755)
+
+
+def test_getsnr_masks_the_maps_and_reports_float(tmp_path):
+  fake_tools(tmp_path / 'bin')
+  env = dict(os.environ, PATH=str(tmp_path / 'bin') + os.pathsep + os.environ['PATH'])
+  subprocess.run(['bash', SCRIPTS + '/getsnr', 'func.nii.gz', 'sub-01', 'rest01', 'mask.nii.gz'],
+                 cwd=tmp_path, env=env, check=True, capture_output=True)
+
+  calls = (tmp_path / 'fslmaths.log').read_text().splitlines()
+  assert calls == ['func.nii.gz -Tmean -mas mask.nii.gz avg -odt float',
+                   'func.nii.gz -Tstd -mas mask.nii.gz std -odt float',
+                   'avg -div std -mas mask.nii.gz snr -odt float']
+  assert (tmp_path / 'by_slice.csv').read_text().splitlines() == [
+    'subj,func,slice,min,max,mean,std', 'sub-01,rest01,0,0,40,10,2.5', 'sub-01,rest01,1,0,40,10,2.5']
+  assert (tmp_path / 'whole_brain.csv').read_text().splitlines() == [
+    'subject,func,min,max,nonzeroMean', 'sub-01,rest01,0,40,12.5']
+  assert not list(tmp_path.glob('snr_slice_*'))
+
+
+class FakeLayout:
+  def __init__(self, paths):
+    self.paths = paths
+
+  def get(self, **filters):
+    return [types.SimpleNamespace(path=p, filename=os.path.basename(p)) for p in self.paths]
+
+  def parse_file_entities(self, path):
+    return {'subject': '01', 'task': 'rest', 'run': 1, 'suffix': 'bold'}
+
+
+def test_run_snr_waits_for_registration(wrapper, tmp_path, monkeypatch):
+  jobs = []
+  monkeypatch.setattr(wrapper, 'run_jobs', lambda batch, entry: jobs.extend(batch))
+  monkeypatch.setattr(wrapper, 'template_assets', lambda entry: {'MNI152_T1_2mm_brain': 'brain.nii', 'MNI152_T1_2mm_brain_bin': 'bin.nii'})
+  entry = types.SimpleNamespace(pid='01', wd=str(tmp_path), templates='/code', overwrite=False, currentstage=None)
+  layout = FakeLayout(['/out/sub-01_task-rest_run-01_space-native_desc-preproc_bold.nii.gz'])
+
+  assert wrapper.run_snr(layout, entry)
+  [job] = jobs
+  assert job.name == 'snr-rest01-bold'
+  assert job.after == ['registration-rest01-bold']
+  assert job.cmd.endswith(' ' + str(tmp_path) + ' rest01 brain.nii bin.nii')
+
+  # finished runs are skipped
+  done = tmp_path / 'snr/rest01/snr_calc/rest01'
+  done.mkdir(parents=True)
+  (done / 'snr2standard.nii.gz').write_text('x')
+  jobs.clear()
+  assert not wrapper.run_snr(layout, entry)
+  assert jobs == []
@@ -0,0 +1,93 @@
+import os
+import types
+
+
+def test_downstream_stages(wrapper):
+  assert wrapper.downstream_stages(['aroma-classify']) == {'aroma-classify', 'report'}
+  assert wrapper.downstream_stages(['fast']) == {'fast', 'outliers', 'report'}
+  assert wrapper.downstream_stages(['topup']) == {
+    'topup', 'distcorrepi', 'preprocess', 'registration', 'snr', 'outliers',
+    'aroma-model', 'aroma-classify', 'report'}
+  assert wrapper.downstream_stages([]) == set()
+
+
+def test_upstream_stages_are_the_inverse(wrapper):
+  names = [name for name, run, save, after in wrapper.STAGES]
+  for name in names:
+    for other in wrapper.upstream_stages(name):
+      assert name in wrapper.downstream_stages([other])
+  assert set(wrapper.upstream_stages('distcorrepi')) == {'topup'}
+
+
+def make_entry(tmp_path, forced, runqc=True):
+  wd = tmp_path / 'wd'
+  for d in ('bet/t1bet', 'topup-01', 'distcorrepi', 'preproc', 'reg/run-01', 'segment', 'aroma/aroma_classify'):
+    (wd / d).mkdir(parents=True)
+  for f in ('preproc/run-01_mcf.nii.gz', 'preproc/run-01_fd_metrics.tsv', 'preproc/run-01_confounds.tsv', 'preproc/run-01_wm_func.nii.gz'):
+    (wd / f).write_text('x')
+  return types.SimpleNamespace(wd=str(wd), outputs=str(tmp_path / 'out'), pid='01', runQC=runqc,
+                               stages=None, forcestages=forced)
+
+
+def test_invalidate_forced_stage_keeps_upstream(wrapper, tmp_path):
+  entry = make_entry(tmp_path, wrapper.downstream_stages(['outliers']))
+  wrapper.invalidate_stages(entry)
+  wd = entry.wd
+  assert sorted(os.listdir(wd + '/preproc')) == ['run-01_mcf.nii.gz']   # preprocess output kept
+  for kept in ('bet', 'topup-01', 'distcorrepi', 'reg', 'segment', 'aroma/aroma_classify'):
+    assert os.path.exists(wd + '/' + kept)
+
+
+def test_invalidate_removes_downstream_outputs(wrapper, tmp_path):
+  entry = make_entry(tmp_path, wrapper.downstream_stages(['preprocess']))
+  wrapper.invalidate_stages(entry)
+  wd = entry.wd
+  for removed in ('preproc', 'reg', 'aroma'):
+    assert not os.path.exists(wd + '/' + removed)
+  for kept in ('bet', 'topup-01', 'distcorrepi', 'segment'):
+    assert os.path.exists(wd + '/' + kept)
+
+
+def test_invalidate_removes_published_outputs(wrapper, tmp_path):
+  entry = make_entry(tmp_path, wrapper.downstream_stages(['registration']))
+  out = tmp_path / 'out/fmripreproc/sub-01'
+  published = {
+    'ses-1/func/sub-01_ses-1_task-rest_run-01_space-MNI152Nonlin2006_desc-preproc_bold.nii.gz': False,
+    'ses-1/func/sub-01_ses-1_task-rest_run-01_space-MNI152Nonlin2006_desc-preproc_snr.nii.gz': False,
+    'ses-1/func/sub-01_ses-1_task-rest_run-01_reg/example_func2standard.mat': False,
+    'ses-1/func/sub-01_ses-1_task-rest_run-01_desc-preproc_confounds.tsv': False,
+    'ses-1/func/sub-01_ses-1_task-rest_run-01_space-native_desc-preproc_bold.nii.gz': True,
+    'anat/sub-01_space-MNI152Nonlin2006_desc-brain_T1w.nii.gz': False,
+    'anat/sub-01_space-T1w_desc-brain_T1w.nii.gz': True,
+  }
+  for name in published:
+    (out / name).parent.mkdir(parents=True, exist_ok=True)
+    (out / name).write_text('x')
+  wrapper.invalidate_stages(entry)
+  assert {name: (out / name).exists() for name in published} == published
+
+
+def test_invalidate_only_selected_stages(wrapper, tmp_path):
+  entry = make_entry(tmp_path, wrapper.downstream_stages(['preprocess']))
+  entry.stages = ['registration']
+  wrapper.invalidate_stages(entry)
+  assert not os.path.exists(entry.wd + '/reg')
+  assert os.path.exists(entry.wd + '/preproc/run-01_mcf.nii.gz')
+
+
+def parse(wrapper, tmp_path, *argv):
+  (tmp_path / 'bids').mkdir(exist_ok=True)
+  return wrapper.parse_arguments(['--in=' + str(tmp_path / 'bids'), '--out=' + str(tmp_path / 'out'),
+                                  '--participant-label=01'] + list(argv))
+
+
+def test_from_stage_selects_downstream(wrapper, tmp_path):
+  entry = parse(wrapper, tmp_path, '--from-stage=registration')
+  assert set(entry.forcestages) == {'registration', 'snr', 'outliers', 'report'}
+  assert set(entry.stages) == set(entry.forcestages)
+
+
+def test_force_stage_with_stage_selection(wrapper, tmp_path):
+  entry = parse(wrapper, tmp_path, '--stages=bet,fast', '--force-stage=fast')
+  assert set(entry.forcestages) == {'fast', 'outliers', 'report'}
+  assert set(entry.stages) == {'bet', 'fast', 'outliers', 'report'}
@@ -0,0 +1,65 @@
+import json
+import os
+import socket
+import types
+import urllib.request
+
+
+def make_monitor(wrapper, tmp_path, port=None):
+  entry = types.SimpleNamespace(outputs=str(tmp_path / 'out'), pid='01', runQC=False, stages=None)
+  os.makedirs(entry.outputs + '/fmripreproc')
+  return wrapper.StatusMonitor(entry, str(tmp_path / 'wd/status.json'), str(tmp_path), interval=3600, port=port)
+
+
+def test_metrics_from_a_sample(wrapper, tmp_path):
+  monitor = make_monitor(wrapper, tmp_path)
+  monitor.begin_stage('01', 'preprocess')
+  done, running = wrapper.Job('preproc-rest01', 'true'), wrapper.Job('preproc-rest02', 'true')
+  monitor.add_jobs([done, running])
+  done.status, done.start, done.end = 'done', 100.0, 160.0
+  running.status, running.start, running.pid = 'running', 150.0, os.getpid()
+  monitor.status = monitor.sample()
+
+  lines = monitor.metrics().splitlines()
+  assert 'fmripreproc_jobs{stage="preprocess",status="done"} 1' in lines
+  assert 'fmripreproc_jobs{stage="preprocess",status="running"} 1' in lines
+  assert 'fmripreproc_jobs{stage="preprocess",status="failed"} 0' in lines
+  assert any(l.startswith('fmripreproc_job_elapsed_seconds{job="preproc-rest02",stage="preprocess"} ') for l in lines)
+  assert not any('preproc-rest01' in l for l in lines)     # only running jobs have gauges
+  assert any(l.startswith('fmripreproc_scratch_free_bytes ') for l in lines)
+  assert any(l.startswith('fmripreproc_eta_seconds{subject="01"} ') for l in lines)
+  # every line is "<name>[{labels}] <number>"
+  for line in lines:
+    float(line.rsplit(' ', 1)[1])
+
+
+def test_metrics_skip_missing_values(wrapper, tmp_path):
+  monitor = make_monitor(wrapper, tmp_path)
+  monitor.status = {'node': {'cpu_utilization': None}, 'scratch': {'used': None, 'free': 10}}
+  assert monitor.metrics() == 'fmripreproc_scratch_free_bytes 10\n'
+
+
+def test_eta_from_stage_history(wrapper, tmp_path):
+  monitor = make_monitor(wrapper, tmp_path)
+  wrapper.write_json(monitor.history, {name: 10 for name in monitor.stages})
+  eta, complete = monitor.eta(0)
+  assert (eta, complete) == (10 * len(monitor.stages), True)
+  monitor.begin_stage('01', monitor.stages[0])
+  eta, complete = monitor.eta(monitor.stagestart + 4)
+  assert (eta, complete) == (10 * len(monitor.stages) - 4, True)
+
+
+def test_metrics_endpoint(wrapper, tmp_path):
+  with socket.socket() as probe:
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+  monitor = make_monitor(wrapper, tmp_path, port=port).start()
+  try:
+    with urllib.request.urlopen('http://127.0.0.1:' + str(port) + '/metrics') as r:
+      assert r.headers['Content-Type'].startswith('text/plain')
+      assert 'fmripreproc_eta_seconds{subject="01"}' in r.read().decode()
+    with urllib.request.urlopen('http://127.0.0.1:' + str(port) + '/status.json') as r:
+      assert json.load(r)['subject'] == '01'
+  finally:
+    monitor.close()
+  assert json.load(open(tmp_path / 'wd/status.json'))['subject'] == '01'
@@ -0,0 +1,59 @@
+import os
+import types
+
+import nibabel as nib
+import numpy as np
+
+
+def test_dilate(wrapper):
+  mask = np.zeros((5, 5, 5), bool)
+  mask[2, 2, 2] = True
+  out = wrapper.dilate(mask)
+  assert out[1:4, 1:4, 1:4].all() and out.sum() == 27
+  # the border does not wrap around
+  mask[:] = False
+  mask[0, 0, 0] = True
+  assert wrapper.dilate(mask).sum() == 8
+
+
+def make_fsldir(root):
+  std = root / 'data/standard'
+  std.mkdir(parents=True)
+  brain = np.zeros((6, 6, 6), np.float32)
+  brain[2:4, 2:4, 2:4] = 100
+  for name in ('MNI152_T1_2mm', 'MNI152_T1_2mm_brain'):
+    nib.save(nib.Nifti1Image(brain, np.eye(4)), str(std / (name + '.nii.gz')))
+  return std
+
+
+def test_template_cache(wrapper, tmp_path, monkeypatch):
+  std = make_fsldir(tmp_path / 'fsl')
+  monkeypatch.setenv('FSLDIR', str(tmp_path / 'fsl'))
+  monkeypatch.setattr(wrapper, 'HCP_TEMPLATES', None)
+  entry = types.SimpleNamespace(templatecache=str(tmp_path / 'cache'))
+  assets = wrapper.template_assets(entry)
+
+  assert 'MNI152_T1_0.8mm' not in assets                      # left to t1_fnirt_bet2
+  assert assets['MNI152_T1_2mm_brain'].startswith(str(tmp_path / 'cache')) and assets['MNI152_T1_2mm_brain'].endswith('.nii')
+  assert assets['MNI152_T1_1mm'] == str(std / 'MNI152_T1_1mm.nii.gz')   # missing: own location
+  assert np.asanyarray(nib.load(assets['MNI152_T1_2mm_brain']).dataobj).max() == 100
+  assert np.asanyarray(nib.load(assets['MNI152_T1_2mm_brain_bin']).dataobj).sum() == 8
+  assert np.asanyarray(nib.load(assets['MNI152_T1_2mm_brain_mask_dil']).dataobj).sum() == 64
+  assert wrapper.template_assets(entry) is assets
+
+  # a second process reuses the cache, a changed source builds a new one
+  built = os.path.getmtime(assets['MNI152_T1_2mm_brain'])
+  again = wrapper.template_assets(types.SimpleNamespace(templatecache=str(tmp_path / 'cache')))
+  assert again == assets and os.path.getmtime(again['MNI152_T1_2mm_brain']) == built
+  nib.save(nib.Nifti1Image(np.ones((6, 6, 6), np.float32), np.eye(4)), str(std / 'MNI152_T1_2mm_brain_mask_dil.nii.gz'))
+  rebuilt = wrapper.template_assets(types.SimpleNamespace(templatecache=str(tmp_path / 'cache')))
+  assert os.path.dirname(rebuilt['MNI152_T1_2mm_brain']) != os.path.dirname(assets['MNI152_T1_2mm_brain'])
+  assert np.asanyarray(nib.load(rebuilt['MNI152_T1_2mm_brain_mask_dil']).dataobj).sum() == 216   # FSL's own mask
+
+
+def test_hcp_templates_from_the_environment(wrapper, tmp_path, monkeypatch):
+  monkeypatch.setenv('FSLDIR', str(tmp_path / 'fsl'))
+  monkeypatch.setattr(wrapper, 'HCP_TEMPLATES', str(tmp_path / 'hcp'))
+  assert wrapper.template_source('MNI152_T1_0.8mm') == str(tmp_path / 'hcp/MNI152_T1_0.8mm.nii.gz')
+  monkeypatch.setattr(wrapper, 'HCP_TEMPLATES', None)
+  assert wrapper.template_source('MNI152_T1_0.8mm') is None
@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+import time
+import types
+
+
+def add_session(subdir, ses, anat=True):
+  # T1w (optional), an AP/PA fieldmap pair intended for one bold run
+  prefix = subdir + '/ses-' + ses + '/'
+  files = {}
+  if anat:
+    files['anat/sub-01_ses-' + ses + '_T1w.nii.gz'] = ''
+    files['anat/sub-01_ses-' + ses + '_T1w.json'] = '{}'
+  bold = 'func/sub-01_ses-' + ses + '_task-rest_bold'
+  for d in ('AP', 'PA'):
+    files['fmap/sub-01_ses-' + ses + '_dir-' + d + '_epi.nii.gz'] = ''
+    files['fmap/sub-01_ses-' + ses + '_dir-' + d + '_epi.json'] = json.dumps({'IntendedFor': ['ses-' + ses + '/' + bold + '.nii.gz']})
+  files[bold + '.nii.gz'] = ''
+  files[bold + '.json'] = '{}'
+  for name, text in files.items():
+    os.makedirs(os.path.dirname(prefix + name), exist_ok=True)
+    with open(prefix + name, 'w') as f:
+      f.write(text)
+  return [prefix + name for name in files]
+
+
+def test_input_sets_counts_complete_sets(wrapper, tmp_path):
+  subdir = str(tmp_path / 'sub-01')
+  files = add_session(subdir, '1')
+  complete, counts = wrapper.input_sets(subdir, {p: True for p in files})
+  assert counts == {'t1w': 1, 'fmap': 1, 'bold': 1}
+  assert complete == set(files)
+
+  # a bold run still being written holds back only its own files
+  stable = {p: not p.endswith('_bold.json') for p in files}
+  complete, counts = wrapper.input_sets(subdir, stable)
+  assert counts == {'t1w': 1, 'fmap': 1, 'bold': 0}
+  assert not any('/func/' in p for p in complete)
+
+  # an unpaired fieldmap is never complete, nor is the run it would correct
+  stable = {p: True for p in files if '_dir-PA_' not in p}
+  complete, counts = wrapper.input_sets(subdir, stable)
+  assert counts == {'t1w': 1, 'fmap': 0, 'bold': 0}
+
+
+def test_watch_group(wrapper):
+  assert wrapper.watch_group('/d/sub-01', '/d/sub-01/ses-2/anat/sub-01_ses-2_T1w.nii.gz') == 'anat'
+  assert wrapper.watch_group('/d/sub-01', '/d/sub-01/ses-2/func/sub-01_ses-2_task-rest_bold.nii.gz') == 'ses-2'
+  assert wrapper.watch_group('/d/sub-01', '/d/sub-01/func/sub-01_task-rest_bold.nii.gz') is None
+  assert wrapper.watch_group('/d/sub-01', '/d/sub-01/anat/sub-01_T1w.nii.gz') == 'anat'
+
+
+def test_dir_watcher_sees_new_files(wrapper, tmp_path):
+  subdir = tmp_path / 'sub-01'
+  (subdir / 'func').mkdir(parents=True)
+  for polling in (False, True):
+    watcher = wrapper.DirWatcher(str(tmp_path), str(subdir), poll=0.1)
+    if polling:
+      watcher.fd = None
+    name = subdir / 'func' / ('new' + str(polling))
+    threading.Timer(0.3, name.write_text, ['x']).start()
+    start = time.time()
+    watcher.wait(10)
+    assert name.exists() and time.time() - start < 5
+    start = time.time()
+    watcher.wait(0.2)   # nothing changes: returns after the timeout
+    assert time.time() - start < 5
+
+
+def test_run_watch_reprocesses_only_the_new_session(wrapper, tmp_path, monkeypatch):
+  subdir = str(tmp_path / 'ds/sub-01')
+  first = add_session(subdir, '1')
+  calls = []
+  monkeypatch.setattr(wrapper, 'bids_data', lambda entry, ignore=None: calls.append(('index', sorted(ignore))))
+  monkeypatch.setattr(wrapper, 'run_stage', lambda name, layout, entry: calls.append(name))
+
+  class Watcher:
+    # the second session arrives while the first one is processed
+    def __init__(self, root, subdir):
+      self.waits = 0
+
+    def wait(self, timeout=None):
+      self.waits += 1
+      if self.waits == 1:
+        add_session(subdir, '2', anat=False)
+      else:
+        time.sleep(timeout)
+
+  monkeypatch.setattr(wrapper, 'DirWatcher', Watcher)
+  entry = types.SimpleNamespace(inputs=str(tmp_path / 'ds'), pid='01', watchsettle=0, watchidle=0.5, runQC=False, stages=None)
+  wrapper.run_watch(entry)
+
+  indexed = [i for i, c in enumerate(calls) if isinstance(c, tuple)]
+  assert len(indexed) == 2
+  assert calls[indexed[0]] == ('index', [])
+  assert calls[1] == 'bet' and 'fast' in calls[:indexed[1]]
+  second = calls[indexed[1] + 1:]
+  assert 'bet' not in second and 'fast' not in second and 'preprocess' in second
+  assert calls[indexed[1]][1] == sorted(p for p in first if '/anat/' not in p)   # session 1 left out